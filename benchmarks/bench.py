@@ -0,0 +1,241 @@
+"""Measure the throughput of the generation stages against a local mock of the OpenAI API.
+
+No real requests are made: a mock server with configurable latency
+distributions, 429 injection and image-edit responses is started in this
+process, synthetic parquet shards are written, and the four stages (and
+the pipeline) are run as `python -m src <stage>` subprocesses against it.
+For every stage the rows/s, the p50/p99 server-side latency per endpoint,
+the number of 429s served and the peak RSS are reported, as well as the
+startup time of the command line and the import cost of each stage module,
+which every run and every --workers process pays before its first request.
+
+    python -m benchmarks.bench --rows 128 --shards 2 --p429 0.02
+"""
+
+import argparse
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Any, Dict, List
+
+import pyarrow.parquet as pq
+
+from .mock_openai import Latency, MockState, start_mock_server
+from .synthetic_data import write_shards
+
+
+STAGES = ["1", "2", "3", "4", "pipeline"]
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the generation stages against a local mock OpenAI server")
+    parser.add_argument("--work-dir", default="./bench_output", help="Directory for the synthetic shards, outputs and logs (recreated)")
+    parser.add_argument("--shards", type=int, default=2, help="Number of synthetic parquet shards")
+    parser.add_argument("--rows", type=int, default=128, help="Rows per shard")
+    parser.add_argument("--image-size", type=int, default=1024, help="Side length of the synthetic images")
+    parser.add_argument("--row-group-size", type=int, default=64, help="Parquet row group size of the synthetic shards")
+    parser.add_argument("--unique-images", type=int, default=32, help="Distinct images per column the rows cycle through")
+    parser.add_argument("--chat-latency", default="lognormal:0.8:0.4", help="Chat completion latency: fixed:S, uniform:LOW:HIGH or lognormal:MEDIAN:SIGMA (seconds)")
+    parser.add_argument("--image-latency", default="lognormal:4:0.3", help="Image edit latency, same format as --chat-latency")
+    parser.add_argument("--p429", type=float, default=0.0, help="Probability that a request is answered with a 429")
+    parser.add_argument("--retry-after-ms", type=int, default=500, help="retry-after-ms header of the injected 429s")
+    parser.add_argument("--edited-image-size", type=int, default=1024, help="Side length of the image returned by the image edits")
+    parser.add_argument("--stages", default="1,2,3,4,pipeline", help=f"Comma separated stages to run, from {','.join(STAGES)}")
+    parser.add_argument("--concurrency", type=int, default=16, help="Requests in flight per stage (--concurrency, or the per-stage options of run_pipeline)")
+    parser.add_argument("--extra-args", default="", help="Extra command line options passed to every run_* script, e.g. \"--image-max-side 512\"")
+    parser.add_argument("--startup-runs", type=int, default=5, help="Repetitions of each startup measurement, the fastest is reported (0: skip them)")
+    parser.add_argument("--report", default=None, help="Write the results as JSON to this file")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic data and of the mock server")
+    return parser.parse_args()
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def count_rows(output_dir: Path) -> int:
+    rows = 0
+    for path in output_dir.glob("*.jsonal"):
+        with path.open("rb") as f:
+            rows += sum(1 for _ in f)
+    # --output-format parquet
+    for path in output_dir.glob("*.parquet"):
+        rows += pq.ParquetFile(path).metadata.num_rows
+    return rows
+
+
+def stage_commands(args: argparse.Namespace, data_dir: Path, out_dir: Path) -> Dict[str, List[str]]:
+    common = ["--api-key", "mock", "--input-parquet-dir", str(data_dir)] + shlex.split(args.extra_args)
+    concurrency = ["--concurrency", str(args.concurrency)]
+    stage_dirs = {stage: out_dir / stage for stage in ["1", "2", "3", "4"]}
+    pipeline_dirs = [out_dir / "pipeline" / stage for stage in ["1", "2", "3", "4"]]
+    return {
+        "1": ["-m", "src", "difference", "--output-dir", str(stage_dirs["1"])] + concurrency + common,
+        "2": ["-m", "src", "instruction", "--input-jsonal-dir", str(stage_dirs["1"]), "--output-dir", str(stage_dirs["2"])] + concurrency + common,
+        "3": ["-m", "src", "step-image", "--input-jsonal-dir", str(stage_dirs["2"]), "--output-dir", str(stage_dirs["3"])] + concurrency + common,
+        "4": ["-m", "src", "analysis", "--input-jsonal-dir", str(stage_dirs["3"]), "--output-dir", str(stage_dirs["4"])] + concurrency + common,
+        "pipeline": [
+            "-m", "src", "pipeline",
+            "--difference-output-dir", str(pipeline_dirs[0]),
+            "--instruction-output-dir", str(pipeline_dirs[1]),
+            "--step-image-output-dir", str(pipeline_dirs[2]),
+            "--analysis-output-dir", str(pipeline_dirs[3]),
+            "--difference-concurrency", str(args.concurrency),
+            "--instruction-concurrency", str(args.concurrency),
+            "--step-image-concurrency", str(args.concurrency),
+            "--analysis-concurrency", str(args.concurrency),
+        ] + common,
+    }
+
+
+def startup_commands(data_dir: Path, out_dir: Path) -> Dict[str, List[str]]:
+    """Commands that return before any request: the bare interpreter, the command line, and the stage imports."""
+    commands = {
+        "python -c pass": ["-c", "pass"],
+        "python -m src --help": ["-m", "src", "--help"],
+        "python -m src difference --help": ["-m", "src", "difference", "--help"],
+        "python -m src plan": ["-m", "src", "plan", "--input-parquet-dir", str(data_dir), "--output-dir", str(out_dir / "1")],
+    }
+    for module in ["run_1", "run_2", "run_3", "run_4", "run_pipeline"]:
+        commands[f"import src.{module}"] = ["-c", f"import src.{module}"]
+    return commands
+
+
+def measure_startup(commands: Dict[str, List[str]], env: Dict[str, str], runs: int) -> Dict[str, float]:
+    """Seconds until each command exits, the fastest of `runs` (the others include disk cache misses and noise)."""
+    startup = {}
+    for label, command in commands.items():
+        seconds = []
+        for _ in range(runs):
+            started = time.monotonic()
+            subprocess.run([sys.executable] + command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=env, check=True)
+            seconds.append(time.monotonic() - started)
+        startup[label] = round(min(seconds), 4)
+    return startup
+
+
+def run_stage(stage: str, command: List[str], output_dir: Path, log_path: Path, env: Dict[str, str], state: MockState) -> Dict[str, Any]:
+    """Run one stage as a subprocess and measure it."""
+    state.reset()
+    started = time.monotonic()
+    with log_path.open("w") as log:
+        process = subprocess.Popen([sys.executable] + command, stdout=log, stderr=subprocess.STDOUT, env=env)
+        # wait4 gives the resource usage of exactly this child (and its pool workers)
+        _, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.monotonic() - started
+    process.returncode = os.waitstatus_to_exitcode(status)
+    served = state.snapshot()
+    rows = count_rows(output_dir)
+    return {
+        "stage": stage,
+        "exit_code": process.returncode,
+        "rows": rows,
+        "seconds": round(elapsed, 3),
+        "rows_per_second": round(rows / elapsed, 3) if elapsed > 0 else None,
+        "requests": served["requests"],
+        "rate_limited": served["rate_limited"],
+        "latency": {
+            endpoint: {
+                "count": len(values),
+                "p50": round(percentile(values, 50), 4),
+                "p99": round(percentile(values, 99), 4),
+            }
+            for endpoint, values in served["latencies"].items()
+        },
+        # ru_maxrss is in KiB on Linux
+        "peak_rss_mb": round(usage.ru_maxrss / 1024, 1),
+        "log": str(log_path),
+    }
+
+
+def print_report(results: List[Dict[str, Any]]) -> None:
+    header = f"{'stage':<9} {'rows':>6} {'sec':>8} {'rows/s':>8} {'reqs':>6} {'429s':>5} {'endpoint':<12} {'p50 s':>7} {'p99 s':>7} {'peak RSS MB':>11}"
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        latency = result["latency"] or {"-": {"p50": float("nan"), "p99": float("nan")}}
+        for k, (endpoint, values) in enumerate(sorted(latency.items())):
+            lead = (
+                f"{result['stage']:<9} {result['rows']:>6} {result['seconds']:>8.2f} {result['rows_per_second']:>8.2f} "
+                f"{result['requests']:>6} {result['rate_limited']:>5}"
+                if k == 0 else " " * 47
+            )
+            tail = f" {result['peak_rss_mb']:>11.1f}" if k == 0 else ""
+            print(f"{lead} {endpoint:<12} {values['p50']:>7.3f} {values['p99']:>7.3f}{tail}")
+        if result["exit_code"] != 0:
+            print(f"  stage {result['stage']} exited with {result['exit_code']}, see {result['log']}")
+
+
+def print_startup(startup: Dict[str, float]) -> None:
+    header = f"{'startup':<34} {'sec':>7}"
+    print(header)
+    print("-" * len(header))
+    for label, seconds in startup.items():
+        print(f"{label:<34} {seconds:>7.3f}")
+
+
+def main() -> None:
+    args = parse_args()
+    stages = [stage.strip() for stage in args.stages.split(",") if stage.strip()]
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        raise SystemExit(f"Unknown stages: {', '.join(sorted(unknown))}")
+
+    work_dir = Path(args.work_dir)
+    shutil.rmtree(work_dir, ignore_errors=True)
+    data_dir = work_dir / "dataset"
+    out_dir = work_dir / "output"
+    for name in ["1", "2", "3", "4"]:
+        (out_dir / name).mkdir(parents=True, exist_ok=True)
+        (out_dir / "pipeline" / name).mkdir(parents=True, exist_ok=True)
+
+    print(f"Writing {args.shards} synthetic shards of {args.rows} rows to {data_dir}\n")
+    write_shards(data_dir, args.shards, args.rows, args.image_size, args.row_group_size, args.unique_images, args.seed)
+
+    state = MockState(
+        Latency(args.chat_latency),
+        Latency(args.image_latency),
+        p429=args.p429,
+        retry_after_ms=args.retry_after_ms,
+        image_size=args.edited_image_size,
+        seed=args.seed,
+    )
+    server = start_mock_server(state)
+    env = dict(os.environ, OPENAI_BASE_URL=f"http://127.0.0.1:{server.server_address[1]}/v1", OPENAI_API_KEY="mock")
+
+    commands = stage_commands(args, data_dir, out_dir)
+    results = []
+    startup = {}
+    try:
+        if args.startup_runs > 0:
+            print("Measuring startup ...")
+            startup = measure_startup(startup_commands(data_dir, out_dir), env, args.startup_runs)
+        for stage in stages:
+            output_dir = out_dir / stage if stage != "pipeline" else out_dir / "pipeline" / "4"
+            print(f"Running stage {stage} ...")
+            results.append(run_stage(stage, commands[stage], output_dir, work_dir / f"stage_{stage}.log", env, state))
+    finally:
+        server.shutdown()
+
+    print()
+    print_report(results)
+    if startup:
+        print()
+        print_startup(startup)
+    if args.report:
+        report = {"config": vars(args), "results": results, "startup": startup}
+        Path(args.report).write_text(json.dumps(report, indent=2), encoding="utf-8")
+        print(f"\nReport written to {args.report}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+import base64
+import io
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+from PIL import Image
+
+
+class Latency:
+    """Latency distribution parsed from a spec string.
+
+    fixed:SECONDS, uniform:LOW:HIGH or lognormal:MEDIAN:SIGMA.
+    """
+
+    def __init__(self, spec: str) -> None:
+        kind, *values = spec.split(":")
+        self.kind = kind
+        self.values = [float(v) for v in values]
+        expected = {"fixed": 1, "uniform": 2, "lognormal": 2}
+        if kind not in expected or len(self.values) != expected[kind]:
+            raise ValueError(f"Bad latency spec {spec!r}: use fixed:S, uniform:LOW:HIGH or lognormal:MEDIAN:SIGMA")
+
+    def sample(self, rng: random.Random) -> float:
+        if self.kind == "fixed":
+            return self.values[0]
+        if self.kind == "uniform":
+            return rng.uniform(*self.values)
+        median, sigma = self.values
+        return median * rng.lognormvariate(0.0, sigma)
+
+
+class MockState:
+    """Behaviour and counters of the mock server, shared by its handler threads."""
+
+    def __init__(
+        self,
+        chat_latency: Latency,
+        image_latency: Latency,
+        p429: float = 0.0,
+        retry_after_ms: int = 500,
+        image_size: int = 1024,
+        seed: int = 0,
+    ) -> None:
+        self.chat_latency = chat_latency
+        self.image_latency = image_latency
+        self.p429 = p429
+        self.retry_after_ms = retry_after_ms
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        buffer = io.BytesIO()
+        Image.new("RGB", (image_size, image_size), (180, 120, 60)).save(buffer, format="PNG")
+        self.edited_image_b64 = base64.b64encode(buffer.getvalue()).decode("ascii")
+        self.files: Dict[str, bytes] = {}
+        self.batches: Dict[str, Dict[str, Any]] = {}
+        self.reset()
+
+    def reset(self) -> None:
+        with self.lock:
+            self.latencies: Dict[str, List[float]] = {}
+            self.rate_limited = 0
+            self.requests = 0
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "rate_limited": self.rate_limited,
+                "latencies": {k: list(v) for k, v in self.latencies.items()},
+            }
+
+    def draw(self, latency: Latency) -> Tuple[float, bool]:
+        with self.lock:
+            self.requests += 1
+            limited = self.rng.random() < self.p429
+            if limited:
+                self.rate_limited += 1
+            return latency.sample(self.rng), limited
+
+    def record(self, endpoint: str, seconds: float) -> None:
+        with self.lock:
+            self.latencies.setdefault(endpoint, []).append(seconds)
+
+
+def chat_answer(request: Dict[str, Any], serial: int) -> Dict[str, Any]:
+    """A chat.completion in the shape the stage asked for (schema lists or numbered dict)."""
+    response_format = request.get("response_format") or {}
+    properties = response_format.get("json_schema", {}).get("schema", {}).get("properties")
+    if properties:
+        content = {name: [f"{name} {serial}", f"{name} {serial} b"] for name in properties}
+    else:
+        content = {"1": f"answer {serial}", "2": f"answer {serial} b"}
+    return {
+        "id": f"chatcmpl-{serial}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": request.get("model", "gpt-4o"),
+        "choices": [
+            {
+                "index": 0,
+                "message": {"role": "assistant", "content": json.dumps(content)},
+                "finish_reason": "stop",
+            }
+        ],
+        "usage": {"prompt_tokens": 900, "completion_tokens": 60, "total_tokens": 960},
+    }
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state: MockState
+
+    def log_message(self, *args: Any) -> None:
+        pass
+
+    def _send_json(self, payload: Dict[str, Any], status: int = 200, headers: Optional[Dict[str, str]] = None) -> None:
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _rate_limited(self) -> None:
+        self._send_json(
+            {"error": {"message": "Rate limit reached (mock)", "type": "requests", "code": "rate_limit_exceeded"}},
+            status=429,
+            headers={"retry-after-ms": str(self.state.retry_after_ms)},
+        )
+
+    def _not_found(self) -> None:
+        self._send_json({"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}}, status=404)
+
+    def do_POST(self) -> None:
+        started = time.monotonic()
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        path = self.path.split("?")[0]
+        if path.endswith("/chat/completions"):
+            self._timed("chat", started, self.state.chat_latency, lambda: chat_answer(json.loads(body), self.state.requests))
+        elif path.endswith("/images/edits"):
+            self._timed(
+                "images.edit",
+                started,
+                self.state.image_latency,
+                lambda: {
+                    "created": int(time.time()),
+                    "data": [{"b64_json": self.state.edited_image_b64}],
+                    "usage": {"input_tokens": 300, "output_tokens": 1000, "total_tokens": 1300},
+                },
+            )
+        elif path.endswith("/files"):
+            self._upload_file(body)
+        elif path.endswith("/batches"):
+            self._create_batch(json.loads(body))
+        else:
+            self._not_found()
+
+    def _timed(self, endpoint: str, started: float, latency: Latency, make: Any) -> None:
+        delay, limited = self.state.draw(latency)
+        if limited:
+            self._rate_limited()
+            return
+        time.sleep(delay)
+        self._send_json(
+            make(),
+            headers={"x-ratelimit-remaining-requests": "10000", "x-ratelimit-remaining-tokens": "10000000"},
+        )
+        self.state.record(endpoint, time.monotonic() - started)
+
+    # Minimal Batch API: a batch completes on its second status check
+
+    def _upload_file(self, body: bytes) -> None:
+        boundary = self.headers["Content-Type"].split("boundary=")[1].encode()
+        content = b""
+        for part in body.split(b"--" + boundary):
+            if b'name="file"' in part:
+                content = part.split(b"\r\n\r\n", 1)[1].rsplit(b"\r\n", 1)[0]
+        file_id = f"file-{len(self.state.files)}"
+        self.state.files[file_id] = content
+        self._send_json({
+            "id": file_id, "object": "file", "bytes": len(content), "created_at": int(time.time()),
+            "filename": "batch_input.jsonl", "purpose": "batch", "status": "processed",
+        })
+
+    def _create_batch(self, request: Dict[str, Any]) -> None:
+        batch_id = f"batch_{len(self.state.batches)}"
+        self.state.batches[batch_id] = {
+            "id": batch_id, "object": "batch", "endpoint": request["endpoint"],
+            "input_file_id": request["input_file_id"], "completion_window": "24h",
+            "status": "in_progress", "created_at": int(time.time()),
+            "output_file_id": None, "request_counts": None, "_checks": 0,
+        }
+        self._send_json(self._public(self.state.batches[batch_id]))
+
+    @staticmethod
+    def _public(batch: Dict[str, Any]) -> Dict[str, Any]:
+        return {k: v for k, v in batch.items() if not k.startswith("_")}
+
+    def do_GET(self) -> None:
+        parts = self.path.split("?")[0].split("/")
+        if "batches" in parts:
+            batch = self.state.batches[parts[-1]]
+            batch["_checks"] += 1
+            if batch["_checks"] >= 2 and batch["status"] != "completed":
+                self._complete_batch(batch)
+            self._send_json(self._public(batch))
+        elif "files" in parts and parts[-1] == "content":
+            data = self.state.files[parts[-2]]
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        else:
+            self._not_found()
+
+    def _complete_batch(self, batch: Dict[str, Any]) -> None:
+        lines = []
+        for line in self.state.files[batch["input_file_id"]].decode("utf-8").splitlines():
+            item = json.loads(line)
+            answer = chat_answer(item["body"], len(lines))
+            lines.append(json.dumps({
+                "id": f"batch_req_{len(lines)}", "custom_id": item["custom_id"],
+                "response": {"status_code": 200, "body": answer}, "error": None,
+            }))
+        output_id = f"file-{len(self.state.files)}"
+        self.state.files[output_id] = ("\n".join(lines) + "\n").encode("utf-8")
+        batch.update(
+            status="completed",
+            output_file_id=output_id,
+            request_counts={"total": len(lines), "completed": len(lines), "failed": 0},
+        )
+
+
+def start_mock_server(state: MockState, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+    """Serve the mock API from a background thread; the bound port is server.server_address[1]."""
+    handler = type("BoundMockHandler", (MockHandler,), {"state": state})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
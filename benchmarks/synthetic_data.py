@@ -0,0 +1,60 @@
+import io
+import random
+from pathlib import Path
+from typing import List
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from PIL import Image
+
+
+def make_image(rng: random.Random, size: int, image_format: str) -> bytes:
+    """A smooth random gradient, so that JPEG/PNG sizes resemble photos more than noise does."""
+    small = Image.new("RGB", (4, 4))
+    small.putdata([tuple(rng.randrange(256) for _ in range(3)) for _ in range(16)])
+    image = small.resize((size, size), Image.BICUBIC)
+    buffer = io.BytesIO()
+    image.save(buffer, format=image_format, quality=90)
+    return buffer.getvalue()
+
+
+def write_shards(
+    out_dir: Path,
+    shards: int,
+    rows: int,
+    image_size: int = 1024,
+    row_group_size: int = 64,
+    unique_images: int = 32,
+    seed: int = 0,
+) -> List[Path]:
+    """Write train-XXXXX-of-YYYYY.parquet shards with src_img / edited_img struct columns.
+
+    The structs hold {"bytes", "path"} like the real dataset. Image bytes are
+    drawn from a pool of `unique_images` per column to keep generation fast;
+    every row still gets its own path names.
+    """
+    rng = random.Random(seed)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    sources = [make_image(rng, image_size, "PNG") for _ in range(unique_images)]
+    targets = [make_image(rng, image_size, "JPEG") for _ in range(unique_images)]
+    image_type = pa.struct([("bytes", pa.binary()), ("path", pa.string())])
+    paths = []
+    for shard in range(shards):
+        base = shard * rows
+        table = pa.table(
+            {
+                "src_img": pa.array(
+                    [{"bytes": sources[(base + i) % unique_images], "path": f"{base + i}_src.png"} for i in range(rows)],
+                    type=image_type,
+                ),
+                "edited_img": pa.array(
+                    [{"bytes": targets[(base + i) % unique_images], "path": f"{base + i}_tgt.jpg"} for i in range(rows)],
+                    type=image_type,
+                ),
+                "edit_prompt": [f"synthetic edit prompt {base + i}" for i in range(rows)],
+            }
+        )
+        path = out_dir / f"train-{shard:05d}-of-{shards:05d}.parquet"
+        pq.write_table(table, path, row_group_size=row_group_size)
+        paths.append(path)
+    return paths
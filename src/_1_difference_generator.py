@@ -1,77 +1,97 @@
 import base64
 from typing import List
-from typing import Any
-import openai
+from typing import Any, Optional
+
+from .api_call import ApiCaller
+from .async_engine import gather_ordered
+from .dedup import Deduplicator, content_key
+from .image_prep import ImagePreprocessor
+from .provenance import Provenance
+from .response_cache import ResponseCache
+from .structured_output import DIFFERENCE_FORMAT, StructuredChat
+
+
+SYSTEM_PROMPT = (
+    "You are a helpful visual assistant. "
+    "When given two images, you will analyze and describe their differences "
+    "according to categories like object, style, color, motion, 2D & 3D spatial, "
+    "texture, and shape differences. "
+    "If a category has no obvious difference, omit it."
+    "You should answer the question without preamble or additional explanation."
+    "You must output your answer as a single valid JSON object: "
+    "each key is a stringified number ('1','2','3',...) and each value is a string describing one difference. "
+    "Do not include Markdown formatting, code blocks, or any explanation outside the JSON. "
+    "Ensure the JSON is valid and parsable."
+)
+USER_PROMPT = (
+    "I have two similar images: the first is the source image, the second is the target image. "
+    "Please describe the differences between them as defiend format requirments. "
+    "providing one paragraph per category, numbered sequentially. "
+    "Each paragraph should be a single sentence starting with “<sequence number>: There is a difference at <category>, …”."
+)
 
 
 class DifferenceDescriptionGenerator:
-    def __init__(self, api_key: str, model: str = "gpt-4o") -> None:
-        """Initialize the generator with the OpenAI API key and model."""
-        openai.api_key = api_key
+    def __init__(self, api_key: str, model: str = "gpt-4o", cache: Optional[ResponseCache] = None, caller: Optional[ApiCaller] = None, images: Optional[ImagePreprocessor] = None, response_format: str = "json_schema", dedup: Optional[Deduplicator] = None) -> None:
+        """Initialize the generator with the OpenAI API key, model and optional response cache, shared caller, image preprocessor or deduplicator."""
+        # A caller shared with other generators also shares their rate budget
+        self.caller = caller if caller is not None else ApiCaller.from_api_key(api_key, cache=cache)
         self.model = model
+        # Structured answers: schema-constrained output, local repair and one retry
+        self.structured = StructuredChat(self.caller, DIFFERENCE_FORMAT, response_format)
+        # Downscaling / re-encoding of the images before upload (by default only the MIME type is fixed)
+        self.images = images if images is not None else ImagePreprocessor()
+        # Identical image pairs are described once per run
+        self.dedup = dedup if dedup is not None else Deduplicator()
+        # Hash of model, prompt and upload settings behind each difference record
+        self.provenance = Provenance("difference", model=model, prompt=[SYSTEM_PROMPT, USER_PROMPT], response_format=self.structured.request_format(), images=self.images.settings())
 
     def _encode_image_path(self, image_path: str) -> str:
         """Read and base64 encode an image from disk."""
         with open(image_path, "rb") as file:
             return base64.b64encode(file.read()).decode("utf-8")
         
-    def _encode_image_bytes(self, img_data: Any) -> str:
-        """Extract bytes from Parquet cell (dict with 'bytes') and base64 encode."""
-        if isinstance(img_data, dict) and "bytes" in img_data:
-            return base64.b64encode(img_data["bytes"]).decode("utf-8")
-        elif isinstance(img_data, (bytes, bytearray)):
-            return base64.b64encode(img_data).decode("utf-8")
-        else:
-            raise TypeError("Unsupported image data format in Parquet")
-
-    def describe_difference(self, source_img: Any, target_img: Any) -> str:
-        """Call the API to describe differences between two images."""
-        source_b64 = self._encode_image_bytes(source_img)
-        target_b64 = self._encode_image_bytes(target_img)
+    def _build_messages(self, source_img: Any, target_img: Any) -> List[dict]:
+        """Build the chat messages comparing the source and target images."""
+        with self.caller.metrics.span("encode"):
+            source_url = self.images.image_url(source_img)
+            target_url = self.images.image_url(target_img)
 
         messages = [
             {
                 "role": "system",
-                "content": (
-                    "You are a helpful visual assistant. "
-                    "When given two images, you will analyze and describe their differences "
-                    "according to categories like object, style, color, motion, 2D & 3D spatial, "
-                    "texture, and shape differences. "
-                    "If a category has no obvious difference, omit it."   
-                    "You should answer the question without preamble or additional explanation."
-                    "You must output your answer as a single valid JSON object: "
-                    "each key is a stringified number ('1','2','3',...) and each value is a string describing one difference. "
-                    "Do not include Markdown formatting, code blocks, or any explanation outside the JSON. "
-                    "Ensure the JSON is valid and parsable."
-                ),
+                "content": SYSTEM_PROMPT,
             },
             {
                 "role": "user",
                 "content": [
                     {
                         "type": "text",
-                        "text": (
-                            "I have two similar images: the first is the source image, the second is the target image. "
-                            "Please describe the differences between them as defiend format requirments. "
-                            "providing one paragraph per category, numbered sequentially. "
-                            "Each paragraph should be a single sentence starting with “<sequence number>: There is a difference at <category>, …”."
-                        ),
+                        "text": USER_PROMPT,
                     },
                     {
                         "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/jpeg;base64,{source_b64}"
-                        },
+                        "image_url": source_url,
                     },
                     {
                         "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/jpeg;base64,{target_b64}"
-                        },
+                        "image_url": target_url,
                     },
                 ],
             },
         ]
+        return messages
+
+    def describe_difference(self, source_img: Any, target_img: Any) -> str:
+        """Call the API to describe differences between two images."""
+        return self.dedup.run(
+            content_key("difference", source_img, target_img),
+            lambda: self._describe(source_img, target_img),
+            bypass=self.caller.batch_collector is not None,
+        )
+
+    def _describe(self, source_img: Any, target_img: Any) -> str:
+        messages = self._build_messages(source_img, target_img)
 
         # # Old version openai API call
         # response = openai.ChatCompletion.create(
@@ -80,12 +100,20 @@ class DifferenceDescriptionGenerator:
         # )
         # return response.choices[0].message.content
     
-        # New version of openai API call
-        response = openai.chat.completions.create(
-            model=self.model,
-            messages=messages,
+        # New version of openai API call (served from the response cache when possible)
+        return self.structured.chat(self.model, messages)
+
+    async def adescribe_difference(self, source_img: Any, target_img: Any) -> str:
+        """Async version of describe_difference using the AsyncOpenAI client."""
+        async def call() -> str:
+            messages = self._build_messages(source_img, target_img)
+            return await self.structured.achat(self.model, messages)
+
+        return await self.dedup.arun(
+            content_key("difference", source_img, target_img),
+            call,
+            bypass=self.caller.batch_collector is not None,
         )
-        return response.choices[0].message.content
 
     def process_batch(self, source_images: List[str], target_images: List[str]) -> List[str]:
         """Process lists of images and return a list of JSON difference descriptions."""
@@ -96,3 +124,16 @@ class DifferenceDescriptionGenerator:
         for src, tgt in zip(source_images, target_images):
             results.append(self.describe_difference(src, tgt))
         return results
+
+    async def aprocess_batch(
+        self, source_images: List[Any], target_images: List[Any], concurrency: int = 8
+    ) -> List[str]:
+        """Process image pairs concurrently, keeping results in input order."""
+        if len(source_images) != len(target_images):
+            raise ValueError("source_paths and target_paths must have the same length")
+
+        return await gather_ordered(
+            lambda pair: self.adescribe_difference(*pair),
+            list(zip(source_images, target_images)),
+            concurrency,
+        )
@@ -1,74 +1,106 @@
 import base64
 import json
 from typing import List, Dict
-from typing import Any
-import openai
+from typing import Any, Optional
+
+from .api_call import ApiCaller
+from .dedup import Deduplicator, content_key
+from .image_prep import ImagePreprocessor
+from .provenance import Provenance
+from .response_cache import ResponseCache
+from .structured_output import EDIT_FORMAT, StructuredChat
+
+
+SYSTEM_PROMPT = (
+    "You are a helpful visual assistant and image editor. "
+    "When provided with a source image context and an ideal difference description, "
+    "you will organize and output the specific editing actions needed to achieve the target image. "
+    "Each action should be concise, use an editing verb, "
+    "and omit any preamble or extra explanation. "
+    "Output must be valid JSON."
+    "The Output should follow the structure that"
+    "each key is a stringified number ('1','2','3',...) and each value is a string describing specific editing action. "
+    "You should answer the question without preamble or additional explanation."
+)
+USER_PROMPT = (
+    "<difference_description>{difference}</difference_description>"
+    "Please list the editing actions one by one in JSON format, numbered sequentially. "
+)
 
 
 class EditInstructionGenerator:
     """Generate editing instructions for an image based on desired differences."""
 
-    def __init__(self, api_key: str, model: str = "gpt-4o") -> None:
-        openai.api_key = api_key
+    def __init__(self, api_key: str, model: str = "gpt-4o", cache: Optional[ResponseCache] = None, caller: Optional[ApiCaller] = None, images: Optional[ImagePreprocessor] = None, response_format: str = "json_schema", dedup: Optional[Deduplicator] = None) -> None:
+        # A caller shared with other generators also shares their rate budget
+        self.caller = caller if caller is not None else ApiCaller.from_api_key(api_key, cache=cache)
         self.model = model
+        # Structured answers: schema-constrained output, local repair and one retry
+        self.structured = StructuredChat(self.caller, EDIT_FORMAT, response_format)
+        # Downscaling / re-encoding of the images before upload (by default only the MIME type is fixed)
+        self.images = images if images is not None else ImagePreprocessor()
+        # The same source image with the same difference is asked about once per run
+        self.dedup = dedup if dedup is not None else Deduplicator()
+        # Hash of model, prompt and upload settings behind each instruction record
+        self.provenance = Provenance("instruction", model=model, prompt=[SYSTEM_PROMPT, USER_PROMPT], response_format=self.structured.request_format(), images=self.images.settings())
 
     def _encode_image(self, image_path: str) -> str:
         """Base64 encode an image from disk."""
         with open(image_path, "rb") as file:
             return base64.b64encode(file.read()).decode("utf-8")
         
-    def _encode_image_bytes(self, img_data: Any) -> str:
-        """Extract bytes from Parquet cell (dict with 'bytes') and base64 encode."""
-        if isinstance(img_data, dict) and "bytes" in img_data:
-            return base64.b64encode(img_data["bytes"]).decode("utf-8")
-        elif isinstance(img_data, (bytes, bytearray)):
-            return base64.b64encode(img_data).decode("utf-8")
-        else:
-            raise TypeError("Unsupported image data format in Parquet")
-
-    def generate_instructions(self, source_img: Any, difference: str) -> str:
-        """Call the API to get editing instructions."""
-        source_b64 = self._encode_image_bytes(source_img)
+    def _build_messages(self, source_img: Any, difference: str) -> List[dict]:
+        """Build the chat messages for the editing-instruction request."""
+        with self.caller.metrics.span("encode"):
+            source_url = self.images.image_url(source_img)
         messages = [
             {
                 "role": "system",
-                "content": (
-                    "You are a helpful visual assistant and image editor. "
-                    "When provided with a source image context and an ideal difference description, "
-                    "you will organize and output the specific editing actions needed to achieve the target image. "
-                    "Each action should be concise, use an editing verb, "
-                    "and omit any preamble or extra explanation. "
-                    "Output must be valid JSON."
-                    "The Output should follow the structure that"
-                    "each key is a stringified number ('1','2','3',...) and each value is a string describing specific editing action. "
-                    "You should answer the question without preamble or additional explanation."
-                ),
+                "content": SYSTEM_PROMPT,
             },
             {
                 "role": "user",
                 "content": [
                     {
                         "type": "text",
-                        "text": (
-                            f"<difference_description>{difference}</difference_description>"
-                            "Please list the editing actions one by one in JSON format, numbered sequentially. " ),
+                        "text": USER_PROMPT.format(difference=difference),
                     },
                     {
                         "type": "image_url",
-                        "image_url": {"url": f"data:image/jpeg;base64,{source_b64}"},
+                        "image_url": source_url,
                     },
                 ],
             },
         ]
+        return messages
+
+    def generate_instructions(self, source_img: Any, difference: str) -> str:
+        """Call the API to get editing instructions."""
+        return self.dedup.run(
+            content_key("instruction", source_img, difference),
+            lambda: self._generate(source_img, difference),
+            bypass=self.caller.batch_collector is not None,
+        )
+
+    def _generate(self, source_img: Any, difference: str) -> str:
+        messages = self._build_messages(source_img, difference)
         # # Old version openai API call
         # response = openai.ChatCompletion.create(model=self.model, messages=messages)
 
-        # New version openai API call
-        response = openai.chat.completions.create(
-            model=self.model,
-            messages=messages,
+        # New version openai API call (served from the response cache when possible)
+        return self.structured.chat(self.model, messages)
+
+    async def agenerate_instructions(self, source_img: Any, difference: str) -> str:
+        """Async version of generate_instructions using the AsyncOpenAI client."""
+        async def call() -> str:
+            messages = self._build_messages(source_img, difference)
+            return await self.structured.achat(self.model, messages)
+
+        return await self.dedup.arun(
+            content_key("instruction", source_img, difference),
+            call,
+            bypass=self.caller.batch_collector is not None,
         )
-        return response.choices[0].message.content
 
     def process_batch(self, records: List[Dict[str, object]]) -> List[str]:
         """Generate instructions for a batch of records."""
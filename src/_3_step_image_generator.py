@@ -1,60 +1,214 @@
 # step_image_editor.py
 
-import os
-import base64
-from pathlib import Path
+import json
 from typing import List, Dict
-from typing import Any
-import openai
+from typing import Any, Optional, Sequence
 import io
-import requests
 from PIL import Image
 
+from .api_call import ApiCaller
+from .dedup import Deduplicator, content_key
+from .image_prep import ImagePreprocessor
+from .provenance import Provenance
+from .response_cache import ResponseCache
+
+
+def chain_steps(edit: Any, max_steps: int = 1) -> List[str]:
+    """The first `max_steps` numbered edit instructions of a stage-2 record, in order ("1", "2", ...).
+
+    A raw-string answer is a single step.
+    """
+    if isinstance(edit, str):
+        return [edit]
+    numbered = sorted((key for key in edit if str(key).isdigit()), key=int)
+    steps = [edit[key] if isinstance(edit[key], str) else json.dumps(edit[key], ensure_ascii=False) for key in numbered[:max_steps]]
+    return steps or [edit.get("1", "")]
+
 
 class StepImageEditor:
-    """Apply only the 'step1' edit instruction to a batch of images using DALL·E Edit."""
+    """Apply the edit instructions of stage 2 to the source images, one step after another, using gpt-image-1 edits.
+
+    By default only step 1 is run. apply_chain() runs several steps, each on
+    the image of the step before. Every intermediate image is keyed by the
+    source image and the edit texts leading to it: records sharing their
+    first steps share those images within the run (dedup), and with a
+    response cache a rerun asking for more steps starts from the images it
+    already has.
+    """
     
     def __init__(
         self,
         api_key: str,
         n: int = 1,
+        cache: Optional[ResponseCache] = None,
+        caller: Optional[ApiCaller] = None,
+        images: Optional[ImagePreprocessor] = None,
+        dedup: Optional[Deduplicator] = None,
     ) -> None:
-        
-        openai.api_key = api_key
+        # A caller shared with other generators also shares their rate budget
+        self.caller = caller if caller is not None else ApiCaller.from_api_key(api_key, cache=cache)
         self.n = n
+        # Decoding / downscaling / re-encoding of the upload, PNG unless configured otherwise.
+        # Give it a process-pool executor to keep the PIL work off the request path
+        self.images = images if images is not None else ImagePreprocessor(image_format="png")
+        # The same edit of the same source image is made once per run (results bounded by bytes)
+        self.dedup = dedup if dedup is not None else Deduplicator()
+        # Hash of model and upload settings behind each step-image record
+        self.provenance = Provenance("step_image", model="gpt-image-1", n=n, images=self.images.settings())
+        # Chain steps asked for, and those served by the response cache from an earlier run
+        self.chain_steps = 0
+        self.prefix_hits = 0
 
-    def ensure_editable_format(self, image_bytes: bytes, img_format: Any) -> io.BytesIO:
-        img = Image.open(io.BytesIO(image_bytes))
-        buffer = io.BytesIO()
-        buffer.name = "image.png"
-        img.save(buffer, format="PNG")
-        buffer.seek(0)
+    def _upload_file(self, encoded: bytes, mime: str) -> io.BytesIO:
+        buffer = io.BytesIO(encoded)
+        # The file extension tells the edit endpoint the image type (PNG, JPEG or WebP)
+        buffer.name = {"image/jpeg": "image.jpg", "image/webp": "image.webp"}.get(mime, "image.png")
         return buffer
-    
+
+    def prefetch(self, source_image: Any, steps: Sequence[Any]) -> None:
+        """Start preparing the upload of an image that is going to be edited soon.
+
+        Nothing is prepared when the first step is served by the prefix cache,
+        the source image is then never uploaded.
+        """
+        if self.caller.cache is not None and self.caller.cache.contains(self._prefix_cache_key(source_image, steps[:1])):
+            return
+        self.images.prefetch(source_image)
+
+    def ensure_editable_format(self, image_bytes: bytes, img_format: Any = None) -> io.BytesIO:
+        with self.caller.metrics.span("encode"):
+            return self._upload_file(*self.images.encode(image_bytes))
+
+    async def aensure_editable_format(self, image_bytes: bytes, img_format: Any = None) -> io.BytesIO:
+        """Async version of ensure_editable_format; the image is prepared in the executor, if any."""
+        with self.caller.metrics.span("encode"):
+            return self._upload_file(*await self.images.aencode(image_bytes))
+
     # if using DALL-E Edit API, we need to create a mask image
-    def create_mask(self, image_bytes: bytes):
-         img = Image.open(io.BytesIO(image_bytes))
-         w, h = img.size
-         mask = Image.new("L", (w, h), 0)
+    def create_mask(self, width: int, height: int):
+         # Built from the known size, the source image is not decoded again
+         mask = Image.new("L", (width, height), 0)
          mask_buffer = io.BytesIO() 
          mask_buffer.name = "mask.png"
          mask.save(mask_buffer, format="PNG")
          mask_buffer.seek(0)
          return mask_buffer  
 
-    def apply_step(self, source_image: Any, edit_text: Any, width: int, height: int, img_format: Any) -> str:
-        
+    def _key(self, source_image: Any, steps: Sequence[Any]) -> str:
+        return content_key("step_image", source_image, str(self.n), *(str(step) for step in steps))
+
+    def _prefix_cache_key(self, source_image: Any, steps: Sequence[Any]) -> str:
+        # The upload settings are part of the key, like the resized image is part of the edit's own cache key
+        return ResponseCache.make_key(
+            {
+                "endpoint": "images.edit.chain",
+                "model": "gpt-image-1",
+                "source": source_image,
+                "steps": [str(step) for step in steps],
+                "n": self.n,
+                "max_side": self.images.max_side,
+                "format": self.images.image_format,
+                "quality": self.images.quality,
+            }
+        )
+
+    def _cached_prefix(self, source_image: Any, steps: Sequence[Any]) -> Optional[bytes]:
+        if self.caller.cache is None:
+            return None
+        image = self.caller.cache.get(self._prefix_cache_key(source_image, steps))
+        if image is not None:
+            self.prefix_hits += 1
+        return image
+
+    def _store_prefix(self, source_image: Any, steps: Sequence[Any], image: bytes) -> None:
+        if self.caller.cache is not None:
+            self.caller.cache.put(self._prefix_cache_key(source_image, steps), image)
+
+    def apply_step(self, source_image: Any, edit_text: Any, width: Optional[int] = None, height: Optional[int] = None, img_format: Any = None) -> bytes:
+        return self.dedup.run(
+            self._key(source_image, [edit_text]),
+            lambda: self._apply_step(source_image, edit_text, img_format),
+            bypass=self.caller.batch_collector is not None,
+        )
+
+    def apply_chain(self, source_image: Any, steps: Sequence[Any]) -> List[bytes]:
+        """Run the edit steps in order, each on the image of the step before; returns the image of every step."""
+        self.chain_steps += len(steps)
+        images = []
+        image = source_image
+        for k in range(1, len(steps) + 1):
+            image = self.dedup.run(
+                self._key(source_image, steps[:k]),
+                lambda image=image, k=k: self._chain_step(source_image, steps[:k], image),
+                bypass=self.caller.batch_collector is not None,
+            )
+            images.append(image)
+        return images
+
+    def _chain_step(self, source_image: Any, prefix: Sequence[Any], image: Any) -> bytes:
+        cached = self._cached_prefix(source_image, prefix)
+        if cached is not None:
+            if len(prefix) == 1:
+                # Cached after prefetch() looked: its conversion would never be used
+                self.images.discard(source_image)
+            return cached
+        edited = self._apply_step(image, prefix[-1])
+        self._store_prefix(source_image, prefix, edited)
+        return edited
+
+    def _apply_step(self, source_image: Any, edit_text: Any, img_format: Any = None) -> bytes:
         image_file = self.ensure_editable_format(source_image, img_format)
 
-        resp = openai.images.edit(
-            model = "gpt-image-1",
-            image=image_file,
-            prompt = edit_text,
+        # The decoded bytes of the first edited image (served from the response cache when possible)
+        image_bytes = self.caller.edit_image(
+            "gpt-image-1",
+            image_file,
+            edit_text,
             n=self.n,
-        ) 
+        )
 
-        image_base64 = resp.data[0].b64_json
-        image_bytes = base64.b64decode(image_base64)
+        return image_bytes
 
+    async def aapply_step(self, source_image: Any, edit_text: Any, width: Optional[int] = None, height: Optional[int] = None, img_format: Any = None) -> bytes:
+        """Async version of apply_step using the AsyncOpenAI client."""
+        return await self.dedup.arun(
+            self._key(source_image, [edit_text]),
+            lambda: self._aapply_step(source_image, edit_text, img_format),
+            bypass=self.caller.batch_collector is not None,
+        )
 
-        return image_bytes
+    async def _aapply_step(self, source_image: Any, edit_text: Any, img_format: Any = None) -> bytes:
+        image_file = await self.aensure_editable_format(source_image, img_format)
+        return await self.caller.aedit_image(
+            "gpt-image-1",
+            image_file,
+            edit_text,
+            n=self.n,
+        )
+
+    async def aapply_chain(self, source_image: Any, steps: Sequence[Any]) -> List[bytes]:
+        """Async version of apply_chain; the steps of one record run in order, different records concurrently."""
+        self.chain_steps += len(steps)
+        images = []
+        image = source_image
+        for k in range(1, len(steps) + 1):
+            image = await self.dedup.arun(
+                self._key(source_image, steps[:k]),
+                lambda image=image, k=k: self._achain_step(source_image, steps[:k], image),
+                bypass=self.caller.batch_collector is not None,
+            )
+            images.append(image)
+        return images
+
+    async def _achain_step(self, source_image: Any, prefix: Sequence[Any], image: Any) -> bytes:
+        cached = self._cached_prefix(source_image, prefix)
+        if cached is not None:
+            if len(prefix) == 1:
+                self.images.discard(source_image)
+            return cached
+        edited = await self._aapply_step(image, prefix[-1])
+        self._store_prefix(source_image, prefix, edited)
+        return edited
+
+    def chain_stats(self) -> Dict[str, int]:
+        return {"steps": self.chain_steps, "prefix_cache_hits": self.prefix_hits}
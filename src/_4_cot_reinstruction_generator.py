@@ -1,8 +1,32 @@
-import base64
 import json
-from typing import List, Dict
-import openai
-from typing import Any
+from typing import List
+from typing import Any, Optional
+
+from .api_call import ApiCaller
+from .dedup import Deduplicator, content_key
+from .image_prep import ImagePreprocessor
+from .provenance import Provenance
+from .response_cache import ResponseCache
+from .structured_output import COT_REEDIT_FORMAT, StructuredChat
+
+
+SYSTEM_PROMPT = (
+    "You are a helpful assistant for visual thinking, design, and editing. "
+    "When given source image (the first image), desired editing instruction in JSON, and the first-step edited image (the second image), "
+    "you will perform two tasks:"
+    "1) Provide a step-by-step chain of thought assessing (a) instruction compliance & subject integrity, "
+    "(b) visual realism (geometry, lighting consistency, physical logic), (c)contextual consistency(e.g., scene-element matching, cross-attribute logic, (d)and ethics/safety. "
+    "!!!Only note unusual issues if not explicitly instructed, concise without preamble."
+    "2) Generate re-editing instructions to refine the first-step result, concise without preamble. "
+    "You should answer the question without preamble or additional explanation."
+    "The Output should follow the structure that"
+    "each keys are a string like 'CoT_1','CoT_2','CoT_3', ... & 'Re_Edit_1', 'Re_Edit_2', ...."
+    "and each value is a string of CoT and re-editing description corresponding to the each keys separately. "
+)
+USER_PROMPT = (
+    "<desired_editing_instruction>{edit_text}</desired_editing_instruction>"
+    "Please output a step-by-step chain of thought and re-editing instructions result as required."
+)
 
 
 class MultiModalAnalysisGenerator:
@@ -11,24 +35,61 @@ class MultiModalAnalysisGenerator:
     def __init__(
         self,
         api_key: str,
-        model: str = "gpt-4o"
+        model: str = "gpt-4o",
+        cache: Optional[ResponseCache] = None,
+        caller: Optional[ApiCaller] = None,
+        images: Optional[ImagePreprocessor] = None,
+        response_format: str = "json_schema",
+        dedup: Optional[Deduplicator] = None,
     ) -> None:
         """
         Args:
             api_key: OpenAI API key.
             model:   Model identifier, e.g., "gpt-4o".
+            cache:   Optional on-disk response cache shared across runs.
+            caller:  Optional ApiCaller shared with other generators (cache, rate limits, retries).
+            images:  Optional ImagePreprocessor (downscaling, re-encoding, resize cache).
+            response_format: "json_schema", "json_object" or "none" (prompt-only JSON).
+            dedup:   Optional Deduplicator; identical (step image, source image, edit) jobs are analysed once.
         """
-        openai.api_key = api_key
+        # A caller shared with other generators also shares their rate budget
+        self.caller = caller if caller is not None else ApiCaller.from_api_key(api_key, cache=cache)
         self.model = model
+        # Structured answers: schema-constrained output, local repair and one retry
+        self.structured = StructuredChat(self.caller, COT_REEDIT_FORMAT, response_format)
+        self.images = images if images is not None else ImagePreprocessor()
+        self.dedup = dedup if dedup is not None else Deduplicator()
+        # Hash of model, prompt and upload settings behind each analysis record
+        self.provenance = Provenance("analysis", model=model, prompt=[SYSTEM_PROMPT, USER_PROMPT], response_format=self.structured.request_format(), images=self.images.settings())
+
+    def _key(self, step_image: Any, source_image: Any, edit_text: Any) -> str:
+        if not isinstance(edit_text, str):
+            edit_text = json.dumps(edit_text, ensure_ascii=False, sort_keys=True)
+        return content_key("analysis", step_image, source_image, edit_text)
+
+    def _build_messages(self, step_image: Any, source_image: Any, edit_text: Any) -> List[dict]:
+        """Build the chat messages for the CoT / re-editing request."""
+        # Prepare the images as data URLs (downscaled and re-encoded as configured)
+        with self.caller.metrics.span("encode"):
+            step_image_url = self.images.image_url(step_image)
+            source_image_url = self.images.image_url(source_image)
+
+
+        # Construct messages
+        user_text = USER_PROMPT.format(edit_text=edit_text)
 
-    def _encode_image_bytes(self, img_data: Any) -> str:
-        """Extract bytes from Parquet cell (dict with 'bytes') and base64 encode."""
-        if isinstance(img_data, dict) and "bytes" in img_data:
-            return base64.b64encode(img_data["bytes"]).decode("utf-8")
-        elif isinstance(img_data, (bytes, bytearray)):
-            return base64.b64encode(img_data).decode("utf-8")
-        else:
-            raise TypeError("Unsupported image data format in Parquet")
+        messages = [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": user_text},
+                    {"type": "image_url", "image_url": source_image_url},
+                    {"type": "image_url", "image_url": step_image_url}
+                ],
+            },
+        ]
+        return messages
 
     def generate(
         self,
@@ -49,45 +110,21 @@ class MultiModalAnalysisGenerator:
         Returns:
             A JSON-formatted string from the API containing analysis and re-edit instructions.
         """
-        # Prepare Base64 images
-        step_image_b64 = self._encode_image_bytes(step_image)
-        source_image_b64 = self._encode_image_bytes(source_image)
-
-
-        # Construct messages
-        system_prompt = (
-            "You are a helpful assistant for visual thinking, design, and editing. "
-            "When given source image (the first image), desired editing instruction in JSON, and the first-step edited image (the second image), "
-            "you will perform two tasks:"
-            "1) Provide a step-by-step chain of thought assessing (a) instruction compliance & subject integrity, "
-            "(b) visual realism (geometry, lighting consistency, physical logic), (c)contextual consistency(e.g., scene-element matching, cross-attribute logic, (d)and ethics/safety. "
-            "!!!Only note unusual issues if not explicitly instructed, concise without preamble."
-            "2) Generate re-editing instructions to refine the first-step result, concise without preamble. "
-            "You should answer the question without preamble or additional explanation."
-            "The Output should follow the structure that"
-            "each keys are a string like 'CoT_1','CoT_2','CoT_3', ... & 'Re_Edit_1', 'Re_Edit_2', ...."
-            "and each value is a string of CoT and re-editing description corresponding to the each keys separately. "
-        )
-        user_text = (
-            f"<desired_editing_instruction>{edit_text}</desired_editing_instruction>"
-            "Please output a step-by-step chain of thought and re-editing instructions result as required."
+        return self.dedup.run(
+            self._key(step_image, source_image, edit_text),
+            lambda: self.structured.chat(self.model, self._build_messages(step_image, source_image, edit_text)),
+            bypass=self.caller.batch_collector is not None,
         )
 
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": user_text},
-                    {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{source_image_b64}"}},
-                    {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{step_image_b64}"}}
-                ],
-            },
-        ]
+    async def agenerate(self, step_image: Any, source_image: Any, edit_text: Any) -> str:
+        """Async version of generate using the AsyncOpenAI client."""
+        async def call() -> str:
+            messages = self._build_messages(step_image, source_image, edit_text)
+            return await self.structured.achat(self.model, messages)
 
-        response = openai.chat.completions.create(
-            model=self.model,
-            messages=messages
+        return await self.dedup.arun(
+            self._key(step_image, source_image, edit_text),
+            call,
+            bypass=self.caller.batch_collector is not None,
         )
-        return response.choices[0].message.content
 
@@ -0,0 +1,376 @@
+import asyncio
+import base64
+import inspect
+import io
+import time
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Dict, List, Optional
+
+import openai
+
+from .budget import Budget, Estimate, image_output_tokens
+from .hedging import HedgePolicy
+from .http_client import OpenAIClients
+from .key_pool import AUTH_ERRORS, SERVER_ERRORS, KeyPool, PooledKey
+from .metrics import Metrics, payload_bytes
+from .rate_limiter import (
+    RETRYABLE_ERRORS,
+    RateLimiter,
+    RateLimits,
+    backoff_delay,
+    estimate_chat_tokens,
+    image_size,
+    retry_after_seconds,
+    vision_tokens,
+)
+from .response_cache import ResponseCache
+
+if TYPE_CHECKING:
+    from .batch_mode import BatchCollector
+
+
+# gpt-image-1 has no per-request token estimate before the call, use a flat one
+IMAGE_EDIT_TOKENS_ESTIMATE = 1500
+
+
+class ApiCaller:
+    """Shared call path of the four generators.
+
+    Wraps the chat-completion and image-edit requests (sync and async, through
+    the pooled clients of the keys in a KeyPool) so that the response cache,
+    the per-key and per-model rate limiters and the retry policy apply to
+    every stage in the same way. One caller can be shared by several
+    generators so that they draw on the same rate budget. Every attempt and
+    every cached answer is recorded in `metrics`. With a `budget`, every
+    request that is actually sent is estimated, reserved and settled
+    against its response.usage first. With a `hedge` policy, async requests
+    slower than usual are duplicated and the first answer is kept.
+    """
+
+    def __init__(
+        self,
+        keys: KeyPool,
+        cache: Optional[ResponseCache] = None,
+        max_retries: int = 6,
+        metrics: Optional[Metrics] = None,
+        budget: Optional[Budget] = None,
+        hedge: Optional[HedgePolicy] = None,
+    ) -> None:
+        self.keys = keys
+        self.cache = cache
+        self.max_retries = max_retries
+        self.metrics = metrics if metrics is not None else Metrics("api")
+        self.budget = budget
+        self.hedge = hedge
+        # Batch mode: while a collector is set, chat requests are recorded instead of
+        # sent; answers downloaded from the Batch API are then served from `prefilled`
+        self.batch_collector: Optional["BatchCollector"] = None
+        self.prefilled: Dict[str, str] = {}
+
+    @classmethod
+    def from_api_key(
+        cls,
+        api_key: str,
+        cache: Optional[ResponseCache] = None,
+        rate_limits: Optional[RateLimits] = None,
+        max_retries: int = 6,
+        metrics: Optional[Metrics] = None,
+        clients: Optional[OpenAIClients] = None,
+        budget: Optional[Budget] = None,
+        hedge: Optional[HedgePolicy] = None,
+    ) -> "ApiCaller":
+        """A caller of a single key, with its own default-configured clients unless shared `clients` are given."""
+        return cls(
+            KeyPool.single(clients if clients is not None else OpenAIClients(api_key), rate_limits),
+            cache=cache,
+            max_retries=max_retries,
+            metrics=metrics,
+            budget=budget,
+            hedge=hedge,
+        )
+
+    def _chat_key(self, model: str, messages: List[dict], params: dict) -> Optional[str]:
+        if self.cache is None and self.batch_collector is None and not self.prefilled:
+            return None
+        return ResponseCache.make_key(
+            {"endpoint": "chat.completions", "model": model, "messages": messages, "params": params}
+        )
+
+    def _lookup_chat(self, key: Optional[str], model: str) -> Optional[str]:
+        """Answer a chat request from the batch results or the cache, if possible."""
+        if key is None:
+            return None
+        if key in self.prefilled:
+            self.metrics.record_cached("chat.completions", model)
+            return self.prefilled[key]
+        if self.cache is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                self.metrics.record_cached("chat.completions", model)
+                return cached.decode("utf-8")
+        return None
+
+    def _collect_chat(self, key: str, model: str, messages: List[dict], params: dict) -> str:
+        """Record the request for the Batch API; the answer is filled in by the merge pass."""
+        self.batch_collector.add(key, {"model": model, "messages": messages, **params})
+        return ""
+
+    def _image_key(self, model: str, image_file: io.BytesIO, prompt: str, params: dict) -> Optional[str]:
+        if self.cache is None:
+            return None
+        return self.cache.make_key(
+            {
+                "endpoint": "images.edit",
+                "model": model,
+                "image": image_file.getbuffer(),
+                "prompt": prompt,
+                "params": params,
+            }
+        )
+
+    def _on_error(self, key: PooledKey, limiter: RateLimiter, exc: Exception, attempt: int) -> float:
+        """Seconds to wait before retrying a failed attempt (0 to retry on another key at once); raises when giving up."""
+        if isinstance(exc, AUTH_ERRORS) and len(self.keys.keys) > 1:
+            self.keys.on_auth_error(key)
+            if not self.keys.available() or attempt == self.max_retries:
+                raise exc
+            return 0.0
+        if not isinstance(exc, RETRYABLE_ERRORS):
+            raise exc
+        retry_after = retry_after_seconds(exc)
+        rate_limited = isinstance(exc, openai.RateLimitError)
+        if rate_limited:
+            limiter.on_rate_limited(retry_after)
+            self.keys.on_rate_limited(key, retry_after)
+        server_error = isinstance(exc, SERVER_ERRORS)
+        if server_error:
+            self.keys.on_server_error(key)
+        if attempt == self.max_retries:
+            raise exc
+        limiter.retries += 1
+        if rate_limited and self.keys.available():
+            # Another key still has room
+            return 0.0
+        if server_error and self.keys.healthy(exclude=key):
+            # Another key's endpoint is answering
+            return 0.0
+        return backoff_delay(attempt, retry_after=retry_after)
+
+    def _request(self, endpoint: str, model: str, tokens: int, payload: int, send: Callable[[OpenAIClients], Any]) -> Any:
+        """Send a request with a key of the pool through its rate limiter, retrying retryable errors."""
+        failed = None
+        for attempt in range(self.max_retries + 1):
+            # A retry goes to another key than the one that just failed, if there is one
+            key, wait = self.keys.pick(model, avoid=failed)
+            if wait > 0:
+                time.sleep(wait)
+            limiter = key.rate_limits.get(model)
+            limiter.acquire_blocking(tokens)
+            key.requests += 1
+            started = time.perf_counter()
+            try:
+                raw = send(key.clients)
+            except Exception as exc:
+                self.metrics.record_request(endpoint, model, time.perf_counter() - started, payload, error=exc)
+                failed = key
+                time.sleep(self._on_error(key, limiter, exc, attempt))
+                continue
+            self.keys.on_success(key)
+            self._on_response(limiter, raw.headers)
+            response = raw.parse()
+            self._reconcile(limiter, tokens, response)
+            self.metrics.record_request(endpoint, model, time.perf_counter() - started, payload, usage=getattr(response, "usage", None))
+            return response
+
+    async def _arequest(self, endpoint: str, model: str, tokens: int, payload: int, send: Callable[[OpenAIClients], Awaitable[Any]]) -> Any:
+        """Async version of _request."""
+        failed = None
+        for attempt in range(self.max_retries + 1):
+            key, wait = self.keys.pick(model, avoid=failed)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            limiter = key.rate_limits.get(model)
+            await limiter.acquire(tokens)
+            key.requests += 1
+            started = time.perf_counter()
+            try:
+                raw = await send(key.clients)
+            except Exception as exc:
+                self.metrics.record_request(endpoint, model, time.perf_counter() - started, payload, error=exc)
+                failed = key
+                await asyncio.sleep(self._on_error(key, limiter, exc, attempt))
+                continue
+            self.keys.on_success(key)
+            self._on_response(limiter, raw.headers)
+            response = raw.parse()
+            # Depending on the openai version the async raw response parses synchronously or not
+            if inspect.isawaitable(response):
+                response = await response
+            self._reconcile(limiter, tokens, response)
+            self.metrics.record_request(endpoint, model, time.perf_counter() - started, payload, usage=getattr(response, "usage", None))
+            return response
+
+    @staticmethod
+    def _on_response(limiter: RateLimiter, headers: Any) -> None:
+        """Feed the rate-limit headers of a successful response back to the limiter."""
+        limiter.on_headers(headers)
+        limiter.on_success()
+
+    @staticmethod
+    def _reconcile(limiter: RateLimiter, tokens: int, response: Any) -> None:
+        """Correct the limiter's token estimate with the real response.usage."""
+        usage = getattr(response, "usage", None)
+        limiter.reconcile(tokens, getattr(usage, "total_tokens", None))
+
+    def _chat_estimate(self, model: str, tokens: int, params: dict) -> Optional[Estimate]:
+        if self.budget is None:
+            return None
+        return self.budget.estimate_chat(model, tokens, params.get("max_tokens") or params.get("max_completion_tokens"))
+
+    def _edit_estimate(self, model: str, image_file: io.BytesIO, prompt: str, params: dict) -> Optional[Estimate]:
+        if self.budget is None:
+            return None
+        width, height = image_size(image_file.getbuffer()) or (1024, 1024)
+        return self.budget.estimate_edit(
+            model,
+            len(prompt) // 4,
+            vision_tokens(width, height, model=model),
+            image_output_tokens(width, height, params.get("size", "auto"), params.get("quality", "auto")),
+        )
+
+    def _budgeted(self, estimate: Optional[Estimate], send: Callable[[], Any]) -> Any:
+        """Send a request within the budget: reserve its estimate, then settle it with response.usage."""
+        if estimate is None:
+            return send()
+        self.budget.reserve(estimate)
+        try:
+            response = send()
+        except BaseException:
+            self.budget.release(estimate)
+            raise
+        self.budget.settle(estimate, getattr(response, "usage", None))
+        return response
+
+    async def _abudgeted(self, estimate: Optional[Estimate], send: Callable[[], Awaitable[Any]]) -> Any:
+        """Async version of _budgeted."""
+        if estimate is None:
+            return await send()
+        await self.budget.areserve(estimate)
+        try:
+            response = await send()
+        except BaseException:
+            self.budget.release(estimate)
+            raise
+        self.budget.settle(estimate, getattr(response, "usage", None))
+        return response
+
+    async def _ahedged(self, endpoint: str, model: str, tokens: int, estimate: Optional[Estimate], send: Callable[[], Awaitable[Any]]) -> Any:
+        """Send a request through the hedge policy, if any; a duplicate is paid out of the budget."""
+        if self.hedge is None:
+            return await send()
+        on_hedge = None if estimate is None else (lambda: self.budget.charge_duplicate(estimate))
+        return await self.hedge.run((endpoint, model), send, tokens, on_hedge=on_hedge)
+
+    def chat(self, model: str, messages: List[dict], refresh: bool = False, **params: Any) -> str:
+        """Return the message content of a chat completion.
+
+        With refresh=True the request is sent even if an answer is cached, and replaces it.
+        """
+        key = self._chat_key(model, messages, params)
+        answer = None if refresh else self._lookup_chat(key, model)
+        if answer is not None:
+            return answer
+        tokens = estimate_chat_tokens(messages, model)
+        estimate = self._chat_estimate(model, tokens, params)
+        if self.batch_collector is not None:
+            if estimate is not None:
+                # Batch requests are paid when collected, at the Batch API discount
+                self.budget.charge(estimate)
+            return self._collect_chat(key, model, messages, params)
+
+        response = self._budgeted(estimate, lambda: self._request(
+            "chat.completions",
+            model,
+            tokens,
+            payload_bytes(messages),
+            lambda clients: clients.chat_client.chat.completions.with_raw_response.create(model=model, messages=messages, **params),
+        ))
+        content = response.choices[0].message.content
+        if self.cache is not None and content is not None:
+            self.cache.put(key, content.encode("utf-8"))
+        return content
+
+    async def achat(self, model: str, messages: List[dict], refresh: bool = False, **params: Any) -> str:
+        """Async version of chat using the AsyncOpenAI client."""
+        key = self._chat_key(model, messages, params)
+        answer = None if refresh else self._lookup_chat(key, model)
+        if answer is not None:
+            return answer
+        tokens = estimate_chat_tokens(messages, model)
+        estimate = self._chat_estimate(model, tokens, params)
+        if self.batch_collector is not None:
+            if estimate is not None:
+                self.budget.charge(estimate)
+            return self._collect_chat(key, model, messages, params)
+
+        response = await self._abudgeted(estimate, lambda: self._ahedged("chat.completions", model, tokens, estimate, lambda: self._arequest(
+            "chat.completions",
+            model,
+            tokens,
+            payload_bytes(messages),
+            lambda clients: clients.async_chat_client.chat.completions.with_raw_response.create(model=model, messages=messages, **params),
+        )))
+        content = response.choices[0].message.content
+        if self.cache is not None and content is not None:
+            self.cache.put(key, content.encode("utf-8"))
+        return content
+
+    def edit_image(self, model: str, image_file: io.BytesIO, prompt: str, **params: Any) -> bytes:
+        """Return the bytes of the first image produced by an image edit."""
+        key = self._image_key(model, image_file, prompt, params)
+        if key is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                self.metrics.record_cached("images.edit", model)
+                return cached
+
+        def send(clients: OpenAIClients) -> Any:
+            # A retried upload must start from the beginning of the file again
+            image_file.seek(0)
+            return clients.image_client.images.with_raw_response.edit(model=model, image=image_file, prompt=prompt, **params)
+
+        resp = self._budgeted(
+            self._edit_estimate(model, image_file, prompt, params),
+            lambda: self._request("images.edit", model, IMAGE_EDIT_TOKENS_ESTIMATE, image_file.getbuffer().nbytes + len(prompt), send),
+        )
+        image_bytes = base64.b64decode(resp.data[0].b64_json)
+        if key is not None:
+            self.cache.put(key, image_bytes)
+        return image_bytes
+
+    async def aedit_image(self, model: str, image_file: io.BytesIO, prompt: str, **params: Any) -> bytes:
+        """Async version of edit_image using the AsyncOpenAI client."""
+        key = self._image_key(model, image_file, prompt, params)
+        if key is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                self.metrics.record_cached("images.edit", model)
+                return cached
+
+        def send(clients: OpenAIClients) -> Awaitable[Any]:
+            # Every attempt uploads its own copy: a hedge in flight at the same time must not share the file position
+            upload = io.BytesIO(image_file.getvalue())
+            upload.name = getattr(image_file, "name", "image.png")
+            return clients.async_image_client.images.with_raw_response.edit(model=model, image=upload, prompt=prompt, **params)
+
+        estimate = self._edit_estimate(model, image_file, prompt, params)
+        resp = await self._abudgeted(estimate, lambda: self._ahedged(
+            "images.edit",
+            model,
+            IMAGE_EDIT_TOKENS_ESTIMATE,
+            estimate,
+            lambda: self._arequest("images.edit", model, IMAGE_EDIT_TOKENS_ESTIMATE, image_file.getbuffer().nbytes + len(prompt), send),
+        ))
+        image_bytes = base64.b64decode(resp.data[0].b64_json)
+        if key is not None:
+            self.cache.put(key, image_bytes)
+        return image_bytes
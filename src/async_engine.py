@@ -0,0 +1,88 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Iterable, List, Optional, Tuple, Type
+
+
+async def gather_ordered(
+    func: Callable[[Any], Awaitable[Any]],
+    items: Iterable[Any],
+    concurrency: int,
+    on_result: Optional[Callable[[int, Any], None]] = None,
+    stop_on: Tuple[Type[BaseException], ...] = (),
+) -> List[Any]:
+    """Run func over items with at most `concurrency` calls in flight.
+
+    Results are returned in the same order as the input items, so the rows
+    written to the .jsonal files keep the parquet row order.
+
+    If on_result is given it is called as on_result(index, result) in input
+    order, as soon as a result and all results before it are available. This
+    lets callers persist finished rows while later ones are still running.
+
+    An exception of a type in stop_on (a refused budget) does not cancel the
+    calls in flight, whose requests are already paid for: no further item is
+    started, the running ones are let finish, every result before the first
+    item without one still goes to on_result, and then the exception is raised.
+    """
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    stopped: List[BaseException] = []
+
+    async def _run(item: Any) -> Any:
+        async with semaphore:
+            if stopped:
+                raise stopped[0]
+            try:
+                return await func(item)
+            except stop_on as exc:
+                stopped.append(exc)
+                raise
+
+    if on_result is None:
+        return await asyncio.gather(*(_run(item) for item in items))
+
+    tasks = [asyncio.ensure_future(_run(item)) for item in items]
+    results = []
+    try:
+        for index, task in enumerate(tasks):
+            try:
+                result = await task
+            except stop_on:
+                await asyncio.gather(*tasks, return_exceptions=True)
+                raise
+            on_result(index, result)
+            results.append(result)
+    finally:
+        # On failure or interruption, stop the requests that are still pending
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    return results
+
+
+class AsyncRunner:
+    """Own a single event loop for the whole run.
+
+    The AsyncOpenAI clients keep their connection pool bound to the loop they
+    were first used on, so every shard is driven through the same loop instead
+    of calling asyncio.run() repeatedly.
+    """
+
+    def __init__(self) -> None:
+        self.loop = asyncio.new_event_loop()
+
+    def run(self, coro: Awaitable[Any]) -> Any:
+        return self.loop.run_until_complete(coro)
+
+    def map_ordered(
+        self,
+        func: Callable[[Any], Awaitable[Any]],
+        items: Iterable[Any],
+        concurrency: int,
+        on_result: Optional[Callable[[int, Any], None]] = None,
+        stop_on: Tuple[Type[BaseException], ...] = (),
+    ) -> List[Any]:
+        """Blocking helper: run func over items concurrently, results in input order."""
+        return self.run(gather_ordered(func, items, concurrency, on_result, stop_on))
+
+    def close(self) -> None:
+        self.loop.run_until_complete(self.loop.shutdown_asyncgens())
+        self.loop.close()
@@ -0,0 +1,219 @@
+import json
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Set
+
+import openai
+
+from .checkpoint import RowId
+from .parquet_output import stage_done_provenance, stage_done_rows
+
+
+# Limits of a single Batch API input file
+MAX_REQUESTS_PER_FILE = 50000
+MAX_BYTES_PER_FILE = 190 * 1024 * 1024
+
+TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+class BatchCollector:
+    """Write /v1/chat/completions requests into Batch API input files instead of sending them.
+
+    The custom_id of a request is its content hash, so identical requests of
+    a shard are submitted only once. Files roll over before they reach the
+    Batch API size or request-count limits.
+    """
+
+    def __init__(self, work_dir: Path, prefix: str, endpoint: str = "/v1/chat/completions") -> None:
+        self.work_dir = work_dir
+        self.prefix = prefix
+        self.endpoint = endpoint
+        self.files: List[Path] = []
+        self.custom_ids: Set[str] = set()
+        self._file = None
+        self._requests = 0
+        self._bytes = 0
+
+    def add(self, custom_id: str, body: Dict[str, Any]) -> None:
+        if custom_id in self.custom_ids:
+            return
+        self.custom_ids.add(custom_id)
+        line = (json.dumps(
+            {"custom_id": custom_id, "method": "POST", "url": self.endpoint, "body": body},
+            ensure_ascii=False,
+        ) + "\n").encode("utf-8")
+        if (
+            self._file is None
+            or self._requests >= MAX_REQUESTS_PER_FILE
+            or self._bytes + len(line) > MAX_BYTES_PER_FILE
+        ):
+            self._roll_over()
+        self._file.write(line)
+        self._requests += 1
+        self._bytes += len(line)
+
+    def _roll_over(self) -> None:
+        if self._file is not None:
+            self._file.close()
+        path = self.work_dir / f"{self.prefix}.batch_input_{len(self.files)}.jsonl"
+        self.files.append(path)
+        self._file = path.open("wb")
+        self._requests = 0
+        self._bytes = 0
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class BatchJob:
+    """Submit Batch API input files, poll them and gather the answers by custom_id.
+
+    The ids of the submitted batches are kept in a small state file so that a
+    restarted run waits for the batches it already paid for instead of
+    submitting them again.
+    """
+
+    def __init__(self, state_path: Path, client: "openai.OpenAI", poll_interval: float = 30.0) -> None:
+        self.state_path = state_path
+        self.client = client
+        self.poll_interval = poll_interval
+        self.state: Dict[str, Any] = {"batches": []}
+        if state_path.exists():
+            self.state = json.loads(state_path.read_text(encoding="utf-8"))
+
+    @property
+    def submitted(self) -> bool:
+        return bool(self.state["batches"])
+
+    def _save(self) -> None:
+        tmp_path = self.state_path.with_name(self.state_path.name + ".tmp")
+        tmp_path.write_text(json.dumps(self.state, indent=2), encoding="utf-8")
+        tmp_path.replace(self.state_path)
+
+    def submit(self, input_files: List[Path], endpoint: str = "/v1/chat/completions") -> None:
+        for path in input_files:
+            with path.open("rb") as f:
+                uploaded = self.client.files.create(file=f, purpose="batch")
+            batch = self.client.batches.create(
+                input_file_id=uploaded.id,
+                endpoint=endpoint,
+                completion_window="24h",
+            )
+            print(f"Submitted batch {batch.id} with {path.name}\n")
+            self.state["batches"].append({"id": batch.id, "input_file": str(path)})
+            # Saved after every submission, so a crash never submits a file twice
+            self._save()
+
+    def wait(self) -> List[Any]:
+        """Poll every batch until it reaches a terminal status."""
+        finished = {}
+        while len(finished) < len(self.state["batches"]):
+            for entry in self.state["batches"]:
+                if entry["id"] in finished:
+                    continue
+                batch = self.client.batches.retrieve(entry["id"])
+                counts = batch.request_counts
+                print(
+                    f"Batch {batch.id}: {batch.status}"
+                    + (f" ({counts.completed}/{counts.total} done, {counts.failed} failed)" if counts else "")
+                )
+                if batch.status in TERMINAL_STATUSES:
+                    finished[batch.id] = batch
+            if len(finished) < len(self.state["batches"]):
+                time.sleep(self.poll_interval)
+        return list(finished.values())
+
+    def results(self) -> Dict[str, str]:
+        """Wait for the batches and return the message content of every successful request."""
+        answers: Dict[str, str] = {}
+        failed = 0
+        for batch in self.wait():
+            if not batch.output_file_id:
+                continue
+            content = self.client.files.content(batch.output_file_id)
+            for line in content.text.splitlines():
+                if not line.strip():
+                    continue
+                item = json.loads(line)
+                response = item.get("response") or {}
+                if item.get("error") or response.get("status_code") != 200:
+                    failed += 1
+                    continue
+                answers[item["custom_id"]] = response["body"]["choices"][0]["message"]["content"]
+        print(f"Batch results: {len(answers)} answered, {failed} failed\n")
+        return answers
+
+    def cleanup(self) -> None:
+        """Remove the state and the input files once the results are merged."""
+        for entry in self.state["batches"]:
+            Path(entry["input_file"]).unlink(missing_ok=True)
+        self.state_path.unlink(missing_ok=True)
+
+
+class CollectingWriter:
+    """Stand-in for CheckpointWriter during the collection pass.
+
+    It knows which rows are already finished, so they are not submitted
+    again, but writes nothing. With --incremental the existing rows are in
+    `previous` and only count as finished once keep() accepts them.
+    """
+
+    def __init__(self, done: Optional[Set[RowId]] = None, previous: Optional[Dict[RowId, Optional[str]]] = None) -> None:
+        self.done = done or set()
+        self.previous = previous or {}
+
+    def is_done(self, row: RowId) -> bool:
+        return row in self.done
+
+    def keep(self, row: RowId, provenance: str) -> bool:
+        if row in self.previous and self.previous[row] == provenance:
+            self.done.add(row)
+        return row in self.done
+
+    def write(self, record: Dict[str, Any], row: Optional[RowId] = None) -> None:
+        pass
+
+
+def prepare_batch_answers(
+    caller: Any,
+    output_path: Path,
+    collect: Callable[[CollectingWriter], None],
+    resume: bool = False,
+    poll_interval: float = 30.0,
+    provenance_field: Optional[str] = None,
+) -> BatchJob:
+    """Run the Batch API round trip of one shard and load the answers into caller.prefilled.
+
+    `collect` runs the stage's normal shard loop once with the caller in
+    collection mode, which records every pending request instead of sending
+    it. The requests are submitted, polled and downloaded; the stage's loop
+    then runs a second time and is served from the downloaded answers. Rows
+    the batch could not answer fall back to a normal online request there.
+    """
+    job = BatchJob(output_path.with_name(f"{output_path.stem}.batch.json"), caller.keys.primary.clients.chat_client, poll_interval)
+    if not job.submitted:
+        done = stage_done_rows(output_path) if resume and output_path.exists() and not provenance_field else set()
+        previous = stage_done_provenance(output_path, provenance_field) if provenance_field and output_path.exists() else {}
+        collector = BatchCollector(output_path.parent, output_path.stem)
+        caller.batch_collector = collector
+        try:
+            collect(CollectingWriter(done, previous))
+        finally:
+            caller.batch_collector = None
+            collector.close()
+        if not collector.custom_ids:
+            return job
+        print(f"Collected {len(collector.custom_ids)} requests for the Batch API\n")
+        job.submit(collector.files)
+    else:
+        print(f"Waiting for the batches already submitted in {job.state_path}\n")
+    caller.prefilled = job.results()
+    return job
+
+
+def finish_batch_answers(caller: Any, job: BatchJob) -> None:
+    """Drop the answers of a merged shard and remove its batch files."""
+    caller.prefilled = {}
+    job.cleanup()
@@ -0,0 +1,82 @@
+import base64
+import mmap
+import os
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+
+class BlobWriter:
+    """Append-only binary sidecar holding the step-edited images of one shard.
+
+    The stage-3 record only keeps a small reference
+    {"blob": <file name>, "offset": ..., "length": ...} instead of the
+    base64 image, so the .jsonal lines stay small and cheap to parse.
+    """
+
+    def __init__(self, blob_path: Path, resume: bool = False) -> None:
+        self.blob_path = blob_path
+        # On resume, bytes written after the last finished record are simply left unused
+        self.file = blob_path.open("ab" if resume else "wb")
+        self.offset = self.file.seek(0, os.SEEK_END)
+
+    def append(self, data: bytes) -> Dict[str, Any]:
+        """Write data durably and return the reference stored in the record."""
+        offset = self.offset
+        self.file.write(data)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.offset += len(data)
+        return {"blob": self.blob_path.name, "offset": offset, "length": len(data)}
+
+    def close(self) -> None:
+        self.file.close()
+
+    def __enter__(self) -> "BlobWriter":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.close()
+
+
+class BlobReader:
+    """Read images back from the sidecars of a stage-3 output directory via mmap."""
+
+    def __init__(self, blob_dir: Path) -> None:
+        self.blob_dir = blob_dir
+        self._maps: Dict[str, mmap.mmap] = {}
+
+    def _map(self, name: str) -> mmap.mmap:
+        if name not in self._maps:
+            with (self.blob_dir / name).open("rb") as f:
+                self._maps[name] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._maps[name]
+
+    def read(self, ref: Dict[str, Any]) -> bytes:
+        offset = ref["offset"]
+        return self._map(ref["blob"])[offset:offset + ref["length"]]
+
+    def close(self) -> None:
+        for mapped in self._maps.values():
+            mapped.close()
+        self._maps.clear()
+
+    def __enter__(self) -> "BlobReader":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.close()
+
+
+def load_step_image(step_edited: Any, reader: Optional[BlobReader]) -> bytes:
+    """Return the step-edited image bytes of a stage-3 record.
+
+    Handles the sidecar reference, the older inline base64 string and the
+    raw bytes of a parquet stage output.
+    """
+    if isinstance(step_edited, (bytes, bytearray, memoryview)):
+        return step_edited
+    if isinstance(step_edited, dict):
+        if reader is None:
+            raise ValueError("step_edited refers to a blob file but no BlobReader was given")
+        return reader.read(step_edited)
+    return base64.b64decode(step_edited)
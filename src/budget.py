@@ -0,0 +1,281 @@
+import asyncio
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set
+
+import pyarrow.parquet as pq
+
+from .checkpoint import RowKey
+from .parquet_output import stage_done_rows
+
+
+# USD per 1M tokens. A model not listed is priced by its longest listed prefix
+# (gpt-4o-2024-08-06 as gpt-4o); pass `prices` to Budget for other models or new prices
+PRICES = {
+    "gpt-4o": {"input": 2.50, "output": 10.00},
+    "gpt-4o-mini": {"input": 0.15, "output": 0.60},
+    "gpt-4.1": {"input": 2.00, "output": 8.00},
+    "gpt-4.1-mini": {"input": 0.40, "output": 1.60},
+    "gpt-image-1": {"input": 5.00, "image_input": 10.00, "output": 40.00},
+}
+# Batch API requests cost half
+BATCH_DISCOUNT = 0.5
+# Completion tokens expected from a chat answer before any response.usage was seen
+CHAT_COMPLETION_TOKENS = 400
+# Output tokens of a gpt-image-1 image by quality and size; "auto" is counted as high
+IMAGE_OUTPUT_TOKENS = {
+    "low": {"1024x1024": 272, "1024x1536": 408, "1536x1024": 400},
+    "medium": {"1024x1024": 1056, "1024x1536": 1584, "1536x1024": 1568},
+    "high": {"1024x1024": 4160, "1024x1536": 6240, "1536x1024": 6208},
+}
+# Weight of the newest response.usage in the running actual/estimated ratios
+LEARNING_RATE = 0.2
+
+
+class BudgetExceeded(Exception):
+    """Raised instead of sending a request that does not fit in what is left of the budget."""
+
+
+def image_output_tokens(width: int, height: int, size: str = "auto", quality: str = "auto") -> int:
+    """Output tokens of an image edit; size "auto" follows the orientation of the input image."""
+    if size not in IMAGE_OUTPUT_TOKENS["high"]:
+        size = "1536x1024" if width > height * 1.2 else "1024x1536" if height > width * 1.2 else "1024x1024"
+    return IMAGE_OUTPUT_TOKENS.get(quality, IMAGE_OUTPUT_TOKENS["high"])[size]
+
+
+def pending_rows(parquet_path: str, output_path: Path, resume: bool, subset: Optional[Set[RowKey]] = None) -> int:
+    """Rows of a dataset shard not yet in the stage output: all of them unless --resume, at most the --subset."""
+    rows = pq.ParquetFile(parquet_path).metadata.num_rows
+    if subset is not None:
+        rows = min(rows, len(subset))
+    if resume and output_path.exists():
+        rows -= len(stage_done_rows(output_path))
+    return max(0, rows)
+
+
+class Estimate:
+    """Pre-flight token counts and cost of one request, reserved until its response.usage is known."""
+
+    def __init__(self, model: str, input_tokens: int, output_tokens: int, image_input_tokens: int = 0, cost: float = 0.0) -> None:
+        self.model = model
+        self.input_tokens = input_tokens
+        self.output_tokens = output_tokens
+        self.image_input_tokens = image_input_tokens
+        self.cost = cost
+        # Token counts before the learned corrections, to compare with response.usage
+        self.raw = (input_tokens, output_tokens, image_input_tokens)
+        self.raw_input_tokens = input_tokens + image_input_tokens
+        self.raw_output_tokens = output_tokens
+
+    @property
+    def tokens(self) -> int:
+        return self.input_tokens + self.image_input_tokens + self.output_tokens
+
+
+class Budget:
+    """Estimate the cost of every request before it is sent and keep a run within --max-cost / --max-tokens.
+
+    ApiCaller asks for an estimate of each request that is not answered from
+    the cache: text tokens from the prompt length, image tokens from the
+    image sizes, completion tokens from what the model answered so far, and
+    for gpt-image-1 edits the output tokens of the expected image size. The
+    estimate is reserved while the request is in flight, so concurrent
+    requests cannot overrun the budget together, and replaced by the real
+    response.usage once the answer arrives. The actual/estimated ratios seen
+    so far correct the next estimates. A request that does not fit raises
+    BudgetExceeded, and so does every request after it: the run stops at one
+    point instead of still sending the rows whose estimates happen to be
+    smaller. The scripts then stop after the rows written so far, and
+    shards whose expected cost no longer fits are left for a later run
+    (shard_fits), so the budget is spent on whole shards where possible.
+    """
+
+    def __init__(self, max_cost: Optional[float] = None, max_tokens: Optional[int] = None, prices: Optional[Dict[str, Dict[str, float]]] = None) -> None:
+        self.max_cost = max_cost
+        self.max_tokens = max_tokens
+        self.prices = {**PRICES, **(prices or {})}
+        self.spent_cost = 0.0
+        self.spent_tokens = 0
+        self.reserved_cost = 0.0
+        self.reserved_tokens = 0
+        # model -> [requests, cost, tokens] of the settled requests
+        self.settled: Dict[str, list] = {}
+        # model -> running actual/estimated ratio of the input and output tokens
+        self.input_ratio: Dict[str, float] = {}
+        self.output_ratio: Dict[str, float] = {}
+        self.estimated_cost = 0.0
+        self.refused = 0
+        # Requests waiting in areserve, served in the order they came
+        self.waiting: List[Estimate] = []
+
+    @property
+    def limited(self) -> bool:
+        return self.max_cost is not None or self.max_tokens is not None
+
+    def _price(self, model: str) -> Dict[str, float]:
+        matches = [name for name in self.prices if model.startswith(name)]
+        if not matches:
+            return {}
+        return self.prices[max(matches, key=len)]
+
+    def cost(self, model: str, input_tokens: int, output_tokens: int, image_input_tokens: int = 0) -> float:
+        price = self._price(model)
+        return (
+            input_tokens * price.get("input", 0.0)
+            + image_input_tokens * price.get("image_input", price.get("input", 0.0))
+            + output_tokens * price.get("output", 0.0)
+        ) / 1e6
+
+    def _correct(self, estimate: Estimate) -> Estimate:
+        """Apply the actual/estimated ratios learned so far to the raw token counts."""
+        input_tokens, output_tokens, image_input_tokens = estimate.raw
+        input_ratio = self.input_ratio.get(estimate.model, 1.0)
+        estimate.input_tokens = round(input_tokens * input_ratio)
+        estimate.image_input_tokens = round(image_input_tokens * input_ratio)
+        estimate.output_tokens = round(output_tokens * self.output_ratio.get(estimate.model, 1.0))
+        estimate.cost = self.cost(estimate.model, estimate.input_tokens, estimate.output_tokens, estimate.image_input_tokens)
+        return estimate
+
+    def _estimate(self, model: str, input_tokens: int, output_tokens: int, image_input_tokens: int = 0) -> Estimate:
+        return self._correct(Estimate(model, input_tokens, output_tokens, image_input_tokens))
+
+    def estimate_chat(self, model: str, prompt_tokens: int, max_tokens: Optional[int] = None) -> Estimate:
+        completion_tokens = CHAT_COMPLETION_TOKENS if max_tokens is None else min(CHAT_COMPLETION_TOKENS, max_tokens)
+        return self._estimate(model, prompt_tokens, completion_tokens)
+
+    def estimate_edit(self, model: str, prompt_tokens: int, image_tokens: int, output_tokens: int) -> Estimate:
+        return self._estimate(model, prompt_tokens, output_tokens, image_tokens)
+
+    def _fits(self, cost: float, tokens: int) -> bool:
+        if self.refused:
+            return False
+        if self.max_cost is not None and self.spent_cost + self.reserved_cost + cost > self.max_cost:
+            return False
+        if self.max_tokens is not None and self.spent_tokens + self.reserved_tokens + tokens > self.max_tokens:
+            return False
+        return True
+
+    def _refuse(self, estimate: Estimate) -> BudgetExceeded:
+        self.refused += 1
+        return BudgetExceeded(
+            f"Budget exhausted: ${self.spent_cost:.4f} / {self.spent_tokens} tokens spent, "
+            f"the next {estimate.model} request needs ~${estimate.cost:.4f} / {estimate.tokens} tokens"
+        )
+
+    def _take(self, estimate: Estimate) -> Estimate:
+        self.reserved_cost += estimate.cost
+        self.reserved_tokens += estimate.tokens
+        return estimate
+
+    def reserve(self, estimate: Estimate) -> Estimate:
+        if not self._fits(estimate.cost, estimate.tokens):
+            raise self._refuse(estimate)
+        return self._take(estimate)
+
+    async def areserve(self, estimate: Estimate) -> Estimate:
+        """Async version of reserve; waits while requests in flight may still come in under their estimates.
+
+        The waiting requests are admitted first come, first served, so the
+        early rows of a shard are not starved by later ones with smaller
+        estimates, which the scripts could then not write in row order.
+        """
+        if self.waiting or not self._fits(estimate.cost, estimate.tokens):
+            self.waiting.append(estimate)
+            try:
+                while self.waiting[0] is not estimate or not self._fits(estimate.cost, estimate.tokens):
+                    if self.refused or (self.waiting[0] is estimate and not self.reserved_tokens):
+                        raise self._refuse(estimate)
+                    await asyncio.sleep(0.05)
+                    # The requests settled meanwhile may have corrected the estimate
+                    self._correct(estimate)
+            finally:
+                self.waiting.remove(estimate)
+        return self._take(estimate)
+
+    def release(self, estimate: Estimate) -> None:
+        """Give back the reservation of a request that failed (failed requests are not billed)."""
+        self.reserved_cost -= estimate.cost
+        self.reserved_tokens -= estimate.tokens
+
+    def settle(self, estimate: Estimate, usage: Any) -> None:
+        """Replace the reservation by the real response.usage and learn from the difference."""
+        self.release(estimate)
+        # Chat completions report prompt/completion tokens, image edits input/output tokens
+        input_tokens = getattr(usage, "prompt_tokens", None) or getattr(usage, "input_tokens", None)
+        output_tokens = getattr(usage, "completion_tokens", None) or getattr(usage, "output_tokens", None)
+        if input_tokens is None or output_tokens is None:
+            self._spend(estimate.model, estimate.cost, estimate.tokens, estimate.cost)
+            return
+        image_input_tokens = 0
+        details = getattr(usage, "input_tokens_details", None)
+        if getattr(details, "image_tokens", None) is not None:
+            image_input_tokens = details.image_tokens
+            input_tokens -= image_input_tokens
+        if estimate.raw_input_tokens:
+            observed = (input_tokens + image_input_tokens) / estimate.raw_input_tokens
+            self.input_ratio[estimate.model] = self._learn(self.input_ratio.get(estimate.model, 1.0), observed)
+        if estimate.raw_output_tokens:
+            observed = output_tokens / estimate.raw_output_tokens
+            self.output_ratio[estimate.model] = self._learn(self.output_ratio.get(estimate.model, 1.0), observed)
+        cost = self.cost(estimate.model, input_tokens, output_tokens, image_input_tokens)
+        self._spend(estimate.model, cost, input_tokens + image_input_tokens + output_tokens, estimate.cost)
+
+    def charge(self, estimate: Estimate, discount: float = BATCH_DISCOUNT) -> None:
+        """Count a request collected for the Batch API at its (discounted) estimate; raises if it does not fit."""
+        estimate.cost *= discount
+        self.reserve(estimate)
+        self.release(estimate)
+        self._spend(estimate.model, estimate.cost, estimate.tokens, estimate.cost)
+
+    def charge_duplicate(self, estimate: Estimate) -> bool:
+        """Count a second copy of a request (a hedge) at the estimate of the first; False when it does not fit.
+
+        A hedge never takes the budget a waiting request is waiting for.
+        """
+        if self.waiting or not self._fits(estimate.cost, estimate.tokens):
+            return False
+        self._spend(estimate.model, estimate.cost, estimate.tokens, estimate.cost)
+        return True
+
+    @staticmethod
+    def _learn(ratio: float, observed: float) -> float:
+        return ratio + LEARNING_RATE * (observed - ratio)
+
+    def _spend(self, model: str, cost: float, tokens: int, estimated_cost: float) -> None:
+        self.spent_cost += cost
+        self.spent_tokens += tokens
+        self.estimated_cost += estimated_cost
+        totals = self.settled.setdefault(model, [0, 0.0, 0])
+        totals[0] += 1
+        totals[1] += cost
+        totals[2] += tokens
+
+    def shard_fits(self, shard: str, rows: int, calls_per_row: Dict[str, int]) -> bool:
+        """Whether `rows` more rows fit in what is left, at the average cost per request seen so far.
+
+        Always True before the first request of a model was settled, and without a budget.
+        """
+        if not self.limited:
+            return True
+        cost = 0.0
+        tokens = 0
+        for model, calls in calls_per_row.items():
+            requests, model_cost, model_tokens = self.settled.get(model, (0, 0.0, 0))
+            if not requests:
+                return True
+            cost += model_cost / requests * calls * rows
+            tokens += round(model_tokens / requests * calls * rows)
+        if self._fits(cost, tokens):
+            return True
+        print(f"Leaving shard {shard} for a later run: {rows} rows need ~${cost:.4f} / {tokens} tokens, more than is left of the budget\n")
+        return False
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "spent_cost": round(self.spent_cost, 4),
+            "spent_tokens": self.spent_tokens,
+            # How far the pre-flight estimates were off, over all settled requests
+            "estimated_cost": round(self.estimated_cost, 4),
+            "max_cost": self.max_cost,
+            "max_tokens": self.max_tokens,
+            "refused": self.refused,
+        }
@@ -0,0 +1,169 @@
+import json
+import os
+from pathlib import Path
+from typing import Any, Dict, Optional, Set, Tuple
+
+
+RowKey = Tuple[str, str]
+# A row of a shard: its source/target names and how many earlier rows have the same names
+RowId = Tuple[str, str, int]
+
+
+def record_key(record: Dict[str, Any]) -> RowKey:
+    """Identify a row by its source/target image names."""
+    return (record.get("source"), record.get("target"))
+
+
+class RowCounter:
+    """Number the rows sharing a source/target key in the order they come.
+
+    A dataset shard may repeat a source/target pair or leave the names
+    empty, so the names alone do not identify a row: the n-th row with a
+    key is (source, target, n). Stage outputs keep the rows in shard order,
+    so counting the records of an output gives the same identities.
+    """
+
+    def __init__(self) -> None:
+        self.seen: Dict[RowKey, int] = {}
+
+    def number(self, source: str, target: str) -> RowId:
+        n = self.seen.get((source, target), 0)
+        self.seen[(source, target)] = n + 1
+        return (source, target, n)
+
+
+def load_done_provenance(output_path: Path, field: Optional[str] = None) -> Dict[RowId, Optional[str]]:
+    """Map the rows already written to an output .jsonal to their `field` value.
+
+    A line cut short by a crash is dropped, and the file is truncated back to
+    the last complete record so new rows can be appended after it.
+    """
+    done = {}
+    rows = RowCounter()
+    valid_size = 0
+    with output_path.open("rb") as fin:
+        for line in fin:
+            if not line.endswith(b"\n"):
+                break
+            stripped = line.strip()
+            if stripped:
+                try:
+                    record = json.loads(stripped)
+                except json.JSONDecodeError:
+                    break
+                done[rows.number(*record_key(record))] = record.get(field) if field else None
+            valid_size += len(line)
+
+    if valid_size < output_path.stat().st_size:
+        print(f"Dropping an incomplete record at the end of {output_path}\n")
+        with output_path.open("r+b") as f:
+            f.truncate(valid_size)
+    return done
+
+
+def load_done_rows(output_path: Path) -> Set[RowId]:
+    """Collect the rows already written to an output .jsonal."""
+    return set(load_done_provenance(output_path))
+
+
+def merge_jsonal(output_path: Path, changes_path: Path) -> None:
+    """Put the rows recomputed by an --incremental run (`changes_path`) in place of the ones they replace.
+
+    Rows that are new to the output are added at its end.
+    """
+    replacements: Dict[RowId, bytes] = {}
+    with changes_path.open("rb") as fin:
+        for line in fin:
+            if not line.endswith(b"\n"):
+                break
+            item = json.loads(line)
+            replacements[tuple(item["row"])] = (json.dumps(item["record"], ensure_ascii=False) + "\n").encode("utf-8")
+    rows = RowCounter()
+    tmp_path = output_path.with_name(f"{output_path.name}.tmp")
+    with tmp_path.open("wb") as fout:
+        if output_path.exists():
+            with output_path.open("rb") as fin:
+                for line in fin:
+                    if line.strip():
+                        fout.write(replacements.pop(rows.number(*record_key(json.loads(line))), line))
+        fout.writelines(replacements.values())
+        fout.flush()
+        os.fsync(fout.fileno())
+    os.replace(tmp_path, output_path)
+    changes_path.unlink()
+
+
+class CheckpointWriter:
+    """Append finished records to a stage output, one durable line at a time.
+
+    With resume=True the existing output is kept, the rows it already holds
+    are reported by is_done() and new rows are appended after them. Otherwise
+    the output is started from scratch, as before. Rows are identified by
+    RowId, so rows repeating a source/target pair are all written.
+
+    With a provenance_field (--incremental) an existing row only counts as
+    done once keep() has found its stored provenance equal to the current
+    one. The others are recomputed into <name>.changes, which is merged into
+    the output when the writer is closed (or by the next run, after a crash).
+    """
+
+    def __init__(self, output_path: Path, resume: bool = False, provenance_field: Optional[str] = None) -> None:
+        self.output_path = output_path
+        self.changes_path = output_path.with_name(f"{output_path.name}.changes")
+        self.done: Set[RowId] = set()
+        self.previous: Dict[RowId, Optional[str]] = {}
+        self.provenance_field = provenance_field
+        self.replaced = 0
+        if self.changes_path.exists():
+            # Rows recomputed by an interrupted --incremental run
+            if resume:
+                merge_jsonal(output_path, self.changes_path)
+            else:
+                self.changes_path.unlink()
+        if resume and output_path.exists():
+            if provenance_field:
+                self.previous = load_done_provenance(output_path, provenance_field)
+                print(f"Checking {output_path}: {len(self.previous)} rows against their current inputs\n")
+            else:
+                self.done = load_done_rows(output_path)
+                print(f"Resuming {output_path}: {len(self.done)} rows already done\n")
+            mode = "a"
+        else:
+            mode = "w"
+        if provenance_field and self.previous:
+            self.file = self.changes_path.open("w", encoding="utf-8")
+        else:
+            self.file = output_path.open(mode, encoding="utf-8")
+
+    def is_done(self, row: RowId) -> bool:
+        return row in self.done
+
+    def keep(self, row: RowId, provenance: str) -> bool:
+        """Count an existing row as done if it was made from the same inputs as it would be now."""
+        if row in self.previous and self.previous[row] == provenance:
+            self.done.add(row)
+        return row in self.done
+
+    def write(self, record: Dict[str, Any], row: Optional[RowId] = None) -> None:
+        """Append one record and force it to disk before returning; `row` is needed with --incremental."""
+        if self.provenance_field and self.previous:
+            line = json.dumps({"row": row, "record": record}, ensure_ascii=False)
+            if row in self.previous:
+                self.replaced += 1
+        else:
+            line = json.dumps(record, ensure_ascii=False)
+        self.file.write(line + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self) -> None:
+        self.file.close()
+        if self.provenance_field and self.previous:
+            print(f"{self.output_path}: {len(self.previous) - self.replaced} rows kept, {self.replaced} recomputed\n")
+            merge_jsonal(self.output_path, self.changes_path)
+
+    def __enter__(self) -> "CheckpointWriter":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.close()
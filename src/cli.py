@@ -0,0 +1,311 @@
+"""Command line of the generation stages: `python -m src <command>` and the parsers of run_1 ... run_4 and run_pipeline.
+
+Only the standard library is imported here, so `--help`, argument errors
+and `plan` answer at once; openai, pyarrow and PIL (about a second of
+imports) are loaded with the stage module, once a run actually starts.
+"""
+
+import argparse
+import importlib
+import os
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .sharding import extract_index_number_str, list_shards, run_workers
+
+
+SUBSET_HELP = "Only process the rows listed in this file: JSON lines with source and target (e.g. lines picked from a stage output); combine with --resume to add them to an existing output"
+INDEX_DIR_HELP = "Save the per-shard source/target -> row index here and reuse it while the parquet file is unchanged (rebuilt in memory when not set)"
+JOIN_TARGET_HELP = "Column name for target image, whose path is part of the key joining records to parquet rows"
+
+
+def add_api_args(parser: argparse.ArgumentParser) -> None:
+    """Keys, endpoint, retries and connections shared by the chat and image requests."""
+    parser.add_argument("--api-key", default=None, help="OpenAI API key (or --api-keys-file)")
+    parser.add_argument("--api-keys-file", default=None, help="Spread the requests over several API keys / compatible endpoints listed in this JSON-lines file (name, api_key or api_key_env, base_url, weight, per-model limits) instead of --api-key")
+    parser.add_argument("--key-auth-cooldown", type=float, default=600.0, help="Seconds a key of --api-keys-file stays out of rotation after an authentication error")
+    parser.add_argument("--key-error-cooldown", type=float, default=60.0, help="Seconds a key of --api-keys-file stays out of rotation after 3 connection errors, timeouts or 5xx in a row")
+    parser.add_argument("--base-url", default=None, help="API base URL, e.g. a proxy or a compatible endpoint (default: the openai default or OPENAI_BASE_URL)")
+    parser.add_argument("--max-retries", type=int, default=6, help="Retries of a request after a 429, timeout or server error (jittered exponential backoff honouring Retry-After)")
+    parser.add_argument("--keepalive-expiry", type=float, default=30.0, help="Seconds an idle pooled connection is kept open for reuse")
+    parser.add_argument("--connect-timeout", type=float, default=10.0, help="Seconds allowed to open a connection")
+    parser.add_argument("--http2", action="store_true", help="Use HTTP/2, multiplexing the requests over fewer connections (needs httpx[http2])")
+
+
+def add_chat_args(parser: argparse.ArgumentParser, model_help: str = "OpenAI model to use") -> None:
+    parser.add_argument("--model", default="gpt-4o", help=model_help)
+    parser.add_argument("--rpm", type=float, default=None, help="Requests per minute budget of the chat model")
+    parser.add_argument("--tpm", type=float, default=None, help="Tokens per minute budget of the chat model")
+    parser.add_argument("--response-format", choices=["json_schema", "json_object", "none"], default="json_schema", help="Structured output requested from the chat model: a strict JSON schema, any JSON object, or prompt-only JSON as before")
+    parser.add_argument("--max-connections", type=int, default=64, help="Size of the connection pool of the chat requests")
+    parser.add_argument("--max-keepalive-connections", type=int, default=32, help="Idle connections kept open for reuse by the chat requests")
+    parser.add_argument("--read-timeout", type=float, default=120.0, help="Seconds to wait for a chat response")
+
+
+def add_image_edit_args(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--n", type=int, default=1, help="Images per edit")
+    parser.add_argument("--edit-steps", type=int, default=1, help="Run the first K numbered edit steps of each record as a chain, each on the image of the step before (default 1: only step 1); images of steps 2..K go to step_edited_2 ... step_edited_K")
+    parser.add_argument("--step-image-storage", choices=["blob", "inline"], default="blob", help="Store step images in a per-shard .blob sidecar (default) or inline as base64 in the JSONL")
+    parser.add_argument("--image-rpm", type=float, default=None, help="Requests per minute budget of gpt-image-1")
+    parser.add_argument("--image-tpm", type=float, default=None, help="Tokens per minute budget of gpt-image-1")
+    parser.add_argument("--image-max-connections", type=int, default=16, help="Size of the separate connection pool of the image edits")
+    parser.add_argument("--image-read-timeout", type=float, default=600.0, help="Seconds to wait for an image edit")
+
+
+def add_parquet_args(parser: argparse.ArgumentParser, target_help: str = JOIN_TARGET_HELP, batch_help: str = "Number of parquet rows read and processed per batch") -> None:
+    parser.add_argument("--input-parquet-dir", required=True, help="Input file containing a batch of parquet file, which include the source and target images")
+    parser.add_argument("--source-column-name", default="src_img", help="Column name for source image bytes")
+    parser.add_argument("--target-column-name", default="edited_img", help=target_help)
+    parser.add_argument("--batch-size", type=int, default=64, help=batch_help)
+
+
+def add_stage_io_args(parser: argparse.ArgumentParser, output_dir: str, input_dir: Optional[str] = None, input_help: str = "path to difference JSONL file") -> None:
+    """Input and output directories of one stage, its concurrency, --resume and --incremental."""
+    if input_dir is not None:
+        parser.add_argument("--input-jsonal-dir", default=input_dir, help=f"Directory of the previous stage's .jsonal / .parquet outputs, {input_help}")
+    parser.add_argument("--output-dir", default=output_dir, help="Output JSONL dir, which will include a batch of generated results")
+    parser.add_argument("--concurrency", type=int, default=8, help="Maximum number of API requests in flight at once")
+    parser.add_argument("--resume", action="store_true", help="Keep the rows already in the output file and only process the missing ones")
+    parser.add_argument("--incremental", action="store_true", help="Keep the rows of the existing output whose provenance hash still matches their current inputs (model, prompt, upload settings, upstream record) and recompute the others; implies --resume")
+
+
+def add_cache_args(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--cache-dir", default=None, help="Directory of the on-disk response cache (disabled when not set)")
+    parser.add_argument("--cache-max-gb", type=float, default=10.0, help="Size cap of the response cache, least recently used entries are evicted first")
+
+
+def add_image_prep_args(
+    parser: argparse.ArgumentParser,
+    detail_help: Optional[str] = "Vision detail level sent with each image; images are also shrunk to what this level uses (512px for low)",
+    for_edits: bool = False,
+    cache_help: str = "Directory caching the resized images, shared by the stages (in-memory only when not set)",
+    workers_help: Optional[str] = None,
+) -> None:
+    """Downscaling / re-encoding before upload; `for_edits` for the uploads of gpt-image-1, which has no detail level."""
+    parser.add_argument("--image-max-side", type=int, default=None, help="Downscale images so their longer side is at most this many pixels before upload")
+    if detail_help is not None:
+        parser.add_argument("--image-detail", choices=["low", "high", "auto"], default=None, help=detail_help)
+    if for_edits:
+        parser.add_argument("--image-format", choices=["png", "jpeg", "webp"], default="png", help="Format the source images are re-encoded to before upload")
+    else:
+        parser.add_argument("--image-format", choices=["original", "jpeg", "webp", "png"], default="original", help="Re-encode images to this format before upload (original keeps the bytes unless they are resized)")
+    parser.add_argument("--image-quality", type=int, default=85, help="JPEG / WebP quality of re-encoded images")
+    parser.add_argument("--image-cache-dir", default=None, help=cache_help)
+    if workers_help is not None:
+        parser.add_argument("--image-workers", type=int, default=min(4, os.cpu_count() or 1), help=workers_help)
+
+
+def add_batch_args(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--mode", choices=["online", "batch"], default="online", help="online: call the API directly; batch: submit the shard through the OpenAI Batch API (half price, separate quota) and merge the results")
+    parser.add_argument("--poll-interval", type=float, default=60.0, help="Seconds between two status checks of a submitted batch")
+
+
+def add_sharding_args(parser: argparse.ArgumentParser, lock_dir: str = "the output directory") -> None:
+    parser.add_argument("--num-shards", type=int, default=1, help="Split the parquet files into this many partitions by their train-XXXXX number (e.g. one per node)")
+    parser.add_argument("--shard-index", type=int, default=0, help="Partition processed by this run, in [0, --num-shards)")
+    parser.add_argument("--workers", type=int, default=None, help=f"Claim parquet files through lock files in {lock_dir} and process them with this many local processes; several machines sharing the directory can run it at once")
+    parser.add_argument("--stale-lock-seconds", type=float, default=600.0, help="A lock whose heartbeat is older than this is considered abandoned and taken over")
+
+
+def add_output_args(parser: argparse.ArgumentParser, format_help: str = "Write the results as JSON lines (default) or as a compressed parquet file written one row group at a time") -> None:
+    parser.add_argument("--output-format", choices=["jsonal", "parquet"], default="jsonal", help=format_help)
+    parser.add_argument("--output-row-group-size", type=int, default=64, help="Rows per row group of parquet outputs")
+    parser.add_argument("--output-compression", choices=["zstd", "snappy", "gzip", "lz4", "none"], default="zstd", help="Compression codec of parquet outputs")
+
+
+def add_subset_args(parser: argparse.ArgumentParser, subset_help: str = SUBSET_HELP, index_help: str = INDEX_DIR_HELP) -> None:
+    parser.add_argument("--subset", default=None, help=subset_help)
+    parser.add_argument("--index-dir", default=None, help=index_help)
+
+
+def add_run_control_args(parser: argparse.ArgumentParser, per_stage: bool = False) -> None:
+    """Metrics export, deduplication, budget and hedging; `per_stage` for run_pipeline's wording."""
+    of_the_run = "of the run, per stage," if per_stage else "of the run"
+    parser.add_argument("--metrics-textfile", default=None, help=f"Export the request and phase metrics {of_the_run} to this Prometheus textfile (e.g. for node_exporter), updated after every shard")
+    once = "once per stage" if per_stage else "once"
+    parser.add_argument("--no-dedup", action="store_true", help=f"Send every row to the API even when its images and texts repeat an earlier row of the run (by default identical work is sent {once} and its result reused)")
+    later = "a later run" if per_stage else "a later --resume run"
+    parser.add_argument("--max-cost", type=float, default=None, help=f"Stop the run before its requests would cost more than this many USD (estimated before each request, settled with the real token usage); shards that no longer fit are left for {later}")
+    parser.add_argument("--max-tokens", type=int, default=None, help="Same as --max-cost, in tokens")
+    parser.add_argument("--hedge-percentile", type=float, default=None, help="Send a duplicate of a request still running after this percentile of the recent latencies (e.g. 95) and keep the first answer; off when not set")
+    parser.add_argument("--hedge-max-rate", type=float, default=0.05, help="At most this many hedged duplicates per request")
+    parser.add_argument("--hedge-min-delay", type=float, default=0.05, help="Never hedge a request earlier than this many seconds, whatever the percentile")
+
+
+def difference_args(parser: argparse.ArgumentParser) -> None:
+    add_api_args(parser)
+    add_chat_args(parser)
+    add_parquet_args(parser, target_help="Column name for target image bytes")
+    add_stage_io_args(parser, "./output/_1_difference")
+    add_cache_args(parser)
+    add_batch_args(parser)
+    add_image_prep_args(parser)
+    add_sharding_args(parser)
+    add_output_args(parser)
+    add_subset_args(
+        parser,
+        subset_help="Only process the rows listed in this file: JSON lines with source and target (e.g. lines picked from a stage output); they are read by key instead of streaming the whole shard. Combine with --resume to add them to an existing output",
+        index_help="Save the per-shard source/target -> row index used by --subset here and reuse it while the parquet file is unchanged",
+    )
+    add_run_control_args(parser)
+
+
+def instruction_args(parser: argparse.ArgumentParser) -> None:
+    add_api_args(parser)
+    add_chat_args(parser)
+    add_parquet_args(parser)
+    add_stage_io_args(parser, "./output/_2_instruction", input_dir="./output/_1_difference")
+    add_cache_args(parser)
+    add_batch_args(parser)
+    add_image_prep_args(parser)
+    add_sharding_args(parser)
+    add_output_args(parser)
+    add_subset_args(parser)
+    add_run_control_args(parser)
+
+
+def step_image_args(parser: argparse.ArgumentParser) -> None:
+    add_api_args(parser)
+    add_image_edit_args(parser)
+    add_parquet_args(parser)
+    add_stage_io_args(parser, "./output/_3_step_image", input_dir="./output/_2_instruction", input_help="path to instruction JSONL file")
+    add_cache_args(parser)
+    add_image_prep_args(
+        parser,
+        detail_help=None,
+        for_edits=True,
+        workers_help="Processes decoding and re-encoding the source images while requests are in flight (0: in the main process)",
+    )
+    add_sharding_args(parser)
+    add_output_args(parser, format_help="Write the results as JSON lines (default) or as a compressed parquet file written one row group at a time; step images are then stored in the parquet file itself")
+    add_subset_args(parser)
+    add_run_control_args(parser)
+
+
+def analysis_args(parser: argparse.ArgumentParser) -> None:
+    add_api_args(parser)
+    add_chat_args(parser, model_help="OpenAI ChatCompletion model to use")
+    add_parquet_args(parser)
+    add_stage_io_args(parser, "./output/_4_cot_reinstruction", input_dir="./output/_3_step_image")
+    add_cache_args(parser)
+    add_batch_args(parser)
+    add_image_prep_args(parser)
+    add_sharding_args(parser)
+    add_output_args(parser)
+    add_subset_args(parser)
+    add_run_control_args(parser)
+
+
+def pipeline_args(parser: argparse.ArgumentParser) -> None:
+    add_api_args(parser)
+    add_chat_args(parser, model_help="OpenAI model to use for the chat stages")
+    add_image_edit_args(parser)
+    add_parquet_args(parser, target_help="Column name for target image bytes", batch_help="Number of parquet rows read per batch")
+
+    # the same per-stage outputs as run_1 ... run_4
+    parser.add_argument("--difference-output-dir", default="./output/_1_difference", help="Output JSONL dir of stage 1")
+    parser.add_argument("--instruction-output-dir", default="./output/_2_instruction", help="Output JSONL dir of stage 2")
+    parser.add_argument("--step-image-output-dir", default="./output/_3_step_image", help="Output JSONL dir of stage 3")
+    parser.add_argument("--analysis-output-dir", default="./output/_4_cot_reinstruction", help="Output JSONL dir of stage 4")
+    parser.add_argument("--resume", action="store_true", help="Keep the rows already in the stage outputs; every missing row starts at the first stage that has not written it, from the record of the stage before")
+
+    # independent concurrency per stage, connected by bounded queues
+    parser.add_argument("--difference-concurrency", type=int, default=8, help="Stage 1 requests in flight")
+    parser.add_argument("--instruction-concurrency", type=int, default=8, help="Stage 2 requests in flight")
+    parser.add_argument("--step-image-concurrency", type=int, default=4, help="Stage 3 image edits in flight")
+    parser.add_argument("--analysis-concurrency", type=int, default=8, help="Stage 4 requests in flight")
+    parser.add_argument("--queue-size", type=int, default=32, help="Maximum number of rows waiting between two stages")
+
+    add_cache_args(parser)
+    add_image_prep_args(
+        parser,
+        detail_help="Vision detail level sent with each image of stages 1, 2 and 4; images are also shrunk to what this level uses (512px for low)",
+        cache_help="Directory caching the resized images across runs (in-memory only when not set)",
+        workers_help="Processes decoding and re-encoding the stage 3 uploads ahead of the requests (0: in the main process)",
+    )
+    add_sharding_args(parser, lock_dir="the stage 4 output directory")
+    add_output_args(parser, format_help="Write the results of every stage as JSON lines (default) or as compressed parquet files written one row group at a time; step images are then stored in the parquet file itself")
+    add_run_control_args(parser, per_stage=True)
+
+
+# command -> (module run by it, description, options)
+STAGES: Dict[str, Tuple[str, str, Callable[[argparse.ArgumentParser], None]]] = {
+    "difference": ("run_1", "Generate image difference descriptions using OpenAI API", difference_args),
+    "instruction": ("run_2", "Generate editing instructions from difference descriptions", instruction_args),
+    "step-image": ("run_3", "Batch-apply 'step' edits to images and update JSONL records", step_image_args),
+    "analysis": ("run_4", "Batch-generate CoT analysis and revised edit instructions from image records", analysis_args),
+    "pipeline": ("run_pipeline", "Stream every parquet row through all four generation stages in one pass", pipeline_args),
+}
+
+
+def check_api_key(parser: argparse.ArgumentParser, args: argparse.Namespace) -> argparse.Namespace:
+    if args.api_key is None and args.api_keys_file is None:
+        parser.error("one of --api-key or --api-keys-file is required")
+    return args
+
+
+def parse_stage_args(stage: str, argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """Parse the options of one stage, as run_1 ... run_4 and run_pipeline do when run directly."""
+    _, description, add_args = STAGES[stage]
+    parser = argparse.ArgumentParser(description=description)
+    add_args(parser)
+    return check_api_key(parser, parser.parse_args(argv))
+
+
+def plan_args(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--input-parquet-dir", required=True, help="Input file containing a batch of parquet file, which include the source and target images")
+    parser.add_argument("--num-shards", type=int, default=1, help="Split the parquet files into this many partitions by their train-XXXXX number (e.g. one per node)")
+    parser.add_argument("--shard-index", type=int, default=0, help="Partition to list, in [0, --num-shards)")
+    parser.add_argument("--output-dir", default=None, help="Output (and lock) directory of a stage, to show which shards are done, claimed or started; the stage 4 one for the pipeline")
+    parser.add_argument("--output-format", choices=["jsonal", "parquet"], default="jsonal", help="Output format of that stage")
+
+
+def shard_status(output_dir: Path, number: str, output_format: str) -> str:
+    """done / claimed come from the lock files of --workers runs, started from an existing output file."""
+    if (output_dir / f"{number}.done").exists():
+        return "done"
+    if (output_dir / f"{number}.lock").exists():
+        return "claimed"
+    if (output_dir / f"{number}.{output_format}").exists():
+        return "started"
+    return "pending"
+
+
+def plan(args: argparse.Namespace) -> None:
+    """Print the parquet files a run with these --num-shards / --shard-index would process, and their state."""
+    paths = list_shards(args.input_parquet_dir, args.num_shards, args.shard_index)
+    counts: Dict[str, int] = {}
+    total_bytes = 0
+    for path in paths:
+        number = extract_index_number_str(path)
+        size = os.path.getsize(path)
+        total_bytes += size
+        line = f"{number}  {os.path.basename(path)}  {size / 1024 ** 2:.1f} MB"
+        if args.output_dir is not None:
+            status = shard_status(Path(args.output_dir), number, args.output_format)
+            counts[status] = counts.get(status, 0) + 1
+            line += f"  {status}"
+        print(line)
+    summary = f"{len(paths)} parquet files, {total_bytes / 1024 ** 3:.2f} GB, partition {args.shard_index} of {args.num_shards}"
+    if counts:
+        summary += ": " + ", ".join(f"{count} {status}" for status, count in sorted(counts.items()))
+    print(summary)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m src", description="Generate the dataset: the four stages, the streaming pipeline, and shard planning")
+    commands = parser.add_subparsers(dest="command", required=True, metavar="command")
+    stage_parsers = {}
+    for command, (module_name, description, add_args) in STAGES.items():
+        stage_parsers[command] = commands.add_parser(command, description=description, help=f"{description} (python -m src.{module_name})")
+        add_args(stage_parsers[command])
+    plan_args(commands.add_parser("plan", description=plan.__doc__, help="List the parquet files of a partition and their progress, without starting a run"))
+    args = parser.parse_args(argv)
+    if args.command == "plan":
+        plan(args)
+        return
+    check_api_key(stage_parsers[args.command], args)
+    # The stage module, and with it openai / pyarrow / PIL, is only imported now
+    module = importlib.import_module(f"{__package__}.{STAGES[args.command][0]}")
+    # One process, or --workers processes sharing the parquet files through lock files
+    run_workers(module.run, args, args.workers or 1)
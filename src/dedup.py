@@ -0,0 +1,110 @@
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Tuple
+
+
+def content_key(*parts: Any) -> str:
+    """Fast content hash of image bytes (bytes or memoryview) and texts; None counts as empty."""
+    digest = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        data = part.encode("utf-8") if isinstance(part, str) else (part if part is not None else b"")
+        # The length prefix keeps ("ab", "c") and ("a", "bc") apart
+        digest.update(len(data).to_bytes(8, "little"))
+        digest.update(data)
+    return digest.hexdigest()
+
+
+def _size(value: Any) -> int:
+    return len(value) if isinstance(value, (str, bytes)) else 64
+
+
+class Deduplicator:
+    """Send each distinct piece of work to the API once and fan the result out to its duplicates.
+
+    The dataset repeats source images with several edits and repeats whole
+    pairs across shards. A generator keys every call on the content of its
+    inputs (image bytes and texts); a duplicate arriving while the first call
+    is in flight waits for it, and one arriving later gets the remembered
+    result. Results are kept up to `max_bytes`, least recently used first
+    out, so the image edits of stage 3 cannot fill the memory. The response
+    cache still covers duplicates across runs and processes.
+    """
+
+    def __init__(self, enabled: bool = True, max_bytes: int = 256 * 1024 ** 2) -> None:
+        self.enabled = enabled
+        self.max_bytes = max_bytes
+        self.results: "OrderedDict[str, Any]" = OrderedDict()
+        self.total_bytes = 0
+        self.in_flight: Dict[str, "asyncio.Future[Any]"] = {}
+        self.lock = threading.Lock()
+        self.unique = 0
+        self.saved = 0
+
+    def _lookup(self, key: str) -> Tuple[bool, Any]:
+        with self.lock:
+            if key in self.results:
+                self.results.move_to_end(key)
+                self.saved += 1
+                return True, self.results[key]
+        return False, None
+
+    def _remember(self, key: str, value: Any) -> None:
+        with self.lock:
+            if key in self.results:
+                return
+            self.results[key] = value
+            self.total_bytes += _size(value)
+            while self.total_bytes > self.max_bytes and self.results:
+                _, evicted = self.results.popitem(last=False)
+                self.total_bytes -= _size(evicted)
+
+    def run(self, key: str, call: Callable[[], Any], bypass: bool = False) -> Any:
+        """Return call() for the first occurrence of `key`, the remembered result for later ones.
+
+        bypass=True calls through without remembering, e.g. in the collection pass of batch mode.
+        """
+        if not self.enabled or bypass:
+            return call()
+        found, value = self._lookup(key)
+        if found:
+            return value
+        self.unique += 1
+        value = call()
+        self._remember(key, value)
+        return value
+
+    async def arun(self, key: str, call: Callable[[], Awaitable[Any]], bypass: bool = False) -> Any:
+        """Async version of run; duplicates of a call still in flight wait for its result."""
+        if not self.enabled or bypass:
+            return await call()
+        found, value = self._lookup(key)
+        if found:
+            return value
+        if key in self.in_flight:
+            self.saved += 1
+            # shield: a cancelled duplicate must not cancel the shared call
+            return await asyncio.shield(self.in_flight[key])
+        future = asyncio.get_running_loop().create_future()
+        self.in_flight[key] = future
+        self.unique += 1
+        try:
+            value = await call()
+        except BaseException as exc:
+            # The duplicates fail like the call they waited for
+            if isinstance(exc, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(exc)
+                # Retrieved here, so an unawaited failure is not reported as "never retrieved"
+                future.exception()
+            raise
+        finally:
+            self.in_flight.pop(key, None)
+        future.set_result(value)
+        self._remember(key, value)
+        return value
+
+    def stats(self) -> Dict[str, int]:
+        return {"unique_calls": self.unique, "saved_calls": self.saved, "remembered": len(self.results)}
@@ -0,0 +1,115 @@
+import asyncio
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Tuple
+
+
+def _round(seconds: Optional[float]) -> Optional[float]:
+    return None if seconds is None else round(seconds, 2)
+
+
+class HedgePolicy:
+    """Send a duplicate of a request that is slower than usual and keep whichever answer comes first.
+
+    The latency of every call is recorded per (endpoint, model), over the
+    last `window` calls. Once `min_samples` are known, a call still running
+    after the `percentile` of those latencies gets a second copy sent
+    (`min_delay` only keeps the delay from reaching zero, it is far below
+    the usual latencies), through the same retries and rate
+    limiters and possibly on another key; the first successful answer wins
+    and the other request is cancelled. At most `max_rate` hedges are sent
+    per call, so the extra cost stays bounded. Only the async path hedges.
+    """
+
+    def __init__(
+        self,
+        percentile: float = 0.95,
+        max_rate: float = 0.05,
+        min_samples: int = 20,
+        window: int = 200,
+        min_delay: float = 0.05,
+    ) -> None:
+        self.percentile = percentile
+        self.max_rate = max_rate
+        self.min_samples = min_samples
+        self.window = window
+        self.min_delay = min_delay
+        self.latencies: Dict[Tuple[str, str], Deque[float]] = {}
+        self.calls = 0
+        self.hedges = 0
+        self.wins = 0
+        self.extra_tokens = 0
+        # How long the calls rescued by a hedge had been waiting when its answer arrived
+        self.cut_seconds = 0.0
+
+    def delay(self, key: Tuple[str, str]) -> Optional[float]:
+        """Seconds after which a call of `key` is hedged, None while too few latencies are known."""
+        samples = self.latencies.get(key)
+        if samples is None or len(samples) < self.min_samples:
+            return None
+        ordered = sorted(samples)
+        return max(self.min_delay, ordered[min(len(ordered) - 1, int(self.percentile * len(ordered)))])
+
+    def observe(self, key: Tuple[str, str], seconds: float) -> None:
+        if key not in self.latencies:
+            self.latencies[key] = deque(maxlen=self.window)
+        self.latencies[key].append(seconds)
+
+    def _allow(self) -> bool:
+        return self.hedges + 1 <= self.max_rate * self.calls
+
+    async def run(
+        self,
+        key: Tuple[str, str],
+        send: Callable[[], Awaitable[Any]],
+        tokens: int = 0,
+        on_hedge: Optional[Callable[[], bool]] = None,
+    ) -> Any:
+        """Return the first successful result of send(), hedging it once if it is slow.
+
+        `on_hedge` is asked before the duplicate is sent (e.g. to pay for it
+        out of the budget) and can veto it by returning False.
+        """
+        self.calls += 1
+        started = time.monotonic()
+        primary = asyncio.ensure_future(send())
+        tasks = [primary]
+        try:
+            delay = self.delay(key)
+            if delay is not None:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if not done and self._allow() and (on_hedge is None or on_hedge()):
+                    self.hedges += 1
+                    self.extra_tokens += tokens
+                    tasks.append(asyncio.ensure_future(send()))
+            winner = None
+            pending = set(tasks)
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                # A request that failed leaves the answer to the other one, if there is one
+                winner = next((task for task in tasks if task in done and task.exception() is None), None)
+            if winner is None:
+                # Every copy failed: raise the error of the original request
+                return primary.result()
+            elapsed = time.monotonic() - started
+            # The time of a call cut short by its hedge is a lower bound, still better than leaving it out
+            self.observe(key, elapsed)
+            if winner is not primary:
+                self.wins += 1
+                self.cut_seconds += elapsed
+            return winner.result()
+        finally:
+            # The losing copy is cancelled; so is everything if the caller is cancelled
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "hedges": self.hedges,
+            "hedge_wins": self.wins,
+            "extra_tokens": self.extra_tokens,
+            "cut_seconds": round(self.cut_seconds, 1),
+            "delays": {f"{endpoint}/{model}": _round(self.delay((endpoint, model))) for endpoint, model in self.latencies},
+        }
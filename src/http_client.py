@@ -0,0 +1,80 @@
+import importlib
+from typing import Any, Optional
+
+import openai
+
+# The HTTP library of the installed openai release: httpx, or httpx2 (the same
+# Limits / Timeout API) from openai 3.0 on. The pools are built with its classes
+httpx = importlib.import_module(openai.DefaultHttpxClient.__mro__[1].__module__.partition(".")[0])
+
+
+class OpenAIClients:
+    """The OpenAI clients of a run, built once and shared by every generator and stage.
+
+    Each client owns a pooled httpx connection pool, so concurrent requests
+    reuse their keep-alive (and with http2=True multiplexed) TLS connections
+    instead of the module-global openai configuration. Chat completions and
+    image edits get separate pools and timeouts: an edit can take minutes,
+    and a few slow uploads must not hold every connection the chat stages
+    need. base_url=None keeps the openai default (or OPENAI_BASE_URL), e.g.
+    for a proxy or a compatible endpoint.
+    """
+
+    def __init__(
+        self,
+        api_key: str,
+        base_url: Optional[str] = None,
+        max_connections: int = 64,
+        max_keepalive_connections: int = 32,
+        keepalive_expiry: float = 30.0,
+        connect_timeout: float = 10.0,
+        read_timeout: float = 120.0,
+        image_max_connections: int = 16,
+        image_read_timeout: float = 600.0,
+        http2: bool = False,
+    ) -> None:
+        self.api_key = api_key
+        self.base_url = base_url
+        self.http2 = http2
+        chat_limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        image_limits = httpx.Limits(
+            max_connections=image_max_connections,
+            max_keepalive_connections=min(max_keepalive_connections, image_max_connections),
+            keepalive_expiry=keepalive_expiry,
+        )
+        chat_timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        image_timeout = httpx.Timeout(image_read_timeout, connect=connect_timeout)
+        self.chat_client = self._client(chat_limits, chat_timeout)
+        self.async_chat_client = self._async_client(chat_limits, chat_timeout)
+        self.image_client = self._client(image_limits, image_timeout)
+        self.async_image_client = self._async_client(image_limits, image_timeout)
+
+    def _client(self, limits: Any, timeout: Any) -> openai.OpenAI:
+        # Retries are handled by ApiCaller (with Retry-After and the rate limiters), not by the client
+        return openai.OpenAI(
+            api_key=self.api_key,
+            base_url=self.base_url,
+            max_retries=0,
+            timeout=timeout,
+            http_client=openai.DefaultHttpxClient(limits=limits, timeout=timeout, http2=self.http2),
+        )
+
+    def _async_client(self, limits: Any, timeout: Any) -> openai.AsyncOpenAI:
+        return openai.AsyncOpenAI(
+            api_key=self.api_key,
+            base_url=self.base_url,
+            max_retries=0,
+            timeout=timeout,
+            http_client=openai.DefaultAsyncHttpxClient(limits=limits, timeout=timeout, http2=self.http2),
+        )
+
+    async def aclose(self) -> None:
+        """Close every connection pool; call it on the event loop that used the async clients."""
+        self.chat_client.close()
+        self.image_client.close()
+        await self.async_chat_client.close()
+        await self.async_image_client.close()
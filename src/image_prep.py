@@ -0,0 +1,259 @@
+import asyncio
+import base64
+import io
+from collections import OrderedDict
+from concurrent.futures import Executor, Future
+from typing import Any, Dict, Optional, Tuple, Union
+
+from PIL import Image
+
+from .response_cache import ResponseCache
+
+
+# MIME types of the formats the OpenAI vision and image-edit endpoints accept
+FORMAT_MIME = {
+    "JPEG": "image/jpeg",
+    "PNG": "image/png",
+    "WEBP": "image/webp",
+    "GIF": "image/gif",
+}
+
+OUTPUT_FORMATS = ("original", "jpeg", "webp", "png")
+
+# The bytes of an image: a Parquet cell is usually a memoryview of its record batch
+ImageBuffer = Union[bytes, bytearray, memoryview]
+
+
+def image_bytes(img_data: Any) -> ImageBuffer:
+    """Extract the bytes from a Parquet cell (dict with 'bytes', bytes or memoryview)."""
+    if isinstance(img_data, dict) and "bytes" in img_data:
+        return img_data["bytes"]
+    elif isinstance(img_data, (bytes, bytearray, memoryview)):
+        return img_data
+    else:
+        raise TypeError("Unsupported image data format in Parquet")
+
+
+def target_size(width: int, height: int, max_side: Optional[int], detail: Optional[str]) -> Tuple[int, int]:
+    """Size an image is shrunk to: at most max_side, and no larger than the server uses for `detail`."""
+    scale = 1.0
+    if max_side:
+        scale = min(scale, max_side / max(width, height))
+    if detail == "low":
+        scale = min(scale, 512 / max(width, height))
+    elif detail == "high":
+        scale = min(scale, 2048 / max(width, height), 768 / min(width, height))
+    if scale >= 1.0:
+        return width, height
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def convert_image(
+    data: Any,
+    max_side: Optional[int] = None,
+    detail: Optional[str] = None,
+    image_format: str = "original",
+    quality: int = 85,
+) -> Tuple[Optional[bytes], str]:
+    """Decode an image once, downscale and re-encode it; return (bytes, MIME type).
+
+    The bytes are None when the image needs no change: the caller then
+    uploads its own buffer, which is neither copied nor sent back from a
+    worker. A module-level function so that it can run in a process pool.
+    """
+    img = Image.open(io.BytesIO(data))
+    src_format = img.format
+    size = target_size(*img.size, max_side, detail)
+    resize = size != img.size
+
+    # Nothing to do: keep the original bytes, only the MIME label is fixed
+    if not resize and image_format in ("original", (src_format or "").lower()) and src_format in FORMAT_MIME:
+        return None, FORMAT_MIME[src_format]
+
+    if resize:
+        # JPEG can decode straight to a reduced scale, much cheaper than a full decode
+        img.draft("RGB", size)
+        img = img.resize(size, Image.LANCZOS) if img.size != size else img
+
+    out_format = src_format if image_format == "original" else image_format.upper()
+    if out_format not in FORMAT_MIME or out_format == "GIF":
+        out_format = "PNG"
+    if out_format == "JPEG" and img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+    elif img.mode not in ("RGB", "RGBA", "L", "LA"):
+        img = img.convert("RGBA")
+
+    buffer = io.BytesIO()
+    # quality is ignored by the PNG encoder
+    img.save(buffer, format=out_format, quality=quality)
+    return buffer.getvalue(), FORMAT_MIME[out_format]
+
+
+class ImagePreprocessor:
+    """Downscale and re-encode images before they are uploaded.
+
+    The server resizes every image anyway (to 512px for detail="low", to fit
+    2048x768 for detail="high"), so pixels beyond that only cost upload time.
+    Images are shrunk to `max_side` and to the limit of `detail`, re-encoded
+    as JPEG/WebP/PNG when asked, and always labelled with their real MIME
+    type. Results are kept in a small in-memory LRU and, with `cache_dir`,
+    on disk, so the same source image is only resized once across stages.
+    With an `executor` (a ProcessPoolExecutor) the PIL work runs in worker
+    processes, and prefetch() lets it start before the image is needed.
+    """
+
+    def __init__(
+        self,
+        max_side: Optional[int] = None,
+        detail: Optional[str] = None,
+        image_format: str = "original",
+        quality: int = 85,
+        cache_dir: Optional[str] = None,
+        cache_entries: int = 128,
+        executor: Optional[Executor] = None,
+    ) -> None:
+        if image_format not in OUTPUT_FORMATS:
+            raise ValueError(f"image_format must be one of {OUTPUT_FORMATS}, got {image_format!r}")
+        self.max_side = max_side
+        self.detail = detail
+        self.image_format = image_format
+        self.quality = quality
+        self.disk_cache = ResponseCache(cache_dir) if cache_dir else None
+        self.cache_entries = cache_entries
+        self._memory: "OrderedDict[str, Tuple[bytes, str]]" = OrderedDict()
+        # Conversions submitted but not collected yet
+        self._pending: Dict[str, "Future[Tuple[bytes, str]]"] = {}
+        # Optional (process) pool the decoding and encoding run in, off the event loop
+        self.executor = executor
+        self.hits = 0
+        self.converted = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def settings(self) -> Dict[str, Any]:
+        """What an uploaded image depends on besides its bytes."""
+        return {
+            "max_side": self.max_side,
+            "detail": self.detail,
+            "format": self.image_format,
+            "quality": self.quality,
+        }
+
+    def _key(self, data: Any) -> str:
+        return ResponseCache.make_key({"image": data, **self.settings()})
+
+    def _submit(self, data: ImageBuffer, count_hit: bool = True) -> Tuple[str, "Future[Tuple[Optional[bytes], str]]"]:
+        """Start the conversion of an image, or return the one already cached or under way."""
+        key = self._key(data)
+        if key in self._pending:
+            return key, self._pending[key]
+        future: "Future[Tuple[Optional[bytes], str]]"
+        cached = self._lookup(key, count_hit)
+        if cached is not None:
+            future = Future()
+            future.set_result(cached)
+            return key, future
+
+        args = (self.max_side, self.detail, self.image_format, self.quality)
+        if self.executor is not None:
+            # The bytes are copied for the worker process, a memoryview cannot be pickled
+            future = self.executor.submit(convert_image, bytes(data), *args)
+        else:
+            future = Future()
+            future.set_result(convert_image(data, *args))
+        self.converted += 1
+        self.bytes_in += len(data)
+        self._pending[key] = future
+        return key, future
+
+    def _lookup(self, key: str, count_hit: bool = True) -> Optional[Tuple[bytes, str]]:
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            if count_hit:
+                self.hits += 1
+            return self._memory[key]
+        if self.disk_cache is not None:
+            cached = self.disk_cache.get(key)
+            if cached is not None:
+                mime, _, encoded = cached.partition(b"\n")
+                if count_hit:
+                    self.hits += 1
+                self._remember(key, (encoded, mime.decode("ascii")))
+                return self._memory[key]
+        return None
+
+    def _remember(self, key: str, result: Tuple[bytes, str]) -> None:
+        self._memory[key] = result
+        if len(self._memory) > self.cache_entries:
+            self._memory.popitem(last=False)
+
+    def _finish(self, key: str, result: Tuple[Optional[bytes], str], data: ImageBuffer) -> Tuple[ImageBuffer, str]:
+        """Store a finished conversion in the caches (once, on the calling thread).
+
+        An unchanged image is uploaded from `data` and not cached: a memoryview
+        kept in the LRU would pin its whole record batch.
+        """
+        encoded, mime = result
+        if encoded is None:
+            if self._pending.pop(key, None) is not None:
+                self.bytes_out += len(data)
+            return data, mime
+        if self._pending.pop(key, None) is not None:
+            self.bytes_out += len(encoded)
+            self._remember(key, result)
+            if self.disk_cache is not None:
+                self.disk_cache.put(key, mime.encode("ascii") + b"\n" + encoded)
+        return result
+
+    def prefetch(self, img_data: Any) -> None:
+        """Start converting an image in the background, so a later encode() finds it ready."""
+        # The hit is counted when the image is actually used
+        self._submit(image_bytes(img_data), count_hit=False)
+
+    def discard(self, img_data: Any) -> None:
+        """Drop the prefetched conversion of an image that turned out not to be needed."""
+        future = self._pending.pop(self._key(image_bytes(img_data)), None)
+        if future is not None:
+            future.cancel()
+
+    def encode(self, img_data: Any) -> Tuple[ImageBuffer, str]:
+        """Return the (bytes, MIME type) to upload for a Parquet image cell.
+
+        The bytes are the cell's own buffer, not a copy, when the image needs no change.
+        """
+        data = image_bytes(img_data)
+        key, future = self._submit(data)
+        try:
+            result = future.result()
+        except Exception:
+            # A broken image is not kept around, so it can fail again the next time
+            self._pending.pop(key, None)
+            raise
+        return self._finish(key, result, data)
+
+    async def aencode(self, img_data: Any) -> Tuple[ImageBuffer, str]:
+        """Async version of encode; the event loop keeps running while a worker converts the image."""
+        data = image_bytes(img_data)
+        key, future = self._submit(data)
+        try:
+            result = await asyncio.wrap_future(future)
+        except Exception:
+            self._pending.pop(key, None)
+            raise
+        return self._finish(key, result, data)
+
+    def image_url(self, img_data: Any) -> Dict[str, str]:
+        """Build the image_url part of a chat message: a data URL with the real MIME type."""
+        encoded, mime = self.encode(img_data)
+        part = {"url": f"data:{mime};base64,{base64.b64encode(encoded).decode('utf-8')}"}
+        if self.detail:
+            part["detail"] = self.detail
+        return part
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "converted": self.converted,
+            "cache_hits": self.hits,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+        }
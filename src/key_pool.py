@@ -0,0 +1,209 @@
+import json
+import os
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import openai
+
+from .http_client import OpenAIClients
+from .rate_limiter import RateLimits
+
+
+# A key failing with these is taken out of rotation for a long while
+AUTH_ERRORS = (openai.AuthenticationError, openai.PermissionDeniedError)
+# Unreachable or failing endpoints (timeouts are connection errors too): a key is
+# taken out of rotation after SERVER_ERROR_STRIKES of them in a row
+SERVER_ERRORS = (openai.APIConnectionError, openai.InternalServerError)
+SERVER_ERROR_STRIKES = 3
+
+
+def load_key_specs(path: Optional[str], api_key: Optional[str] = None, base_url: Optional[str] = None) -> List[Dict[str, Any]]:
+    """The keys of an --api-keys-file, or the single --api-key when no file is given.
+
+    One JSON object per line:
+        {"name": "team-a", "api_key_env": "OPENAI_KEY_A", "weight": 2,
+         "base_url": "https://...", "limits": {"gpt-4o": {"rpm": 5000, "tpm": 800000}}}
+    "api_key" may hold the key itself; name, base_url (default --base-url),
+    weight (default 1) and limits (default --rpm / --tpm ...) are optional.
+    """
+    if path is None:
+        if api_key is None:
+            raise ValueError("an API key is required: pass --api-key or --api-keys-file")
+        return [{"name": "default", "api_key": api_key, "base_url": base_url}]
+    specs = []
+    with open(path, "r", encoding="utf-8") as fin:
+        for line in fin:
+            line = line.strip()
+            if not line:
+                continue
+            spec = json.loads(line)
+            if "api_key" not in spec:
+                spec["api_key"] = os.environ[spec["api_key_env"]]
+            spec.setdefault("name", f"key-{len(specs)}")
+            spec.setdefault("base_url", base_url)
+            specs.append(spec)
+    if not specs:
+        raise ValueError(f"no API keys in {path}")
+    return specs
+
+
+class PooledKey:
+    """One API key (and endpoint) of the pool: its clients, rate limiters and health."""
+
+    def __init__(self, name: str, clients: OpenAIClients, rate_limits: RateLimits, weight: float = 1.0) -> None:
+        self.name = name
+        self.clients = clients
+        self.rate_limits = rate_limits
+        self.weight = weight
+        # Smooth weighted round-robin state
+        self.current = 0.0
+        self.suspended_until = 0.0
+        # Consecutive 429s, the rotation pause doubles with each of them
+        self.strikes = 0
+        # Consecutive connection errors, timeouts and 5xx
+        self.failures = 0
+        self.requests = 0
+        self.rate_limited = 0
+        self.auth_errors = 0
+        self.server_errors = 0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "requests": self.requests,
+            "rate_limited": self.rate_limited,
+            "auth_errors": self.auth_errors,
+            "server_errors": self.server_errors,
+            "suspended_seconds": round(max(0.0, self.suspended_until - time.monotonic()), 1),
+            "limits": self.rate_limits.stats(),
+        }
+
+
+class KeyPool:
+    """Spread the requests of a run over several API keys / compatible endpoints.
+
+    Every key has its own clients and rate limiters, so the combined
+    throughput grows with the number of keys. Each request goes to a key by
+    smooth weighted round-robin, the weight being the key's weight times the
+    headroom left in its budget for the model, so the keys with the most
+    room get the most requests. A key answering 429 is taken out of rotation
+    for its Retry-After (or a pause doubling with every consecutive 429), one
+    failing authentication for `auth_cooldown` seconds, and one whose
+    endpoint failed SERVER_ERROR_STRIKES times in a row (connection error,
+    timeout or 5xx) for `error_cooldown` seconds; the request is retried on
+    another key right away. A pool of one key behaves like the single
+    --api-key before.
+    """
+
+    def __init__(
+        self,
+        keys: List[PooledKey],
+        auth_cooldown: float = 600.0,
+        rate_limit_cooldown: float = 5.0,
+        max_cooldown: float = 300.0,
+        error_cooldown: float = 60.0,
+    ) -> None:
+        self.keys = keys
+        self.auth_cooldown = auth_cooldown
+        self.error_cooldown = error_cooldown
+        self.rate_limit_cooldown = rate_limit_cooldown
+        self.max_cooldown = max_cooldown
+
+    @classmethod
+    def from_specs(
+        cls,
+        specs: List[Dict[str, Any]],
+        budgets: Optional[Dict[str, Tuple[Optional[float], Optional[float]]]] = None,
+        client_options: Optional[Dict[str, Any]] = None,
+        auth_cooldown: float = 600.0,
+        error_cooldown: float = 60.0,
+    ) -> "KeyPool":
+        """Build the pool of load_key_specs(); `budgets` are the per-model limits of keys without their own."""
+        keys = []
+        for spec in specs:
+            key_budgets = dict(budgets or {})
+            for model, limits in spec.get("limits", {}).items():
+                key_budgets[model] = (limits.get("rpm"), limits.get("tpm"))
+            keys.append(PooledKey(
+                spec["name"],
+                OpenAIClients(spec["api_key"], base_url=spec.get("base_url"), **(client_options or {})),
+                RateLimits(key_budgets),
+                weight=float(spec.get("weight", 1.0)),
+            ))
+        return cls(keys, auth_cooldown=auth_cooldown, error_cooldown=error_cooldown)
+
+    @classmethod
+    def single(cls, clients: OpenAIClients, rate_limits: Optional[RateLimits] = None) -> "KeyPool":
+        return cls([PooledKey("default", clients, rate_limits if rate_limits is not None else RateLimits())])
+
+    @property
+    def primary(self) -> PooledKey:
+        """The first key, used for what must stay on one account (Batch API files and batches)."""
+        return self.keys[0]
+
+    def available(self) -> List[PooledKey]:
+        now = time.monotonic()
+        return [key for key in self.keys if key.suspended_until <= now]
+
+    def healthy(self, exclude: Optional[PooledKey] = None) -> List[PooledKey]:
+        """The keys in rotation whose last request did not fail with a server error, other than `exclude`."""
+        return [key for key in self.available() if key is not exclude and not key.failures]
+
+    def pick(self, model: str, avoid: Optional[PooledKey] = None) -> Tuple[PooledKey, float]:
+        """The key for the next request of `model`, and how long to wait before it may be used.
+
+        `avoid` (the key a retried request just failed on) is only picked when no other key is in rotation.
+        """
+        available = self.available()
+        if avoid is not None and len(available) > 1:
+            available = [key for key in available if key is not avoid]
+        if not available:
+            # Every key is out of rotation: use the one coming back first
+            key = min(self.keys, key=lambda k: k.suspended_until)
+            return key, key.suspended_until - time.monotonic()
+        if len(available) == 1:
+            return available[0], 0.0
+        total = 0.0
+        best = None
+        for key in available:
+            # A key without headroom keeps a small share, its limiter makes the request wait
+            effective = key.weight * max(key.rate_limits.get(model).headroom(), 0.01)
+            key.current += effective
+            total += effective
+            if best is None or key.current > best.current:
+                best = key
+        best.current -= total
+        return best, 0.0
+
+    def on_success(self, key: PooledKey) -> None:
+        key.strikes = 0
+        key.failures = 0
+
+    def on_rate_limited(self, key: PooledKey, retry_after: Optional[float]) -> None:
+        key.rate_limited += 1
+        key.strikes += 1
+        if len(self.keys) > 1:
+            pause = retry_after if retry_after is not None else self.rate_limit_cooldown * 2 ** (key.strikes - 1)
+            self._suspend(key, min(self.max_cooldown, pause))
+
+    def on_auth_error(self, key: PooledKey) -> None:
+        key.auth_errors += 1
+        self._suspend(key, self.auth_cooldown)
+        print(f"API key {key.name} failed authentication, out of rotation for {self.auth_cooldown:.0f}s\n")
+
+    def on_server_error(self, key: PooledKey) -> None:
+        key.server_errors += 1
+        key.failures += 1
+        # Requests already in flight on a suspended key do not suspend it again
+        if len(self.keys) > 1 and key.failures >= SERVER_ERROR_STRIKES and key.suspended_until <= time.monotonic():
+            self._suspend(key, self.error_cooldown)
+            print(f"API key {key.name} failed {key.failures} requests in a row, out of rotation for {self.error_cooldown:.0f}s\n")
+
+    def _suspend(self, key: PooledKey, seconds: float) -> None:
+        key.suspended_until = max(key.suspended_until, time.monotonic() + seconds)
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {key.name: key.stats() for key in self.keys}
+
+    async def aclose(self) -> None:
+        for key in self.keys:
+            await key.clients.aclose()
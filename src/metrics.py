@@ -0,0 +1,232 @@
+import json
+import multiprocessing
+import os
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+def payload_bytes(messages: List[dict]) -> int:
+    """Approximate request size of a chat payload: its text and data-URL lengths."""
+    size = 0
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, str):
+            size += len(content)
+            continue
+        for part in content:
+            if part.get("type") == "text":
+                size += len(part["text"])
+            elif part.get("type") == "image_url":
+                size += len(part["image_url"]["url"])
+    return size
+
+
+def _labels(labels: Dict[str, str]) -> str:
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels.items()) + "}"
+
+
+def _quantile(ordered: List[float], q: float) -> float:
+    return ordered[min(len(ordered) - 1, round(q * (len(ordered) - 1)))]
+
+
+class _Aggregate:
+    """Counters of one shard or of the whole run."""
+
+    def __init__(self) -> None:
+        # (endpoint, model) -> counters; latencies are kept to report quantiles
+        self.requests: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        # phase -> [seconds, count]
+        self.phases: Dict[str, List[float]] = {}
+        self.started = time.time()
+
+    def _entry(self, endpoint: str, model: str) -> Dict[str, Any]:
+        key = (endpoint, model)
+        if key not in self.requests:
+            self.requests[key] = {
+                "requests": 0,
+                "cached": 0,
+                "errors": {},
+                "payload_bytes": 0,
+                "prompt_tokens": 0,
+                "completion_tokens": 0,
+                "latencies": [],
+            }
+        return self.requests[key]
+
+    def as_dict(self) -> Dict[str, Any]:
+        requests = []
+        for (endpoint, model), entry in sorted(self.requests.items()):
+            ordered = sorted(entry["latencies"])
+            requests.append({
+                "endpoint": endpoint,
+                "model": model,
+                **{k: v for k, v in entry.items() if k != "latencies"},
+                "latency_seconds": {
+                    "count": len(ordered),
+                    "sum": round(sum(ordered), 4),
+                    **({f"p{round(q * 100)}": round(_quantile(ordered, q), 4) for q in QUANTILES} if ordered else {}),
+                },
+            })
+        return {
+            "wall_seconds": round(time.time() - self.started, 3),
+            "requests": requests,
+            "phases": {
+                phase: {"seconds": round(seconds, 4), "count": int(count)}
+                for phase, (seconds, count) in sorted(self.phases.items())
+            },
+        }
+
+
+class Metrics:
+    """Per-request and per-phase instrumentation of one run_* process.
+
+    ApiCaller reports every API attempt (latency, payload bytes, tokens from
+    response.usage, error type) and every answer served from the cache; the
+    scripts and generators time their read / encode / write phases with
+    span() and timed(). Counters are kept per shard, written as a JSON
+    summary when the shard is finished, and for the whole run, exported as a
+    Prometheus textfile.
+    """
+
+    def __init__(self, stage: str) -> None:
+        self.stage = stage
+        self.shard = _Aggregate()
+        self.run = _Aggregate()
+
+    def _both(self) -> Tuple[_Aggregate, _Aggregate]:
+        return self.shard, self.run
+
+    def record_request(
+        self,
+        endpoint: str,
+        model: str,
+        seconds: float,
+        payload: int,
+        usage: Any = None,
+        error: Optional[BaseException] = None,
+    ) -> None:
+        # Chat completions report prompt/completion tokens, image edits input/output tokens
+        prompt = getattr(usage, "prompt_tokens", None) or getattr(usage, "input_tokens", None) or 0
+        completion = getattr(usage, "completion_tokens", None) or getattr(usage, "output_tokens", None) or 0
+        for aggregate in self._both():
+            entry = aggregate._entry(endpoint, model)
+            entry["requests"] += 1
+            entry["payload_bytes"] += payload
+            entry["latencies"].append(seconds)
+            if error is not None:
+                name = type(error).__name__
+                entry["errors"][name] = entry["errors"].get(name, 0) + 1
+            else:
+                entry["prompt_tokens"] += prompt
+                entry["completion_tokens"] += completion
+
+    def record_cached(self, endpoint: str, model: str) -> None:
+        for aggregate in self._both():
+            aggregate._entry(endpoint, model)["cached"] += 1
+
+    def add_phase(self, phase: str, seconds: float) -> None:
+        for aggregate in self._both():
+            totals = aggregate.phases.setdefault(phase, [0.0, 0])
+            totals[0] += seconds
+            totals[1] += 1
+
+    @contextmanager
+    def span(self, phase: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase(phase, time.perf_counter() - started)
+
+    def timed(self, iterable: Iterable[Any], phase: str) -> Iterator[Any]:
+        """Iterate, counting the time spent producing every item (e.g. reading a parquet batch) as `phase`."""
+        iterator = iter(iterable)
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.add_phase(phase, time.perf_counter() - started)
+            yield item
+
+    def finish_shard(self, summary_path: Path, shard: str) -> Dict[str, Any]:
+        """Write the JSON summary of the shard just processed and start counting the next one."""
+        summary = {"stage": self.stage, "shard": shard, **self.shard.as_dict()}
+        _write_atomic(summary_path, json.dumps(summary, indent=2))
+        self.shard = _Aggregate()
+        return summary
+
+    def summary(self) -> Dict[str, Any]:
+        return {"stage": self.stage, **self.run.as_dict()}
+
+    def write_prometheus(self, path: str) -> None:
+        """Export the run totals in the Prometheus text format (for node_exporter's textfile collector)."""
+        write_prometheus(path, [self])
+
+
+def write_prometheus(path: str, metrics: List[Metrics]) -> None:
+    """Export the run totals of one or more stages (run_pipeline) to a Prometheus textfile.
+
+    The processes started by --workers each write their own file,
+    run_1.prom becoming run_1.worker-0.prom, run_1.worker-1.prom, ...
+    """
+    path = Path(path)
+    worker = multiprocessing.current_process().name
+    if worker != "MainProcess":
+        path = path.with_name(f"{path.stem}.{worker}{path.suffix}")
+    lines = []
+
+    def metric(name: str, kind: str, help_text: str, samples: List[Tuple[Dict[str, str], float]]) -> None:
+        lines.append(f"# HELP dataset_yx_{name} {help_text}")
+        lines.append(f"# TYPE dataset_yx_{name} {kind}")
+        for labels, value in samples:
+            lines.append(f"dataset_yx_{name}{_labels(labels)} {value}")
+
+    base = [
+        ({"stage": m.stage, "endpoint": endpoint, "model": model}, entry)
+        for m in metrics
+        for (endpoint, model), entry in sorted(m.run.requests.items())
+    ]
+    phases = [
+        ({"stage": m.stage, "phase": phase}, totals)
+        for m in metrics
+        for phase, totals in sorted(m.run.phases.items())
+    ]
+    metric("requests_total", "counter", "API request attempts sent",
+           [(labels, entry["requests"]) for labels, entry in base])
+    metric("cached_answers_total", "counter", "Answers served from the response cache or batch results",
+           [(labels, entry["cached"]) for labels, entry in base])
+    metric("request_errors_total", "counter", "Failed API request attempts by error type",
+           [({**labels, "error": error}, count) for labels, entry in base for error, count in sorted(entry["errors"].items())])
+    metric("payload_bytes_total", "counter", "Request payload bytes sent",
+           [(labels, entry["payload_bytes"]) for labels, entry in base])
+    metric("tokens_total", "counter", "Tokens reported by response.usage",
+           [({**labels, "kind": kind}, entry[f"{kind}_tokens"]) for labels, entry in base for kind in ("prompt", "completion")])
+    latency_samples = []
+    for labels, entry in base:
+        ordered = sorted(entry["latencies"])
+        if ordered:
+            latency_samples += [({**labels, "quantile": str(q)}, round(_quantile(ordered, q), 6)) for q in QUANTILES]
+    metric("request_seconds", "summary", "API request latency", latency_samples)
+    for labels, entry in base:
+        lines.append(f"dataset_yx_request_seconds_sum{_labels(labels)} {round(sum(entry['latencies']), 6)}")
+        lines.append(f"dataset_yx_request_seconds_count{_labels(labels)} {len(entry['latencies'])}")
+    metric("phase_seconds_total", "counter", "Time spent per phase (read, encode, write, ...)",
+           [(labels, round(seconds, 6)) for labels, (seconds, _) in phases])
+    metric("phase_count_total", "counter", "Number of timed spans per phase",
+           [(labels, int(count)) for labels, (_, count) in phases])
+    _write_atomic(path, "\n".join(lines) + "\n")
+
+
+def _write_atomic(path: Path, text: str) -> None:
+    # A scraper or the next stage never sees half a file
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    tmp_path.write_text(text, encoding="utf-8")
+    os.replace(tmp_path, path)
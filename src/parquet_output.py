@@ -0,0 +1,248 @@
+import base64
+import json
+import os
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Set
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from .checkpoint import CheckpointWriter, RowCounter, RowId, load_done_provenance, load_done_rows
+from .parquet_stream import iter_jsonal
+from .provenance import PROVENANCE_SUFFIX
+
+
+OUTPUT_FORMATS = ("jsonal", "parquet")
+KEY_COLUMNS = ("source", "target")
+# step_edited, step_edited_2, ...: the images of stage 3
+STEP_IMAGE_COLUMN = "step_edited"
+# Schema metadata listing the columns that hold JSON text (numbered dicts or raw answers)
+JSON_COLUMNS_KEY = b"json_columns"
+
+
+class RawJson(str):
+    """JSON text of a column a stage does not use, written back to parquet without being decoded."""
+
+
+def _is_binary(value: Any) -> bool:
+    return isinstance(value, (bytes, bytearray, memoryview))
+
+
+def _row_ids(table: pa.Table) -> List[RowId]:
+    rows = RowCounter()
+    return [rows.number(source, target) for source, target in zip(table.column("source").to_pylist(), table.column("target").to_pylist())]
+
+
+class ParquetRecordWriter:
+    """Write stage records to a compressed parquet file, one row group at a time.
+
+    Drop-in replacement of CheckpointWriter for --output-format parquet.
+    source/target are string columns, image bytes (step_edited) binary
+    columns and every other value JSON text, so the numbered dicts and the
+    raw-string fallbacks of the .jsonal records fit in one column type.
+
+    Records are buffered and flushed as a row group every `row_group_size`
+    rows. The file is written as <name>.partial and renamed when closed, also
+    when the stage fails with an exception; only a hard kill loses the rows of
+    the current run. With resume=True the rows of the existing file are
+    copied first and reported by is_done(). With a provenance_field
+    (--incremental) only the existing rows keep() accepts count as done; when
+    the writer is closed the recomputed rows take the place of the ones they
+    replace, in shard order.
+    """
+
+    def __init__(
+        self,
+        output_path: Path,
+        resume: bool = False,
+        row_group_size: int = 64,
+        compression: str = "zstd",
+        provenance_field: Optional[str] = None,
+    ) -> None:
+        self.output_path = output_path
+        self.partial_path = output_path.with_name(f"{output_path.name}.partial")
+        self.row_group_size = row_group_size
+        self.compression = compression
+        self.done: Set[RowId] = set()
+        self.previous: Dict[RowId, Optional[str]] = {}
+        self.provenance_field = provenance_field
+        # Rows written by this run, in order, when they may replace existing ones
+        self.written: List[RowId] = []
+        self.existing: Optional[pa.Table] = None
+        self.buffer: List[Dict[str, Any]] = []
+        self.schema: Optional[pa.Schema] = None
+        self.writer: Optional[pq.ParquetWriter] = None
+        existing = pq.read_table(output_path) if resume and output_path.exists() else None
+        if existing is not None and existing.num_rows and provenance_field:
+            if provenance_field in existing.column_names:
+                self.previous = dict(zip(_row_ids(existing), existing.column(provenance_field).to_pylist()))
+                self.existing = existing
+                print(f"Checking {output_path}: {len(self.previous)} rows against their current inputs\n")
+                self._open(existing.schema)
+            else:
+                print(f"{output_path} has no {provenance_field} column, recomputing all of its rows\n")
+        elif existing is not None and existing.num_rows:
+            self.done = set(_row_ids(existing))
+            print(f"Resuming {output_path}: {len(self.done)} rows already done\n")
+            self._open(existing.schema)
+            self.writer.write_table(existing, row_group_size=row_group_size)
+
+    def _open(self, schema: pa.Schema) -> None:
+        self.schema = schema
+        self.json_columns = set(json.loads((schema.metadata or {}).get(JSON_COLUMNS_KEY, b"[]")))
+        self.writer = pq.ParquetWriter(self.partial_path, schema, compression=self.compression)
+
+    def _schema_for(self, record: Dict[str, Any]) -> pa.Schema:
+        fields = []
+        json_columns = []
+        for name, value in record.items():
+            if name in KEY_COLUMNS or name.endswith(PROVENANCE_SUFFIX):
+                fields.append(pa.field(name, pa.string()))
+            elif _is_binary(value) or (value is None and name.startswith(STEP_IMAGE_COLUMN)):
+                # A chain shorter than --edit-steps leaves its last step image columns empty
+                fields.append(pa.field(name, pa.binary()))
+            else:
+                fields.append(pa.field(name, pa.string()))
+                json_columns.append(name)
+        return pa.schema(fields, metadata={JSON_COLUMNS_KEY: json.dumps(json_columns).encode("utf-8")})
+
+    def _row(self, record: Dict[str, Any]) -> Dict[str, Any]:
+        row = {}
+        for name, value in record.items():
+            if value is None or name not in self.json_columns:
+                row[name] = bytes(value) if isinstance(value, memoryview) else value
+            elif isinstance(value, RawJson):
+                row[name] = str(value)
+            else:
+                row[name] = json.dumps(value, ensure_ascii=False)
+        return row
+
+    def is_done(self, row: RowId) -> bool:
+        return row in self.done
+
+    def keep(self, row: RowId, provenance: str) -> bool:
+        """Count an existing row as done if it was made from the same inputs as it would be now."""
+        if row in self.previous and self.previous[row] == provenance:
+            self.done.add(row)
+        return row in self.done
+
+    def write(self, record: Dict[str, Any], row: Optional[RowId] = None) -> None:
+        """Buffer one record; `row` is needed with --incremental."""
+        if self.writer is None:
+            self._open(self._schema_for(record))
+        self.buffer.append(self._row(record))
+        if self.existing is not None:
+            self.written.append(row)
+        if len(self.buffer) >= self.row_group_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """Write the buffered records as one row group."""
+        if self.buffer:
+            self.writer.write_table(pa.Table.from_pylist(self.buffer, schema=self.schema), row_group_size=len(self.buffer))
+            self.buffer = []
+
+    def close(self) -> None:
+        if self.writer is None:
+            # No rows at all: still leave a (key-only) file for the next stage
+            self._open(pa.schema([pa.field(name, pa.string()) for name in KEY_COLUMNS]))
+        self.flush()
+        self.writer.close()
+        if self.existing is not None:
+            self._merge()
+        os.replace(self.partial_path, self.output_path)
+
+    def _merge(self) -> None:
+        """Rewrite the partial file as the existing rows, the recomputed ones in their place and the new ones at the end."""
+        replaced = sum(1 for row in self.written if row in self.previous)
+        print(f"{self.output_path}: {len(self.previous) - replaced} rows kept, {replaced} recomputed\n")
+        changes = pq.read_table(self.partial_path)
+        base = self.existing.num_rows
+        position = {row: base + k for k, row in enumerate(self.written)}
+        order = [position.pop(row, i) for i, row in enumerate(_row_ids(self.existing))]
+        order.extend(position.values())
+        merged = pa.concat_tables([self.existing, changes]).take(pa.array(order, type=pa.int64()))
+        pq.write_table(merged, self.partial_path, row_group_size=self.row_group_size, compression=self.compression)
+
+    def __enter__(self) -> "ParquetRecordWriter":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.close()
+
+
+def output_path_for(output_dir: str, shard: str, output_format: str) -> Path:
+    """The output file of a shard: 00012.jsonal or 00012.parquet."""
+    return Path(f"{output_dir}/{shard}.{output_format}")
+
+
+def open_stage_writer(
+    output_path: Path,
+    resume: bool = False,
+    row_group_size: int = 64,
+    compression: str = "zstd",
+    provenance_field: Optional[str] = None,
+) -> Any:
+    """A ParquetRecordWriter for .parquet outputs, a CheckpointWriter otherwise."""
+    if output_path.suffix == ".parquet":
+        return ParquetRecordWriter(output_path, resume=resume, row_group_size=row_group_size, compression=compression, provenance_field=provenance_field)
+    return CheckpointWriter(output_path, resume=resume, provenance_field=provenance_field)
+
+
+def stage_done_rows(output_path: Path) -> Set[RowId]:
+    """The rows already in a stage output of either format."""
+    if output_path.suffix == ".parquet":
+        return set(_row_ids(pq.read_table(output_path, columns=list(KEY_COLUMNS))))
+    return load_done_rows(output_path)
+
+
+def stage_done_provenance(output_path: Path, field: str) -> Dict[RowId, Optional[str]]:
+    """The `field` provenance of every row already in a stage output of either format (None if missing)."""
+    if output_path.suffix == ".parquet":
+        table = pq.read_table(output_path)
+        values = table.column(field).to_pylist() if field in table.column_names else [None] * table.num_rows
+        return dict(zip(_row_ids(table), values))
+    return load_done_provenance(output_path, field)
+
+
+def find_stage_input(input_dir: str, shard: str) -> Path:
+    """The previous stage's output of a shard, whichever format it was written in."""
+    parquet_path = Path(f"{input_dir}/{shard}.parquet")
+    return parquet_path if parquet_path.exists() else Path(f"{input_dir}/{shard}.jsonal")
+
+
+def iter_stage_records(
+    input_path: Path,
+    decode: Optional[Set[str]] = None,
+    passthrough: bool = False,
+    columns: Optional[List[str]] = None,
+    batch_size: int = 256,
+) -> Iterator[Dict[str, Any]]:
+    """Lazily yield the records of a previous stage's output, .jsonal or .parquet.
+
+    For parquet inputs with passthrough=True (the stage writes parquet too),
+    only the JSON columns in `decode` are parsed; the others stay RawJson
+    text and binary columns stay bytes, so they are copied to the output
+    as they are. Otherwise every record looks exactly like its .jsonal
+    version, binary columns as base64 strings. `columns` restricts a
+    parquet input to the given columns (e.g. for analysis jobs).
+    """
+    if input_path.suffix != ".parquet":
+        yield from iter_jsonal(input_path)
+        return
+    parquet_file = pq.ParquetFile(input_path)
+    metadata = parquet_file.schema_arrow.metadata or {}
+    json_columns = set(json.loads(metadata[JSON_COLUMNS_KEY])) if JSON_COLUMNS_KEY in metadata else set()
+    binary_columns = {field.name for field in parquet_file.schema_arrow if pa.types.is_binary(field.type)}
+    for batch in parquet_file.iter_batches(batch_size=batch_size, columns=columns):
+        values_by_name = {name: batch.column(k).to_pylist() for k, name in enumerate(batch.schema.names)}
+        for i in range(batch.num_rows):
+            record = {}
+            for name, values in values_by_name.items():
+                value = values[i]
+                if value is not None and name in json_columns:
+                    value = RawJson(value) if passthrough and decode is not None and name not in decode else json.loads(value)
+                elif value is not None and name in binary_columns and not passthrough:
+                    value = base64.b64encode(value).decode("utf-8")
+                record[name] = value
+            yield record
@@ -0,0 +1,95 @@
+import json
+from itertools import islice
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+class ParquetStreamReader:
+    """Read a parquet shard batch by batch instead of loading it whole.
+
+    Only one record batch (at most `batch_size` rows) is decoded at a time, so
+    memory stays flat no matter how large the shard is.
+    """
+
+    def __init__(
+        self,
+        parquet_path: str,
+        batch_size: int = 64,
+        columns: Optional[List[str]] = None,
+    ) -> None:
+        self.parquet_path = parquet_path
+        self.batch_size = batch_size
+        self.columns = columns
+        self.parquet_file = pq.ParquetFile(parquet_path)
+
+    @property
+    def num_rows(self) -> int:
+        return self.parquet_file.metadata.num_rows
+
+    def describe(self) -> str:
+        """Short summary of the shard, printed instead of df.info()."""
+        metadata = self.parquet_file.metadata
+        columns = ", ".join(self.columns) if self.columns else "all"
+        return (
+            f"{self.parquet_path}: {metadata.num_rows} rows, "
+            f"{metadata.num_row_groups} row groups, reading columns: {columns}\n"
+            f"{self.parquet_file.schema_arrow}"
+        )
+
+    def iter_batches(self) -> Iterator[pa.RecordBatch]:
+        yield from self.parquet_file.iter_batches(
+            batch_size=self.batch_size, columns=self.columns
+        )
+
+
+def struct_field(batch: pa.RecordBatch, column_name: str, field_name: str) -> List[Any]:
+    """Return one field ('bytes' or 'path') of an image struct column as a list."""
+    column = batch.column(batch.schema.get_field_index(column_name))
+    return column.field(field_name).to_pylist()
+
+
+def binary_views(array: pa.Array) -> List[Optional[memoryview]]:
+    """Slice a binary array into per-row memoryviews without copying.
+
+    Each view points straight into the Arrow data buffer, so image payloads
+    can go to base64.b64encode / io.BytesIO without an intermediate bytes copy.
+    The views keep the underlying buffer alive.
+    """
+    offset_format = "q" if pa.types.is_large_binary(array.type) else "i"
+    _, offsets_buffer, data_buffer = array.buffers()
+    offsets = memoryview(offsets_buffer).cast("B").cast(offset_format)
+    data = memoryview(data_buffer).cast("B") if data_buffer is not None else memoryview(b"")
+    valid = array.is_valid().to_pylist() if array.null_count else None
+
+    views = []
+    for i in range(len(array)):
+        if valid is not None and not valid[i]:
+            views.append(None)
+            continue
+        start = offsets[array.offset + i]
+        end = offsets[array.offset + i + 1]
+        views.append(data[start:end])
+    return views
+
+
+def struct_field_views(batch: pa.RecordBatch, column_name: str, field_name: str = "bytes") -> List[Optional[memoryview]]:
+    """Zero-copy version of struct_field for the binary 'bytes' field of an image column."""
+    column = batch.column(batch.schema.get_field_index(column_name))
+    return binary_views(column.field(field_name))
+
+
+def iter_jsonal(input_path: Path) -> Iterator[Dict[str, Any]]:
+    """Lazily yield the records of a .jsonal file, one line at a time."""
+    with input_path.open("r", encoding="utf-8") as fin:
+        for line in fin:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def take(iterator: Iterator[Any], n: int) -> List[Any]:
+    """Take the next n items of an iterator (fewer if it runs out)."""
+    return list(islice(iterator, n))
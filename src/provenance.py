@@ -0,0 +1,34 @@
+import json
+from typing import Any
+
+from .dedup import content_key
+
+
+# Every stage adds <stage>_provenance to its records (difference_provenance,
+# instruction_provenance, ...), next to those of the stages before it
+PROVENANCE_SUFFIX = "_provenance"
+
+
+def provenance_field(stage: str) -> str:
+    return f"{stage}{PROVENANCE_SUFFIX}"
+
+
+class Provenance:
+    """Hash of everything a stage record was made from, for --incremental reruns.
+
+    The settings every row of a run shares (model, prompt template, answer
+    format, upload settings) are hashed once; of() adds what is particular to
+    a row: the upstream record's provenance and the values read from it, and
+    the image bytes. A record whose hash still matches its current inputs
+    would be made the same way again, so an incremental run keeps it; one
+    whose prompt, model, upstream record or image changed is recomputed.
+    """
+
+    def __init__(self, stage: str, **settings: Any) -> None:
+        self.stage = stage
+        self.field = provenance_field(stage)
+        self.fingerprint = content_key("provenance", stage, json.dumps(settings, sort_keys=True, ensure_ascii=False, default=str))
+
+    def of(self, *inputs: Any) -> str:
+        """Provenance hash of one record; `inputs` are texts, image bytes or None (a missing upstream hash)."""
+        return content_key(self.fingerprint, *inputs)
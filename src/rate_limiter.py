@@ -0,0 +1,286 @@
+import asyncio
+import base64
+import binascii
+import email.utils
+import io
+import math
+import random
+import re
+import time
+from typing import Any, Dict, List, Mapping, Optional, Tuple
+
+import openai
+from PIL import Image
+
+
+# Errors worth retrying: quota (429), timeouts, dropped connections and 5xx
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+)
+
+# Token cost of one image in a chat request whose size cannot be read (a high-detail 1024px image)
+IMAGE_TOKENS_ESTIMATE = 765
+# Flat token cost of a detail="low" image
+LOW_DETAIL_IMAGE_TOKENS = 85
+# (base, per 512px tile) image tokens of the models that do not use the gpt-4o ones
+VISION_TOKENS = {
+    "gpt-4o-mini": (2833, 5667),
+    "gpt-image-1": (65, 129),
+}
+# Enough base64 of a data URL to reach the image header (and a JPEG's EXIF before it)
+HEADER_CHARS = 64 * 1024
+
+
+def image_size(data: Any) -> Optional[Tuple[int, int]]:
+    """Width and height from the image header, without decoding the pixels."""
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            return img.size
+    except (OSError, ValueError):
+        return None
+
+
+def data_url_size(url: str) -> Optional[Tuple[int, int]]:
+    """Width and height of a base64 data URL image, reading only its first bytes when possible."""
+    encoded = url.partition(",")[2]
+    try:
+        size = image_size(base64.b64decode(encoded[:HEADER_CHARS]))
+        if size is None and len(encoded) > HEADER_CHARS:
+            size = image_size(base64.b64decode(encoded))
+    except (binascii.Error, ValueError):
+        return None
+    return size
+
+
+def vision_tokens(width: int, height: int, detail: Optional[str] = None, model: str = "") -> int:
+    """Input tokens of one image: fit in 2048x2048, shortest side to 768px, then per 512px tile."""
+    base, per_tile = next((tokens for name, tokens in VISION_TOKENS.items() if model.startswith(name)), (85, 170))
+    if detail == "low":
+        return base
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return base + per_tile * math.ceil(width / 512) * math.ceil(height / 512)
+
+
+def estimate_chat_tokens(messages: List[dict], model: str = "") -> int:
+    """Cheap pre-flight token estimate of a chat request: ~4 characters per token, images by their size."""
+    chars = 0
+    image_tokens = 0
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, str):
+            chars += len(content)
+            continue
+        for part in content:
+            if part.get("type") == "text":
+                chars += len(part["text"])
+            elif part.get("type") == "image_url":
+                detail = part["image_url"].get("detail")
+                size = data_url_size(part["image_url"]["url"])
+                if size is not None:
+                    image_tokens += vision_tokens(*size, detail, model)
+                else:
+                    image_tokens += LOW_DETAIL_IMAGE_TOKENS if detail == "low" else IMAGE_TOKENS_ESTIMATE
+    return chars // 4 + image_tokens
+
+
+def parse_duration(value: str) -> Optional[float]:
+    """Parse the x-ratelimit-reset-* format, e.g. '1s', '6m0s' or '250ms', into seconds."""
+    total = 0.0
+    matched = False
+    for amount, unit in re.findall(r"([\d.]+)(ms|s|m|h)", value):
+        matched = True
+        total += float(amount) * {"ms": 0.001, "s": 1, "m": 60, "h": 3600}[unit]
+    return total if matched else None
+
+
+def retry_after_seconds(exc: BaseException) -> Optional[float]:
+    """Read the Retry-After hint of a failed request, if the server sent one."""
+    response = getattr(exc, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    retry_after = headers.get("retry-after")
+    if not retry_after:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        pass
+    # HTTP-date form
+    parsed = email.utils.parsedate_to_datetime(retry_after)
+    if parsed is None:
+        return None
+    return max(0.0, parsed.timestamp() - time.time())
+
+
+def backoff_delay(attempt: int, base: float = 1.0, cap: float = 60.0, retry_after: Optional[float] = None) -> float:
+    """Full-jitter exponential backoff, never shorter than the server's Retry-After."""
+    delay = random.uniform(0, min(cap, base * 2 ** attempt))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+
+class RateLimiter:
+    """Token-bucket limiter with request/minute and token/minute budgets for one model.
+
+    The buckets refill continuously at budget/60 per second. The effective
+    rate is scaled down after every 429 and recovers slowly on success, the
+    buckets are lowered to the server's x-ratelimit-remaining-* counts when
+    those are smaller, and a Retry-After pauses all requests of the model.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        requests_per_minute: Optional[float] = None,
+        tokens_per_minute: Optional[float] = None,
+    ) -> None:
+        self.name = name
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.request_level = requests_per_minute or 0.0
+        self.token_level = tokens_per_minute or 0.0
+        self.scale = 1.0
+        self.paused_until = 0.0
+        self.updated = time.monotonic()
+        self.rate_limited = 0
+        self.retries = 0
+
+    def _refill(self, now: float) -> None:
+        elapsed = now - self.updated
+        self.updated = now
+        if self.requests_per_minute:
+            self.request_level = min(
+                self.requests_per_minute,
+                self.request_level + elapsed * self.requests_per_minute * self.scale / 60,
+            )
+        if self.tokens_per_minute:
+            self.token_level = min(
+                self.tokens_per_minute,
+                self.token_level + elapsed * self.tokens_per_minute * self.scale / 60,
+            )
+
+    def _reserve(self, tokens: int) -> float:
+        """Take budget for one request, or return how long to wait before trying again."""
+        now = time.monotonic()
+        self._refill(now)
+        if now < self.paused_until:
+            return self.paused_until - now
+
+        wait = 0.0
+        if self.requests_per_minute and self.request_level < 1:
+            wait = max(wait, (1 - self.request_level) * 60 / (self.requests_per_minute * self.scale))
+        if self.tokens_per_minute:
+            # A request larger than the whole budget only waits for a full bucket
+            tokens = min(tokens, self.tokens_per_minute)
+            if self.token_level < tokens:
+                wait = max(wait, (tokens - self.token_level) * 60 / (self.tokens_per_minute * self.scale))
+        if wait > 0:
+            return wait
+
+        if self.requests_per_minute:
+            self.request_level -= 1
+        if self.tokens_per_minute:
+            self.token_level -= tokens
+        return 0.0
+
+    async def acquire(self, tokens: int) -> None:
+        while True:
+            wait = self._reserve(tokens)
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+    def acquire_blocking(self, tokens: int) -> None:
+        while True:
+            wait = self._reserve(tokens)
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def reconcile(self, estimated_tokens: int, actual_tokens: Optional[int]) -> None:
+        """Correct the token bucket once response.usage tells the real token count."""
+        if self.tokens_per_minute and actual_tokens is not None:
+            self.token_level -= actual_tokens - min(estimated_tokens, self.tokens_per_minute)
+
+    def on_headers(self, headers: Mapping[str, str]) -> None:
+        """Follow the server's view of the remaining quota when it is tighter than ours."""
+        remaining_requests = headers.get("x-ratelimit-remaining-requests")
+        if remaining_requests is not None and self.requests_per_minute:
+            try:
+                self.request_level = min(self.request_level, float(remaining_requests))
+            except ValueError:
+                pass
+        remaining_tokens = headers.get("x-ratelimit-remaining-tokens")
+        if remaining_tokens is not None and self.tokens_per_minute:
+            try:
+                self.token_level = min(self.token_level, float(remaining_tokens))
+            except ValueError:
+                pass
+        # Nothing left on the server side: wait for its reset instead of provoking 429s
+        if remaining_requests == "0" or remaining_tokens == "0":
+            resets = [
+                parse_duration(headers.get(name, ""))
+                for name in ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens")
+            ]
+            resets = [r for r in resets if r is not None]
+            if resets:
+                self.paused_until = max(self.paused_until, time.monotonic() + max(resets))
+
+    def headroom(self) -> float:
+        """Fraction of the budget available right now (0 while paused), for picking between keys."""
+        now = time.monotonic()
+        self._refill(now)
+        if now < self.paused_until:
+            return 0.0
+        fraction = 1.0
+        if self.requests_per_minute:
+            fraction = min(fraction, max(0.0, self.request_level) / self.requests_per_minute)
+        if self.tokens_per_minute:
+            fraction = min(fraction, max(0.0, self.token_level) / self.tokens_per_minute)
+        return fraction * self.scale
+
+    def on_success(self) -> None:
+        self.scale = min(1.0, self.scale + 0.02)
+
+    def on_rate_limited(self, retry_after: Optional[float]) -> None:
+        self.rate_limited += 1
+        self.scale = max(0.1, self.scale * 0.7)
+        if retry_after is not None:
+            self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "rate_limited": self.rate_limited,
+            "retries": self.retries,
+            "scale": round(self.scale, 3),
+        }
+
+
+class RateLimits:
+    """Per-model rate limiters, kept separately for the chat model and the image model."""
+
+    def __init__(self, budgets: Optional[Dict[str, Tuple[Optional[float], Optional[float]]]] = None) -> None:
+        self.budgets = budgets or {}
+        self.limiters: Dict[str, RateLimiter] = {}
+
+    def get(self, model: str) -> RateLimiter:
+        if model not in self.limiters:
+            requests_per_minute, tokens_per_minute = self.budgets.get(model, (None, None))
+            self.limiters[model] = RateLimiter(model, requests_per_minute, tokens_per_minute)
+        return self.limiters[model]
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {model: limiter.stats() for model, limiter in self.limiters.items()}
@@ -0,0 +1,107 @@
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+
+class ResponseCache:
+    """Content-addressed on-disk cache of API responses.
+
+    Entries are keyed by a SHA-256 of everything that determines the answer
+    (model, full messages payload including the base64 images, and the
+    request parameters), so a repeated request is served from disk instead
+    of paying for the same completion again.
+
+    The cache is capped at `max_bytes`; when it grows past the cap the least
+    recently used entries (by file mtime, refreshed on every hit) are removed.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int = 10 * 1024 ** 3) -> None:
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # key -> size, oldest first
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        self._size = 0
+        existing = []
+        for path in self.cache_dir.glob("*/*"):
+            if path.is_file() and not path.name.endswith(".tmp"):
+                stat = path.stat()
+                existing.append((stat.st_mtime, path.name, stat.st_size))
+        for _, key, size in sorted(existing):
+            self._entries[key] = size
+            self._size += size
+
+    @staticmethod
+    def make_key(payload: Dict[str, Any]) -> str:
+        """Hash a JSON-serialisable request description into a cache key."""
+        digest = hashlib.sha256()
+        for name in sorted(payload):
+            value = payload[name]
+            digest.update(name.encode("utf-8"))
+            if isinstance(value, (bytes, bytearray, memoryview)):
+                digest.update(value)
+            else:
+                digest.update(
+                    json.dumps(value, sort_keys=True, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+                )
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / key
+
+    def contains(self, key: str) -> bool:
+        """Whether an entry exists, without reading it or counting a hit or miss."""
+        return self._path(key).exists()
+
+    def get(self, key: str) -> Optional[bytes]:
+        path = self._path(key)
+        try:
+            data = path.read_bytes()
+        except FileNotFoundError:
+            self._entries.pop(key, None)
+            self.misses += 1
+            return None
+        # Refresh the entry so it is evicted last
+        os.utime(path)
+        self._entries[key] = len(data)
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return data
+
+    def put(self, key: str, value: bytes) -> None:
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f"{key}.{os.getpid()}.tmp")
+        tmp_path.write_bytes(value)
+        # Atomic so a concurrent reader never sees half an entry
+        os.replace(tmp_path, path)
+
+        self._size += len(value) - self._entries.pop(key, 0)
+        self._entries[key] = len(value)
+        self._evict()
+
+    def _evict(self) -> None:
+        while self._size > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            try:
+                self._path(key).unlink()
+            except FileNotFoundError:
+                pass
+            self._size -= size
+            self.evictions += 1
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "bytes": self._size,
+        }
@@ -0,0 +1,175 @@
+import json
+import os
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from .checkpoint import RowCounter, RowId, RowKey, record_key
+from .parquet_stream import binary_views
+
+
+# Row group, position inside it
+RowLocation = Tuple[int, int]
+
+
+class ShardIndex:
+    """Map the source/target image names of a dataset shard to their row group and position.
+
+    Built by reading only the nested `path` fields of the two image columns,
+    never the image bytes. The later stages use it to join their upstream
+    records to the images by key instead of by position, so skipped or
+    failed rows upstream cannot misalign the rest of the shard, and any
+    subset of rows can be fetched by reading just the row groups they are in.
+    A key repeated in the shard (or left empty) maps to all its rows, in
+    order; the n-th record with that key is joined to the n-th row (RowId).
+    With `index_dir` the index is saved as <shard>.index.json and reused
+    while the parquet file is unchanged.
+    """
+
+    def __init__(
+        self,
+        parquet_path: str,
+        source_column: str = "src_img",
+        target_column: str = "edited_img",
+        index_dir: Optional[str] = None,
+        cached_row_groups: int = 2,
+    ) -> None:
+        self.parquet_path = parquet_path
+        self.source_column = source_column
+        self.target_column = target_column
+        self.parquet_file = pq.ParquetFile(parquet_path)
+        self.cached_row_groups = cached_row_groups
+        # (row group, column) -> decoded column, a few groups are kept since records arrive in row order
+        self._groups: "OrderedDict[Tuple[int, str], pa.Array]" = OrderedDict()
+        stat = os.stat(parquet_path)
+        self._signature = {
+            "version": 2,
+            "parquet": os.path.basename(parquet_path),
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "columns": [source_column, target_column],
+        }
+        self.index_path = (
+            Path(index_dir) / f"{Path(parquet_path).stem}.index.json" if index_dir else None
+        )
+        self.rows = self._load() if self.index_path is not None else None
+        if self.rows is None:
+            self.rows = self._build()
+            if self.index_path is not None:
+                self._save()
+
+    def _build(self) -> Dict[RowKey, List[RowLocation]]:
+        rows: Dict[RowKey, List[RowLocation]] = {}
+        columns = [f"{self.source_column}.path", f"{self.target_column}.path"]
+        for group in range(self.parquet_file.metadata.num_row_groups):
+            table = self.parquet_file.read_row_group(group, columns=columns)
+            sources = table.column(self.source_column).combine_chunks().field("path").to_pylist()
+            targets = table.column(self.target_column).combine_chunks().field("path").to_pylist()
+            for position, key in enumerate(zip(sources, targets)):
+                rows.setdefault(key, []).append((group, position))
+        return rows
+
+    def _load(self) -> Optional[Dict[RowKey, List[RowLocation]]]:
+        if not self.index_path.exists():
+            return None
+        try:
+            saved = json.loads(self.index_path.read_text(encoding="utf-8"))
+        except json.JSONDecodeError:
+            return None
+        if saved.get("signature") != self._signature:
+            return None
+        rows: Dict[RowKey, List[RowLocation]] = {}
+        for source, target, group, position in saved["rows"]:
+            rows.setdefault((source, target), []).append((group, position))
+        return rows
+
+    def _save(self) -> None:
+        self.index_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.index_path.with_name(f"{self.index_path.name}.{os.getpid()}.tmp")
+        rows = [[source, target, group, position] for (source, target), locations in self.rows.items() for group, position in locations]
+        tmp_path.write_text(json.dumps({"signature": self._signature, "rows": rows}), encoding="utf-8")
+        os.replace(tmp_path, self.index_path)
+
+    def describe(self) -> str:
+        metadata = self.parquet_file.metadata
+        return (
+            f"{self.parquet_path}: {metadata.num_rows} rows, {metadata.num_row_groups} row groups, "
+            f"{len(self.rows)} distinct source/target keys"
+        )
+
+    def locate(self, row: RowId) -> Optional[RowLocation]:
+        locations = self.rows.get(row[:2], [])
+        return locations[row[2]] if row[2] < len(locations) else None
+
+    def _column(self, group: int, column: str) -> pa.Array:
+        cache_key = (group, column)
+        if cache_key in self._groups:
+            self._groups.move_to_end(cache_key)
+            return self._groups[cache_key]
+        array = self.parquet_file.read_row_group(group, columns=[column]).column(column).combine_chunks()
+        self._groups[cache_key] = array
+        while len(self._groups) > self.cached_row_groups:
+            self._groups.popitem(last=False)
+        return array
+
+    def fetch(self, rows: List[RowId], column: str, field: str = "bytes") -> List[Optional[memoryview]]:
+        """Zero-copy views of the image bytes of `rows` in `column`; None for rows not in the shard.
+
+        Only the row groups holding the requested rows are read.
+        """
+        located: Dict[int, List[Tuple[int, int]]] = {}
+        for k, row in enumerate(rows):
+            location = self.locate(row)
+            if location is not None:
+                located.setdefault(location[0], []).append((k, location[1]))
+        views: List[Optional[memoryview]] = [None] * len(rows)
+        for group, items in sorted(located.items()):
+            group_views = binary_views(self._column(group, column).field(field))
+            for k, position in items:
+                views[k] = group_views[position]
+        return views
+
+    def in_row_order(self, keys: Iterable[RowKey]) -> List[RowId]:
+        """Every row of this shard with one of `keys`, sorted by position."""
+        rows = [(*key, n) for key in keys for n in range(len(self.rows.get(key, [])))]
+        return sorted(rows, key=self.locate)
+
+    def join(self, records: List[Tuple[RowId, Dict[str, Any]]], column: str) -> List[Tuple[RowId, Dict[str, Any], memoryview]]:
+        """Add to each (row, record) its image in `column`; records not in the shard are skipped."""
+        images = self.fetch([row for row, _ in records], column)
+        joined = []
+        for (row, rec), image in zip(records, images):
+            if image is None:
+                print(f"Skipping {rec['source']} / {rec['target']}: not found in {os.path.basename(self.parquet_path)}\n")
+                continue
+            joined.append((row, rec, image))
+        return joined
+
+
+def load_subset(path: Optional[str]) -> Optional[Set[RowKey]]:
+    """Keys listed in a --subset file: JSON lines with "source" and "target", e.g. lines of any stage output."""
+    if path is None:
+        return None
+    keys = set()
+    with open(path, "r", encoding="utf-8") as fin:
+        for line in fin:
+            line = line.strip()
+            if line:
+                keys.add(record_key(json.loads(line)))
+    return keys
+
+
+def select_records(records: Iterable[Dict[str, Any]], writer: Any, subset: Optional[Set[RowKey]], rows: RowCounter) -> List[Tuple[RowId, Dict[str, Any]]]:
+    """The (row, record) pairs still to process: not yet written and, with --subset, listed in it.
+
+    `rows` numbers the records of the whole upstream output, so it has to see every one of them, in order.
+    """
+    numbered = [(rows.number(*record_key(rec)), rec) for rec in records]
+    return [
+        (row, rec) for row, rec in numbered
+        if not writer.is_done(row)
+        and (subset is None or record_key(rec) in subset)
+    ]
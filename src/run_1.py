@@ -1,100 +1,246 @@
 import argparse
 import json
-import base64
-import pandas as pd
-from pathlib import Path
-from typing import Any
-import os
-import re
-import pyarrow.parquet as pq
-import pyarrow as pa
-import glob
+from typing import Any, Iterator, Tuple
 from ._1_difference_generator import DifferenceDescriptionGenerator
+from .api_call import ApiCaller
+from .async_engine import AsyncRunner
+from .batch_mode import finish_batch_answers, prepare_batch_answers
+from .budget import Budget, BudgetExceeded, pending_rows
+from .checkpoint import RowCounter
+from .cli import parse_stage_args
+from .dedup import Deduplicator
+from .hedging import HedgePolicy
+from .image_prep import ImagePreprocessor
+from .key_pool import KeyPool, load_key_specs
+from .metrics import Metrics
+from .parquet_output import open_stage_writer, output_path_for
+from .parquet_stream import ParquetStreamReader, struct_field, struct_field_views
+from .row_index import ShardIndex, load_subset
+from .response_cache import ResponseCache
+from .sharding import claim_shards, extract_index_number_str, list_shards, run_workers
+from .structured_output import clean_json_block
 
 
-def parse_args() -> argparse.Namespace:
-    parser = argparse.ArgumentParser(description="Generate image difference descriptions using OpenAI API")
-    parser.add_argument("--api-key", required=True, help="OpenAI API key")
-    #parser.add_argument("--source", nargs='+', required=True, help="List of source image paths")
-    #parser.add_argument("--target", nargs='+', required=True, help="List of target image paths")
-    parser.add_argument("--output-dir", default="./output/_1_difference", help="Output JSONL dir, which will include a batch of generated results")
-    parser.add_argument("--model", default="gpt-4o", help="OpenAI model to use")
-
-    # for parquet file input
-    parser.add_argument("--input-parquet-dir", required=True, help="Input file containing a batch of parquet file, which include the source and target images")
-    parser.add_argument("--source-column-name", default="src_img", help="Column name for source image bytes")
-    parser.add_argument("--target-column-name", default="edited_img", help="Column name for target image bytes")
-    return parser.parse_args()
-
-def clean_json_block(s: str) -> str:
-    s = s.strip()
-    if s.startswith("```"):
-        s = s.strip("`")
-        s = s.replace("json\n", "", 1).replace("\n", "", 1) if s.startswith("json") else s
-    return s
-
-def extract_index_number_int(path):
-    # train-00012-xxx.parquet，extract int(12)
-    m = re.search(r'train-(\d+)-', os.path.basename(path))
-    return int(m.group(1)) if m else -1
-def extract_index_number_str(path):
-    # train-00012-xxx.parquet，extract str(00012)
-    m = re.search(r'train-(\d+)-', os.path.basename(path))
-    return m.group(1) if m else -1
+def iter_row_batches(args: argparse.Namespace, reader: ParquetStreamReader, subset: Any, metrics: Any) -> Iterator[Tuple[list, list, list]]:
+    """Yield (source images, target images, row ids) batch by batch.
 
-def main() -> None:
-    args = parse_args()
+    The whole shard is streamed, unless a --subset is given: its rows are then
+    located through the shard's source/target index and read by key, only
+    from the row groups they are in.
+    """
+    if subset is None:
+        rows = RowCounter()
+        for batch in metrics.timed(reader.iter_batches(), "read"):
+            # Image bytes are zero-copy views into the Arrow buffers; names are plain lists
+            names = zip(struct_field(batch, args.source_column_name, "path"), struct_field(batch, args.target_column_name, "path"))
+            yield (
+                struct_field_views(batch, args.source_column_name),
+                struct_field_views(batch, args.target_column_name),
+                [rows.number(source, target) for source, target in names],
+            )
+        return
+    index = ShardIndex(reader.parquet_path, args.source_column_name, args.target_column_name, index_dir=args.index_dir)
+    rows = index.in_row_order(subset)
+    for start in range(0, len(rows), args.batch_size):
+        chunk = rows[start:start + args.batch_size]
+        with metrics.span("read"):
+            source_images = index.fetch(chunk, args.source_column_name)
+            target_images = index.fetch(chunk, args.target_column_name)
+        yield source_images, target_images, chunk
+
+def process_shard(args: argparse.Namespace, generator: Any, runner: AsyncRunner, reader: ParquetStreamReader, writer: Any, subset: Any = None) -> None:
+    """Generate the differences of every pending row of one shard and write them in row order.
+
+    `writer` is a CheckpointWriter, or a CollectingWriter during the collection pass of batch mode.
+    """
+    metrics = generator.caller.metrics
+    for source_images, target_images, rows in iter_row_batches(args, reader, subset, metrics):
+
+        # Skip the rows already written by an earlier run; with --incremental
+        # only those still made from the same images, model and prompt
+        pending = []
+        provenance = {}
+        for i in range(len(source_images)):
+            if writer.is_done(rows[i]):
+                continue
+            provenance[i] = generator.provenance.of(source_images[i], target_images[i])
+            if args.incremental and writer.keep(rows[i], provenance[i]):
+                continue
+            pending.append(i)
+        if not pending:
+            continue
+
+        def write_difference(k: int, diff_str: str) -> None:
+            i = pending[k]
+            try:
+                # Attempt to parse the difference string as JSON format
+                diff_str_clean = clean_json_block(diff_str)
+                diff = json.loads(diff_str_clean)
+            except json.JSONDecodeError:
+                # Fallback to raw string if the API does not return valid JSON
+                diff = diff_str
+            record = {
+                "source": rows[i][0],
+                "target": rows[i][1],
+                "difference": diff,
+                generator.provenance.field: provenance[i],
+            }
+            with metrics.span("write"):
+                writer.write(record, rows[i])
+
+        # Call the generator, keeping up to --concurrency requests in flight;
+        # every difference is appended in row order as soon as it is ready
+        runner.map_ordered(
+            lambda i: generator.adescribe_difference(source_images[i], target_images[i]),
+            pending,
+            args.concurrency,
+            on_result=write_difference,
+            stop_on=(BudgetExceeded,),
+        )
+
+def run(args: argparse.Namespace) -> None:
+    # --incremental reads the existing outputs like --resume does
+    if args.incremental:
+        args.resume = True
+    # Optional on-disk response cache, so reruns do not pay for the same request twice
+    cache = (
+        ResponseCache(args.cache_dir, max_bytes=int(args.cache_max_gb * 1024 ** 3))
+        if args.cache_dir else None
+    )
+    # Rate budget of the chat model per key; 429s and Retry-After are handled even without one
+    budgets = {args.model: (args.rpm, args.tpm)}
+    # Latency, payload, token and error counters of every request, timing of the read / encode / write phases
+    metrics = Metrics("difference")
+    # One key, or a pool of keys / endpoints from --api-keys-file; each key has its own
+    # pooled keep-alive connections and rate limiters
+    keys = KeyPool.from_specs(
+        load_key_specs(args.api_keys_file, args.api_key, args.base_url),
+        budgets,
+        client_options={
+            "max_connections": args.max_connections,
+            "max_keepalive_connections": args.max_keepalive_connections,
+            "keepalive_expiry": args.keepalive_expiry,
+            "connect_timeout": args.connect_timeout,
+            "read_timeout": args.read_timeout,
+            "http2": args.http2,
+        },
+        auth_cooldown=args.key_auth_cooldown,
+        error_cooldown=args.key_error_cooldown,
+    )
+    # Pre-flight cost / token estimate of every request, kept within --max-cost / --max-tokens
+    budget = Budget(max_cost=args.max_cost, max_tokens=args.max_tokens)
+    # Optional duplicates of the slowest requests, to cut the latency tail that holds up a shard
+    hedge = HedgePolicy(args.hedge_percentile / 100, max_rate=args.hedge_max_rate, min_delay=args.hedge_min_delay) if args.hedge_percentile else None
+    caller = ApiCaller(keys, cache=cache, max_retries=args.max_retries, metrics=metrics, budget=budget, hedge=hedge)
+    # Downscaling / re-encoding of the images before upload, cached across stages
+    images = ImagePreprocessor(
+        max_side=args.image_max_side,
+        detail=args.image_detail,
+        image_format=args.image_format,
+        quality=args.image_quality,
+        cache_dir=args.image_cache_dir,
+    )
     # Initialize the DifferenceDescriptionGenerator
-    generator = DifferenceDescriptionGenerator(args.api_key, model=args.model)
-
-    parquet_dir = args.input_parquet_dir
-    all_paths = glob.glob(os.path.join(parquet_dir, "*.parquet"))
-    valid_paths = [
-        p for p in all_paths
-        if not os.path.basename(p).startswith('._')
-    ]
-    
-    # Sequence the path list with order of number: train-00000-xxx, train-00001-xxx, ...
-    valid_paths.sort(key=extract_index_number_int)
+    generator = DifferenceDescriptionGenerator(args.api_key, model=args.model, caller=caller, images=images, response_format=args.response_format, dedup=Deduplicator(enabled=not args.no_dedup))
+    # A single event loop drives every async request of the run
+    runner = AsyncRunner()
+    # Existing rows are checked against their provenance hash with --incremental
+    provenance_field = generator.provenance.field if args.incremental else None
+    # Optional --subset of source/target keys to process
+    subset = load_subset(args.subset)
+
+    # The parquet files of this partition, in train-XXXXX order
+    valid_paths = list_shards(args.input_parquet_dir, args.num_shards, args.shard_index)
     length = len(valid_paths)
     print(f"The number of parquet is {length} \n")
 
-    for parquet_path in valid_paths:
+    def fits_budget(parquet_path: str) -> bool:
+        # Judged from the average cost per request so far, once the first requests were settled
+        number = extract_index_number_str(parquet_path)
+        output_path = output_path_for(args.output_dir, number, args.output_format)
+        return budget.shard_fits(number, pending_rows(parquet_path, output_path, args.resume, subset), {args.model: 1})
+
+    # With --workers, each parquet file is claimed through a lock file so that
+    # concurrent processes (local or on other machines) never take the same one
+    for parquet_path in claim_shards(
+        valid_paths,
+        args.output_dir,
+        extract_index_number_str,
+        enabled=args.workers is not None,
+        stale_after=args.stale_lock_seconds,
+        admit=fits_budget if budget.limited else None,
+        run_id=args.run_id,
+        # --resume / --incremental check the files finished by earlier runs again
+        recheck_done=args.resume,
+    ):
         
         # Extract the sequence string, for convenient
         parquet_path_number_str = extract_index_number_str(parquet_path)
 
-        # Read a parquet file
-        df = pd.read_parquet(parquet_path)
+        # Open the parquet file for streaming, one record batch at a time
+        # Only the source and target image columns are decoded
+        reader = ParquetStreamReader(
+            parquet_path,
+            batch_size=args.batch_size,
+            columns=[args.source_column_name, args.target_column_name],
+        )
         print(f"Generating from original dataset_{parquet_path_number_str}.parquet for difference\n")
         print(f"The information of processing parquet is:\n")
-        print(df.info(),"\n")
-        # Convert the specified columns to lists
-        source_images = [x['bytes'] for x in df[args.source_column_name]]
-        target_images = [x['bytes'] for x in df[args.target_column_name]]
-        source_images_name = [x['path'] for x in df[args.source_column_name]]
-        target_images_name = [x['path'] for x in df[args.target_column_name]]
-
-        # Call the generator 
-        differences = generator.process_batch(source_images, target_images)
-        # Write the differences into json
-        output_path = f"{args.output_dir}/{parquet_path_number_str}.jsonal"
-        output_path = Path(output_path)
-        with output_path.open("w", encoding="utf-8") as f:
-            for src_name, tgt_name, diff_str in zip(source_images_name, target_images_name, differences):
-                try:
-                    # Attempt to parse the difference string as JSON format
-                    diff_str_clean = clean_json_block(diff_str)
-                    diff = json.loads(diff_str_clean)
-                except json.JSONDecodeError:
-                    # Fallback to raw string if the API does not return valid JSON
-                    diff = diff_str
-                record = {
-                    "source": src_name,
-                    "target": tgt_name,
-                    "difference": diff,
-                }
-                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        print(reader.describe(),"\n")
+
+        output_path = output_path_for(args.output_dir, parquet_path_number_str, args.output_format)
+        # Answers still unusable after local repair and one retry are stored as raw strings
+        failed_before = generator.structured.stats.failed
+        saved_before = generator.dedup.saved
+        cost_before = budget.spent_cost
+        # A request that no longer fits in the budget stops the run after the rows written so far
+        exhausted = None
+        try:
+            if args.mode == "batch":
+                # Send every pending request of the shard through the Batch API first,
+                # the pass below then merges the answers in row order
+                job = prepare_batch_answers(
+                    caller,
+                    output_path,
+                    lambda collecting_writer: process_shard(args, generator, runner, reader, collecting_writer, subset),
+                    resume=args.resume,
+                    poll_interval=args.poll_interval,
+                    provenance_field=provenance_field,
+                )
+            with open_stage_writer(output_path, resume=args.resume, row_group_size=args.output_row_group_size, compression=args.output_compression, provenance_field=provenance_field) as writer:
+                process_shard(args, generator, runner, reader, writer, subset)
+        except BudgetExceeded as exc:
+            exhausted = exc
+        print(f"Unparseable answers in {output_path.name}: {generator.structured.stats.failed - failed_before}\n")
+        print(f"Deduplicated calls in {output_path.name}: {generator.dedup.saved - saved_before}\n")
+        print(f"Spent on {output_path.name}: ${budget.spent_cost - cost_before:.4f}\n")
+        # Per-shard JSON summary next to the output; the textfile holds the run totals so far
+        metrics.finish_shard(output_path.with_name(f"{parquet_path_number_str}.metrics.json"), parquet_path_number_str)
+        if args.metrics_textfile:
+            metrics.write_prometheus(args.metrics_textfile)
+        if exhausted is not None:
+            print(f"Stopping: {exhausted}. Run again with --resume to continue\n")
+            break
+        if args.mode == "batch":
+            finish_batch_answers(caller, job)
+
+    runner.run(keys.aclose())
+    runner.close()
+    if cache is not None:
+        print(f"Response cache: {cache.stats()}\n")
+    print(f"API keys: {keys.stats()}\n")
+    print(f"Budget: {budget.stats()}\n")
+    if hedge is not None:
+        print(f"Hedging: {hedge.stats()}\n")
+    print(f"Structured answers: {generator.structured.stats.as_dict()}\n")
+    print(f"Image preprocessing: {images.stats()}\n")
+    print(f"Deduplication: {generator.dedup.stats()}\n")
+    print(f"Request metrics: {metrics.summary()['requests']}\n")
+
+def main() -> None:
+    args = parse_stage_args("difference")
+    # One process, or --workers processes sharing the parquet files through lock files
+    run_workers(run, args, args.workers or 1)
 
 if __name__ == "__main__":
     main()
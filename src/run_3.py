@@ -1,105 +1,243 @@
 # run_step_edit.py
 
 import argparse
-import json
 from pathlib import Path
-import pandas as pd
-from PIL import Image
-import io
+from typing import Any, List
 import base64
-import pyarrow.parquet as pq
-import pyarrow as pa
-import glob
-import re
-import os
-from ._3_step_image_generator import StepImageEditor
-
-def parse_args():
-    parser = argparse.ArgumentParser(
-        description="Batch-apply 'step' edits to images and update JSONL records"
-    )
-    parser.add_argument("--api-key", required=True, help="OpenAI API key")
-    parser.add_argument("--input-jsonal-dir", default='./output/_2_instruction', help="Path to instruction JSONL file")
-    parser.add_argument("--input-parquet-dir", required=True, help="Input file containing a batch of parquet file, which include the source and target images")
-    parser.add_argument("--source-column-name", default="src_img", help="Column name for source image bytes")
-    parser.add_argument("--output-dir", default="./output/_3_step_image", help="Output JSONL dir, which will include a batch of generated results")
-    parser.add_argument("--n",    type=int, default=1, help="Images per edit")
-    return parser.parse_args()
-
-def extract_index_number_int(path):
-    # train-00012-xxx.parquet，extract int(12)
-    m = re.search(r'train-(\d+)-', os.path.basename(path))
-    return int(m.group(1)) if m else -1
-def extract_index_number_str(path):
-    # train-00012-xxx.parquet，extract str(00012)
-    m = re.search(r'train-(\d+)-', os.path.basename(path))
-    return m.group(1) if m else -1
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
+from ._3_step_image_generator import StepImageEditor, chain_steps
+from .api_call import ApiCaller
+from .async_engine import AsyncRunner
+from .blob_store import BlobWriter
+from .budget import Budget, BudgetExceeded, pending_rows
+from .checkpoint import RowCounter
+from .cli import parse_stage_args
+from .dedup import Deduplicator
+from .hedging import HedgePolicy
+from .image_prep import ImagePreprocessor
+from .key_pool import KeyPool, load_key_specs
+from .metrics import Metrics
+from .parquet_output import find_stage_input, iter_stage_records, open_stage_writer, output_path_for
+from .parquet_stream import take
+from .row_index import ShardIndex, load_subset, select_records
+from .response_cache import ResponseCache
+from .sharding import claim_shards, extract_index_number_str, list_shards, run_workers
 
-def main():
-    args = parse_args()
 
+def run(args: argparse.Namespace):
+    # --incremental reads the existing outputs like --resume does
+    if args.incremental:
+        args.resume = True
+    # Optional on-disk response cache, so reruns do not pay for the same request twice
+    cache = (
+        ResponseCache(args.cache_dir, max_bytes=int(args.cache_max_gb * 1024 ** 3))
+        if args.cache_dir else None
+    )
+    # Rate budget of the image model per key; 429s and Retry-After are handled even without one
+    budgets = {"gpt-image-1": (args.image_rpm, args.image_tpm)}
+    # Latency, payload, token and error counters of every request, timing of the read / encode / write phases
+    metrics = Metrics("step_image")
+    # One key, or a pool of keys / endpoints from --api-keys-file; each key has its own
+    # pooled keep-alive connections and rate limiters
+    keys = KeyPool.from_specs(
+        load_key_specs(args.api_keys_file, args.api_key, args.base_url),
+        budgets,
+        client_options={
+            "keepalive_expiry": args.keepalive_expiry,
+            "connect_timeout": args.connect_timeout,
+            "image_max_connections": args.image_max_connections,
+            "image_read_timeout": args.image_read_timeout,
+            "http2": args.http2,
+        },
+        auth_cooldown=args.key_auth_cooldown,
+        error_cooldown=args.key_error_cooldown,
+    )
+    # Pre-flight cost / token estimate of every request, kept within --max-cost / --max-tokens
+    budget = Budget(max_cost=args.max_cost, max_tokens=args.max_tokens)
+    # Optional duplicates of the slowest requests, to cut the latency tail that holds up a shard
+    hedge = HedgePolicy(args.hedge_percentile / 100, max_rate=args.hedge_max_rate, min_delay=args.hedge_min_delay) if args.hedge_percentile else None
+    caller = ApiCaller(keys, cache=cache, max_retries=args.max_retries, metrics=metrics, budget=budget, hedge=hedge)
+
+    # Decoding / downscaling / re-encoding of the uploads, done in worker processes so that
+    # the next rows are prepared while the current ones wait on the API
+    image_pool = ProcessPoolExecutor(max_workers=args.image_workers) if args.image_workers > 0 else None
+    images = ImagePreprocessor(
+        max_side=args.image_max_side,
+        image_format=args.image_format,
+        quality=args.image_quality,
+        cache_dir=args.image_cache_dir,
+        executor=image_pool,
+    )
     editor = StepImageEditor(
         api_key=args.api_key,
         n=args.n,
+        caller=caller,
+        images=images,
+        # Repeated edits of the same source image are made once
+        dedup=Deduplicator(enabled=not args.no_dedup),
     )
+    # A single event loop drives every async request of the run
+    runner = AsyncRunner()
+    # Optional --subset of source/target keys to process
+    subset = load_subset(args.subset)
+
+    # The parquet files of this partition, in train-XXXXX order
+    valid_paths = list_shards(args.input_parquet_dir, args.num_shards, args.shard_index)
 
-    parquet_dir = args.input_parquet_dir
-    all_paths = glob.glob(os.path.join(parquet_dir, "*.parquet"))
-    valid_paths = [
-        p for p in all_paths
-        if not os.path.basename(p).startswith('._')
-    ]
-    
-    # Sequence the path list with order of number: train-00000-xxx, train-00001-xxx, ...
-    valid_paths.sort(key=extract_index_number_int)
+    def fits_budget(parquet_path: str) -> bool:
+        # Judged from the average cost per request so far, once the first requests were settled;
+        # a row costs up to one image edit per --edit-steps step
+        number = extract_index_number_str(parquet_path)
+        output_path = output_path_for(args.output_dir, number, args.output_format)
+        return budget.shard_fits(number, pending_rows(parquet_path, output_path, args.resume, subset), {"gpt-image-1": args.edit_steps})
 
-    for parquet_path in valid_paths:
+    # With --workers, each parquet file is claimed through a lock file so that
+    # concurrent processes (local or on other machines) never take the same one
+    for parquet_path in claim_shards(
+        valid_paths,
+        args.output_dir,
+        extract_index_number_str,
+        enabled=args.workers is not None,
+        stale_after=args.stale_lock_seconds,
+        admit=fits_budget if budget.limited else None,
+        run_id=args.run_id,
+        # --resume / --incremental check the files finished by earlier runs again
+        recheck_done=args.resume,
+    ):
 
         # Extract the sequence string, for convenient
         parquet_path_number_str = extract_index_number_str(parquet_path)
 
-        # Read the parquet file
-        df = pd.read_parquet(parquet_path)
-        # Convert the specified columns to lists
-        source_images = [x['bytes'] for x in df[args.source_column_name]]
-
+        # Source/target -> row index of the parquet file; the source images are read
+        # by key, only from the row groups holding the pending records
+        index = ShardIndex(parquet_path, args.source_column_name, args.target_column_name, index_dir=args.index_dir)
         print(f"Generating from original dataset_{parquet_path_number_str}.parquet for step images\n")
         print(f"The information of processing parquet is:\n")
-        print(df.info(),"\n")
-
-        # Read the JSONL file into list of records
-        input_path = f"{args.input_jsonal_dir}/{parquet_path_number_str}.jsonal"
-        input_path = Path(input_path)
-        records = []
-        with input_path.open("r", encoding="utf-8") as fin:
-            for line in fin:
-                line = line.strip()
-                if line:
-                    records.append(json.loads(line))
-
-        output_path = f"{args.output_dir}/{parquet_path_number_str}.jsonal"
-        output_path = Path(output_path)
-        with output_path.open("w", encoding="utf-8") as f:
-            for rec, source_image in zip(records, source_images ): # source_image is corresponding image bytes
-                # Grab the difference key 
-                edit_text = (
-                    rec["edit"]
-                    if isinstance(rec["edit"], str)
-                    else rec["edit"].get("1", "")  # Only take action 1 to execute
-                )
-                print("The specific action of this step edited image is: \n")
-                print(edit_text)
-                # Get the width and height of the source image
-                img = Image.open(io.BytesIO(source_image))
-                img_format = img.format
-                width, height = img.size
-
-                step_edited_img_bytes = editor.apply_step(source_image, edit_text, width, height, img_format)
-
-                # Add step edited image base64 string to the record jsonal and save as new output
-                # Attention: jsonal cannot accept bytes, so we need to encode the bytes to base64 string
-                rec["step_edited"] = base64.b64encode(step_edited_img_bytes).decode("utf-8")
-                f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+        print(index.describe(),"\n")
+
+        # Stream the upstream records; with a parquet output only the edit
+        # column is decoded, the others are copied as they are
+        input_path = find_stage_input(args.input_jsonal_dir, parquet_path_number_str)
+        record_iter = iter_stage_records(input_path, decode={"edit"}, passthrough=args.output_format == "parquet")
+        # Numbers the records sharing a source/target pair, to tell their rows apart
+        rows = RowCounter()
+
+        output_path = output_path_for(args.output_dir, parquet_path_number_str, args.output_format)
+        # Step images go to a per-shard binary sidecar next to the .jsonal, unless inline is requested;
+        # a parquet output keeps them in a binary column
+        blob_path = Path(f"{args.output_dir}/{parquet_path_number_str}.blob")
+        blob_context = (
+            BlobWriter(blob_path, resume=args.resume)
+            if args.step_image_storage == "blob" and args.output_format == "jsonal" else contextlib.nullcontext()
+        )
+        writer_context = open_stage_writer(
+            output_path,
+            resume=args.resume,
+            row_group_size=args.output_row_group_size,
+            compression=args.output_compression,
+            # Existing rows are checked against their provenance hash with --incremental
+            provenance_field=editor.provenance.field if args.incremental else None,
+        )
+        saved_before = editor.dedup.saved
+        cost_before = budget.spent_cost
+        # An edit that no longer fits in the budget stops the run after the images written so far
+        exhausted = None
+        with writer_context as writer, blob_context as blob_writer:
+            while True:
+                records = take(record_iter, args.batch_size)
+                if not records:
+                    break
+
+                # Collect the edit requests of this batch, skipping the rows already
+                # written by an earlier run and those outside --subset
+                records = select_records(records, writer, subset, rows)
+                # Join the records to their source images by key, reading only the row groups they are in
+                with metrics.span("read"):
+                    joined = index.join(records, args.source_column_name)
+                pending = []
+                edit_jobs = []
+                for row, rec, source_image in joined: # source_image is corresponding image bytes
+                    # The first --edit-steps numbered actions, run one after another
+                    steps = chain_steps(rec["edit"], args.edit_steps)
+                    provenance = editor.provenance.of(rec.get("instruction_provenance"), *steps, source_image)
+                    # With --incremental, keep the existing rows made from the same edit steps and image
+                    if args.incremental and writer.keep(row, provenance):
+                        continue
+                    rec[editor.provenance.field] = provenance
+                    print("The specific action of this step edited image is: \n")
+                    print("\n".join(steps))
+                    # The image is decoded and re-encoded once, in the worker pool, starting right away
+                    editor.prefetch(source_image, steps)
+                    pending.append((row, rec))
+                    edit_jobs.append((source_image, steps))
+                if not pending:
+                    continue
+
+                def store_image(step_edited_img_bytes: bytes) -> Any:
+                    if args.output_format == "parquet":
+                        return step_edited_img_bytes
+                    if blob_writer is not None:
+                        # Write the image bytes to the sidecar first, the record only keeps a reference to them
+                        return blob_writer.append(step_edited_img_bytes)
+                    # Add step edited image base64 string to the record jsonal and save as new output
+                    # Attention: jsonal cannot accept bytes, so we need to encode the bytes to base64 string
+                    return base64.b64encode(step_edited_img_bytes).decode("utf-8")
+
+                def write_step_image(k: int, step_images: List[bytes]) -> None:
+                    row, rec = pending[k]
+                    with metrics.span("write"):
+                        rec["step_edited"] = store_image(step_images[0])
+                        for step in range(2, args.edit_steps + 1):
+                            if step <= len(step_images):
+                                rec[f"step_edited_{step}"] = store_image(step_images[step - 1])
+                            elif args.output_format == "parquet":
+                                # Every row of a parquet file has the same columns
+                                rec[f"step_edited_{step}"] = None
+                        writer.write(rec, row)
+
+                # Run the edit chains concurrently; every record is appended in row order
+                # as soon as its images are ready
+                try:
+                    runner.map_ordered(
+                        lambda job: editor.aapply_chain(*job),
+                        edit_jobs,
+                        args.concurrency,
+                        on_result=write_step_image,
+                        stop_on=(BudgetExceeded,),
+                    )
+                except BudgetExceeded as exc:
+                    exhausted = exc
+                    break
+        print(f"Deduplicated calls in {output_path.name}: {editor.dedup.saved - saved_before}\n")
+        print(f"Spent on {output_path.name}: ${budget.spent_cost - cost_before:.4f}\n")
+        # Per-shard JSON summary next to the output; the textfile holds the run totals so far
+        metrics.finish_shard(output_path.with_name(f"{parquet_path_number_str}.metrics.json"), parquet_path_number_str)
+        if args.metrics_textfile:
+            metrics.write_prometheus(args.metrics_textfile)
+        if exhausted is not None:
+            print(f"Stopping: {exhausted}. Run again with --resume to continue\n")
+            break
+
+    runner.run(keys.aclose())
+    runner.close()
+    if image_pool is not None:
+        image_pool.shutdown()
+    if cache is not None:
+        print(f"Response cache: {cache.stats()}\n")
+    print(f"API keys: {keys.stats()}\n")
+    print(f"Budget: {budget.stats()}\n")
+    if hedge is not None:
+        print(f"Hedging: {hedge.stats()}\n")
+    print(f"Image preprocessing: {images.stats()}\n")
+    print(f"Deduplication: {editor.dedup.stats()}\n")
+    print(f"Edit chains: {editor.chain_stats()}\n")
+    print(f"Request metrics: {metrics.summary()['requests']}\n")
+
+def main():
+    args = parse_stage_args("step-image")
+    # One process, or --workers processes sharing the parquet files through lock files
+    run_workers(run, args, args.workers or 1)
 
 if __name__ == "__main__":
     main()
@@ -3,98 +3,55 @@
 import argparse
 import json
 from pathlib import Path
-import pandas as pd
-import base64
-import os
-import re
-import pyarrow.parquet as pq
-import pyarrow as pa
-import glob
+from typing import Any
 from ._4_cot_reinstruction_generator import MultiModalAnalysisGenerator
-
-def parse_args():
-    parser = argparse.ArgumentParser(
-        description="Batch-generate CoT analysis and revised edit instructions from image records"
-    )
-    parser.add_argument(
-        "--api-key",
-        required=True,
-        help="OpenAI API key"
-    )
-    parser.add_argument("--input-jsonal-dir", default='./output/_3_step_image', help="Path to difference JSONL file")
-    parser.add_argument("--output-dir", default="./output/_4_cot_reinstruction", help="Output JSONL dir, which will include a batch of generated results")
-
-
-    parser.add_argument(
-        "--model",
-        default="gpt-4o",
-        help="OpenAI ChatCompletion model to use"
-    )
-    parser.add_argument("--input-parquet-dir", required=True, help="Input file containing a batch of parquet file, which include the source and target images")
-    parser.add_argument("--source-column-name", default="src_img", help="Column name for source image bytes")
-    return parser.parse_args()
-
-def clean_json_block(s: str) -> str:
-    s = s.strip()
-    if s.startswith("```"):
-        s = s.strip("`")
-        s = s.replace("json\n", "", 1).replace("\n", "", 1) if s.startswith("json") else s
-    return s
-
-def extract_index_number_int(path):
-    # train-00012-xxx.parquet，extract int(12)
-    m = re.search(r'train-(\d+)-', os.path.basename(path))
-    return int(m.group(1)) if m else -1
-def extract_index_number_str(path):
-    # train-00012-xxx.parquet，extract str(00012)
-    m = re.search(r'train-(\d+)-', os.path.basename(path))
-    return m.group(1) if m else -1
-
-def main():
-    args = parse_args()
-
-    generator = MultiModalAnalysisGenerator(
-        api_key=args.api_key,
-        model=args.model
-    )
-
-    parquet_dir = args.input_parquet_dir
-    all_paths = glob.glob(os.path.join(parquet_dir, "*.parquet"))
-    valid_paths = [
-        p for p in all_paths
-        if not os.path.basename(p).startswith('._')
-    ]
-    
-    # Sequence the path list with order of number: train-00000-xxx, train-00001-xxx, ...
-    valid_paths.sort(key=extract_index_number_int)
-
-    for parquet_path in valid_paths:
-
-        # Extract the sequence string, for convenient
-        parquet_path_number_str = extract_index_number_str(parquet_path)
-
-        # Read the parquet file
-        df = pd.read_parquet(parquet_path)
-        # Convert the specified columns to lists
-        source_images = [x['bytes'] for x in df[args.source_column_name]]
-        print(f"Generating from original dataset_{parquet_path_number_str}.parquet for cot and reinstruction\n")
-        print(f"The information of processing parquet is:\n")
-        print(df.info(),"\n")
-
-        # Read the input JSONL file into list of records
-        input_path = f"{args.input_jsonal_dir}/{parquet_path_number_str}.jsonal"
-        input_path = Path(input_path)
-        records = []
-        with input_path.open("r", encoding="utf-8") as fin:
-            for line in fin:
-                line = line.strip()
-                if line:
-                    records.append(json.loads(line))
-
-        output_path = f"{args.output_dir}/{parquet_path_number_str}.jsonal"
-        output_path = Path(output_path)
-        with output_path.open("w", encoding="utf-8") as f:
-            for rec, source_image in zip(records, source_images ): # source_image is corresponding image bytes
+from .api_call import ApiCaller
+from .async_engine import AsyncRunner
+from .batch_mode import finish_batch_answers, prepare_batch_answers
+from .budget import Budget, BudgetExceeded, pending_rows
+from .blob_store import BlobReader, load_step_image
+from .checkpoint import RowCounter
+from .cli import parse_stage_args
+from .dedup import Deduplicator
+from .hedging import HedgePolicy
+from .image_prep import ImagePreprocessor
+from .key_pool import KeyPool, load_key_specs
+from .metrics import Metrics
+from .parquet_output import find_stage_input, iter_stage_records, open_stage_writer, output_path_for
+from .parquet_stream import take
+from .row_index import ShardIndex, load_subset, select_records
+from .response_cache import ResponseCache
+from .sharding import claim_shards, extract_index_number_str, list_shards, run_workers
+from .structured_output import clean_json_block
+
+
+def process_shard(args: argparse.Namespace, generator: Any, runner: AsyncRunner, index: ShardIndex, input_path: Path, writer: Any, subset: Any = None) -> None:
+    """Generate the CoT and re-editing instructions of every pending row of one shard and write them in upstream order.
+
+    `writer` is a CheckpointWriter, or a CollectingWriter during the collection pass of batch mode.
+    """
+    metrics = generator.caller.metrics
+    # Stream the upstream records; with a parquet output only the edit
+    # column is decoded, the others are copied as they are
+    record_iter = iter_stage_records(input_path, decode={"edit"}, passthrough=args.output_format == "parquet")
+    # Numbers the records sharing a source/target pair, to tell their rows apart
+    rows = RowCounter()
+    # Step images referenced by the stage-3 records are read from the .blob sidecars via mmap
+    with BlobReader(input_path.parent) as blob_reader:
+        while True:
+            records = take(record_iter, args.batch_size)
+            if not records:
+                break
+
+            # Collect the analysis requests of this batch, skipping the rows
+            # already written by an earlier run and those outside --subset
+            records = select_records(records, writer, subset, rows)
+            # Join the records to their source images by key, reading only the row groups they are in
+            with metrics.span("read"):
+                joined = index.join(records, args.source_column_name)
+            pending = []
+            analysis_jobs = []
+            for row, rec, source_image in joined: # source_image is corresponding image bytes
                 # Grab the edit key 
                 edit_text = (
                     rec["edit"]
@@ -102,12 +59,20 @@ def main():
                     else json.dumps(rec["edit"], ensure_ascii=False) # if the content of key "difference" is a dict
                 )
 
-                # Conver the step edited image saved in jsonal file from baed64 format into bytes format
-                step_image_b64 = rec['step_edited']
-                step_image =base64.b64decode(step_image_b64)
-
-                # The input images are under bytes format
-                cot_reediting_str = generator.generate(step_image, source_image, edit_text)
+                # Load the step edited image bytes from the sidecar (or from an inline base64 string)
+                step_image = load_step_image(rec['step_edited'], blob_reader)
+                provenance = generator.provenance.of(rec.get("step_image_provenance"), edit_text, step_image, source_image)
+                # With --incremental, keep the existing rows made from the same step image, edit and prompt
+                if args.incremental and writer.keep(row, provenance):
+                    continue
+                rec[generator.provenance.field] = provenance
+                pending.append((row, rec))
+                analysis_jobs.append((step_image, source_image, edit_text))
+            if not pending:
+                continue
+
+            def write_analysis(k: int, cot_reediting_str: str) -> None:
+                row, rec = pending[k]
                 try:
                     # Attempt to parse the difference string as JSON format
                     cot_reediting_str_clean = clean_json_block(cot_reediting_str)
@@ -116,7 +81,168 @@ def main():
                     cot_reediting = cot_reediting_str
                 # Add editing instructions to the record json and save as new output
                 rec["CoT_Reedit"] = cot_reediting
-                f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+                with metrics.span("write"):
+                    writer.write(rec, row)
+
+            # The input images are under bytes format; every record is appended
+            # in row order as soon as it is ready
+            runner.map_ordered(
+                lambda job: generator.agenerate(*job),
+                analysis_jobs,
+                args.concurrency,
+                on_result=write_analysis,
+                stop_on=(BudgetExceeded,),
+            )
+
+def run(args: argparse.Namespace):
+    # --incremental reads the existing outputs like --resume does
+    if args.incremental:
+        args.resume = True
+
+    # Optional on-disk response cache, so reruns do not pay for the same request twice
+    cache = (
+        ResponseCache(args.cache_dir, max_bytes=int(args.cache_max_gb * 1024 ** 3))
+        if args.cache_dir else None
+    )
+    # Rate budget of the chat model per key; 429s and Retry-After are handled even without one
+    budgets = {args.model: (args.rpm, args.tpm)}
+    # Latency, payload, token and error counters of every request, timing of the read / encode / write phases
+    metrics = Metrics("analysis")
+    # One key, or a pool of keys / endpoints from --api-keys-file; each key has its own
+    # pooled keep-alive connections and rate limiters
+    keys = KeyPool.from_specs(
+        load_key_specs(args.api_keys_file, args.api_key, args.base_url),
+        budgets,
+        client_options={
+            "max_connections": args.max_connections,
+            "max_keepalive_connections": args.max_keepalive_connections,
+            "keepalive_expiry": args.keepalive_expiry,
+            "connect_timeout": args.connect_timeout,
+            "read_timeout": args.read_timeout,
+            "http2": args.http2,
+        },
+        auth_cooldown=args.key_auth_cooldown,
+        error_cooldown=args.key_error_cooldown,
+    )
+    # Pre-flight cost / token estimate of every request, kept within --max-cost / --max-tokens
+    budget = Budget(max_cost=args.max_cost, max_tokens=args.max_tokens)
+    # Optional duplicates of the slowest requests, to cut the latency tail that holds up a shard
+    hedge = HedgePolicy(args.hedge_percentile / 100, max_rate=args.hedge_max_rate, min_delay=args.hedge_min_delay) if args.hedge_percentile else None
+    caller = ApiCaller(keys, cache=cache, max_retries=args.max_retries, metrics=metrics, budget=budget, hedge=hedge)
+
+    # Downscaling / re-encoding of the images before upload, cached across stages
+    images = ImagePreprocessor(
+        max_side=args.image_max_side,
+        detail=args.image_detail,
+        image_format=args.image_format,
+        quality=args.image_quality,
+        cache_dir=args.image_cache_dir,
+    )
+    generator = MultiModalAnalysisGenerator(
+        api_key=args.api_key,
+        model=args.model,
+        caller=caller,
+        images=images,
+        response_format=args.response_format,
+        # Repeated (step image, source image, edit) jobs are analysed once
+        dedup=Deduplicator(enabled=not args.no_dedup),
+    )
+    # A single event loop drives every async request of the run
+    runner = AsyncRunner()
+    # Existing rows are checked against their provenance hash with --incremental
+    provenance_field = generator.provenance.field if args.incremental else None
+    # Optional --subset of source/target keys to process
+    subset = load_subset(args.subset)
+
+    # The parquet files of this partition, in train-XXXXX order
+    valid_paths = list_shards(args.input_parquet_dir, args.num_shards, args.shard_index)
+
+    def fits_budget(parquet_path: str) -> bool:
+        # Judged from the average cost per request so far, once the first requests were settled
+        number = extract_index_number_str(parquet_path)
+        output_path = output_path_for(args.output_dir, number, args.output_format)
+        return budget.shard_fits(number, pending_rows(parquet_path, output_path, args.resume, subset), {args.model: 1})
+
+    # With --workers, each parquet file is claimed through a lock file so that
+    # concurrent processes (local or on other machines) never take the same one
+    for parquet_path in claim_shards(
+        valid_paths,
+        args.output_dir,
+        extract_index_number_str,
+        enabled=args.workers is not None,
+        stale_after=args.stale_lock_seconds,
+        admit=fits_budget if budget.limited else None,
+        run_id=args.run_id,
+        # --resume / --incremental check the files finished by earlier runs again
+        recheck_done=args.resume,
+    ):
+
+        # Extract the sequence string, for convenient
+        parquet_path_number_str = extract_index_number_str(parquet_path)
+
+        # Source/target -> row index of the parquet file; the source images are read
+        # by key, only from the row groups holding the pending records
+        index = ShardIndex(parquet_path, args.source_column_name, args.target_column_name, index_dir=args.index_dir)
+        print(f"Generating from original dataset_{parquet_path_number_str}.parquet for cot and reinstruction\n")
+        print(f"The information of processing parquet is:\n")
+        print(index.describe(),"\n")
+
+        # Upstream records of this shard
+        input_path = find_stage_input(args.input_jsonal_dir, parquet_path_number_str)
+
+        output_path = output_path_for(args.output_dir, parquet_path_number_str, args.output_format)
+        # Answers still unusable after local repair and one retry are stored as raw strings
+        failed_before = generator.structured.stats.failed
+        saved_before = generator.dedup.saved
+        cost_before = budget.spent_cost
+        # A request that no longer fits in the budget stops the run after the rows written so far
+        exhausted = None
+        try:
+            if args.mode == "batch":
+                # Send every pending request of the shard through the Batch API first,
+                # the pass below then merges the answers in row order
+                job = prepare_batch_answers(
+                    caller,
+                    output_path,
+                    lambda collecting_writer: process_shard(args, generator, runner, index, input_path, collecting_writer, subset),
+                    resume=args.resume,
+                    poll_interval=args.poll_interval,
+                    provenance_field=provenance_field,
+                )
+            with open_stage_writer(output_path, resume=args.resume, row_group_size=args.output_row_group_size, compression=args.output_compression, provenance_field=provenance_field) as writer:
+                process_shard(args, generator, runner, index, input_path, writer, subset)
+        except BudgetExceeded as exc:
+            exhausted = exc
+        print(f"Unparseable answers in {output_path.name}: {generator.structured.stats.failed - failed_before}\n")
+        print(f"Deduplicated calls in {output_path.name}: {generator.dedup.saved - saved_before}\n")
+        print(f"Spent on {output_path.name}: ${budget.spent_cost - cost_before:.4f}\n")
+        # Per-shard JSON summary next to the output; the textfile holds the run totals so far
+        metrics.finish_shard(output_path.with_name(f"{parquet_path_number_str}.metrics.json"), parquet_path_number_str)
+        if args.metrics_textfile:
+            metrics.write_prometheus(args.metrics_textfile)
+        if exhausted is not None:
+            print(f"Stopping: {exhausted}. Run again with --resume to continue\n")
+            break
+        if args.mode == "batch":
+            finish_batch_answers(caller, job)
+
+    runner.run(keys.aclose())
+    runner.close()
+    if cache is not None:
+        print(f"Response cache: {cache.stats()}\n")
+    print(f"API keys: {keys.stats()}\n")
+    print(f"Budget: {budget.stats()}\n")
+    if hedge is not None:
+        print(f"Hedging: {hedge.stats()}\n")
+    print(f"Structured answers: {generator.structured.stats.as_dict()}\n")
+    print(f"Image preprocessing: {images.stats()}\n")
+    print(f"Deduplication: {generator.dedup.stats()}\n")
+    print(f"Request metrics: {metrics.summary()['requests']}\n")
+
+def main():
+    args = parse_stage_args("analysis")
+    # One process, or --workers processes sharing the parquet files through lock files
+    run_workers(run, args, args.workers or 1)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,441 @@
+# run_pipeline.py
+
+import argparse
+import asyncio
+import base64
+import json
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from ._1_difference_generator import DifferenceDescriptionGenerator
+from ._2_instruction_generator import EditInstructionGenerator
+from ._3_step_image_generator import StepImageEditor, chain_steps
+from ._4_cot_reinstruction_generator import MultiModalAnalysisGenerator
+from .api_call import ApiCaller
+from .blob_store import BlobReader, BlobWriter, load_step_image
+from .budget import Budget, BudgetExceeded, pending_rows
+from .checkpoint import RowCounter, RowId, record_key
+from .cli import parse_stage_args
+from .dedup import Deduplicator
+from .hedging import HedgePolicy
+from .image_prep import ImagePreprocessor
+from .key_pool import KeyPool, load_key_specs
+from .metrics import Metrics, write_prometheus
+from .parquet_output import iter_stage_records, open_stage_writer, output_path_for
+from .parquet_stream import ParquetStreamReader, struct_field, struct_field_views
+from .response_cache import ResponseCache
+from .sharding import claim_shards, extract_index_number_str, list_shards, run_workers
+from .structured_output import clean_json_block
+
+
+def parse_json_answer(answer: str) -> Any:
+    try:
+        # Attempt to parse the answer string as JSON format
+        return json.loads(clean_json_block(answer))
+    except json.JSONDecodeError:
+        # Fallback to raw string if the API does not return valid JSON
+        return answer
+
+
+class OrderedSink:
+    """Write stage records in parquet row order although they finish out of order.
+
+    With --resume, rows the stage output already holds are not written
+    again, and rows that start at a later stage are passed with skip().
+    """
+
+    def __init__(self, writer: Any, metrics: Metrics) -> None:
+        self.writer = writer
+        self.metrics = metrics
+        self.next_index = 0
+        self.pending: Dict[int, Optional[Dict[str, Any]]] = {}
+
+    def put(self, index: int, record: Dict[str, Any], row: RowId) -> None:
+        self.pending[index] = None if self.writer.is_done(row) else record
+        self._drain()
+
+    def skip(self, index: int) -> None:
+        self.pending[index] = None
+        self._drain()
+
+    def _drain(self) -> None:
+        while self.next_index in self.pending:
+            record = self.pending.pop(self.next_index)
+            if record is not None:
+                with self.metrics.span("write"):
+                    self.writer.write(record)
+            self.next_index += 1
+
+
+async def run_stage(
+    process: Callable[[Dict[str, Any]], Awaitable[Dict[str, Any]]],
+    in_queue: asyncio.Queue,
+    out_queue: Optional[asyncio.Queue],
+    sink: OrderedSink,
+    concurrency: int,
+    next_concurrency: int,
+    stopped: List[BudgetExceeded],
+) -> None:
+    """Run `concurrency` workers that take rows from in_queue, process them and pass them on.
+
+    A None item marks the end of the input; once every worker has stopped,
+    one None per worker of the next stage is forwarded. Once a request was
+    refused by the budget (added to `stopped`), the rows still queued are
+    dropped, while the rows in flight are finished and written.
+    """
+    async def worker() -> None:
+        while True:
+            item = await in_queue.get()
+            if item is None:
+                break
+            if stopped:
+                continue
+            try:
+                item["record"] = await process(item)
+            except BudgetExceeded as exc:
+                stopped.append(exc)
+                continue
+            sink.put(item["index"], item["record"], item["row"])
+            if out_queue is not None:
+                await out_queue.put(item)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    if out_queue is not None:
+        for _ in range(next_concurrency):
+            await out_queue.put(None)
+
+
+def unfinished_records(output_path: Path, next_writer: Any, passthrough: bool) -> Dict[RowId, Dict[str, Any]]:
+    """--resume: the records of a stage output whose rows the next stage has not written yet."""
+    records: Dict[RowId, Dict[str, Any]] = {}
+    if not output_path.exists():
+        return records
+    rows = RowCounter()
+    for rec in iter_stage_records(output_path, decode={"difference", "edit"}, passthrough=passthrough):
+        row = rows.number(*record_key(rec))
+        if not next_writer.is_done(row):
+            records[row] = rec
+    return records
+
+
+async def run_shard(args: argparse.Namespace, generators: Dict[str, Any], parquet_path: str, parquet_path_number_str: str) -> None:
+    # Only the source and target image columns are decoded, and only once for all four stages
+    reader = ParquetStreamReader(
+        parquet_path,
+        batch_size=args.batch_size,
+        columns=[args.source_column_name, args.target_column_name],
+    )
+    print(f"Streaming original dataset_{parquet_path_number_str}.parquet through all four stages\n")
+    print(f"The information of processing parquet is:\n")
+    print(reader.describe(),"\n")
+
+    concurrency = [
+        max(1, args.difference_concurrency),
+        max(1, args.instruction_concurrency),
+        max(1, args.step_image_concurrency),
+        max(1, args.analysis_concurrency),
+    ]
+    output_dirs = [
+        args.difference_output_dir,
+        args.instruction_output_dir,
+        args.step_image_output_dir,
+        args.analysis_output_dir,
+    ]
+    queues = [asyncio.Queue(maxsize=args.queue_size) for _ in range(4)]
+    # Answers still unusable after local repair and one retry are stored as raw strings
+    chat_stages = ["difference", "instruction", "analysis"]
+    failed_before = {stage: generators[stage].structured.stats.failed for stage in chat_stages}
+    stages = ["difference", "instruction", "step_image", "analysis"]
+    saved_before = {stage: generators[stage].dedup.saved for stage in stages}
+    budget = generators["difference"].caller.budget
+    cost_before = budget.spent_cost
+    metrics = [generators[stage].caller.metrics for stage in stages]
+    output_paths = [output_path_for(d, parquet_path_number_str, args.output_format) for d in output_dirs]
+    writers = [
+        open_stage_writer(
+            output_path,
+            resume=args.resume,
+            row_group_size=args.output_row_group_size,
+            compression=args.output_compression,
+        )
+        for output_path in output_paths
+    ]
+    sinks = [OrderedSink(writer, stage_metrics) for writer, stage_metrics in zip(writers, metrics)]
+    blob_writer = (
+        BlobWriter(Path(f"{args.step_image_output_dir}/{parquet_path_number_str}.blob"), resume=args.resume)
+        if args.step_image_storage == "blob" and args.output_format == "jsonal" else None
+    )
+
+    # --resume: the records a row continues from when an earlier stage already wrote it
+    carried: List[Dict[RowId, Dict[str, Any]]] = [{}, {}, {}]
+    step_images: Dict[RowId, bytes] = {}
+    if args.resume:
+        for k in range(3):
+            carried[k] = unfinished_records(output_paths[k], writers[k + 1], passthrough=args.output_format == "parquet")
+        with BlobReader(Path(args.step_image_output_dir)) as blob_reader:
+            step_images = {row: bytes(load_step_image(rec["step_edited"], blob_reader)) for row, rec in carried[2].items()}
+    # Rows of this run by the stage they start at
+    started = [0, 0, 0, 0]
+
+    # The first request refused by the budget; no new rows are started after it
+    stopped: List[BudgetExceeded] = []
+
+    async def produce() -> None:
+        index = 0
+        rows = RowCounter()
+        # The parquet reads are accounted to the first stage, which they feed
+        for batch in metrics[0].timed(reader.iter_batches(), "read"):
+            if stopped:
+                break
+            # Zero-copy views of the image bytes, shared by every stage of the row
+            source_images = struct_field_views(batch, args.source_column_name)
+            target_images = struct_field_views(batch, args.target_column_name)
+            source_images_name = struct_field(batch, args.source_column_name, "path")
+            target_images_name = struct_field(batch, args.target_column_name, "path")
+            for i in range(len(source_images)):
+                if stopped:
+                    break
+                row = rows.number(source_images_name[i], target_images_name[i])
+                # A row starts at the first stage that has not written it yet (all of them without --resume)
+                stage = next((k for k in range(4) if not writers[k].is_done(row)), None)
+                if stage is None:
+                    continue
+                item = {
+                    "index": index,
+                    "row": row,
+                    "source_image": source_images[i],
+                    "target_image": target_images[i],
+                    "record": {"source": source_images_name[i], "target": target_images_name[i]},
+                }
+                if stage > 0:
+                    item["record"] = carried[stage - 1].pop(row)
+                if stage == 3:
+                    item["step_image"] = step_images.pop(row)
+                for sink in sinks[:stage]:
+                    sink.skip(index)
+                started[stage] += 1
+                await queues[stage].put(item)
+                index += 1
+        for _ in range(concurrency[0]):
+            await queues[0].put(None)
+        if args.resume:
+            print(f"Rows of shard {parquet_path_number_str} resumed per first stage: {dict(zip(stages, started))}\n")
+
+    async def difference(item: Dict[str, Any]) -> Dict[str, Any]:
+        generator = generators["difference"]
+        diff_str = await generator.adescribe_difference(item["source_image"], item["target_image"])
+        # The same provenance hashes as run_1 ... run_4, so their --incremental reruns can check these rows
+        provenance = generator.provenance.of(item["source_image"], item["target_image"])
+        return {**item["record"], "difference": parse_json_answer(diff_str), generator.provenance.field: provenance}
+
+    async def instruction(item: Dict[str, Any]) -> Dict[str, Any]:
+        rec = item["record"]
+        diff_text = (
+            rec["difference"]
+            if isinstance(rec["difference"], str)
+            else json.dumps(rec["difference"], ensure_ascii=False)
+        )
+        generator = generators["instruction"]
+        instr_str = await generator.agenerate_instructions(item["source_image"], diff_text)
+        edit = parse_json_answer(instr_str)
+        # Start preparing the stage 3 upload while the row waits in the queue
+        generators["step_image"].prefetch(item["source_image"], chain_steps(edit, args.edit_steps))
+        provenance = generator.provenance.of(rec["difference_provenance"], diff_text, item["source_image"])
+        return {**rec, "edit": edit, generator.provenance.field: provenance}
+
+    def store_image(step_image_bytes: bytes) -> Any:
+        if args.output_format == "parquet":
+            return step_image_bytes
+        if blob_writer is not None:
+            return blob_writer.append(step_image_bytes)
+        return base64.b64encode(step_image_bytes).decode("utf-8")
+
+    async def step_image(item: Dict[str, Any]) -> Dict[str, Any]:
+        rec = item["record"]
+        # The first --edit-steps numbered actions, each on the image of the step before
+        steps = chain_steps(rec["edit"], args.edit_steps)
+        editor = generators["step_image"]
+        step_images = await editor.aapply_chain(item["source_image"], steps)
+        # Keep the step 1 bytes for stage 4 instead of reading them back from disk
+        item["step_image"] = step_images[0]
+        provenance = editor.provenance.of(rec["instruction_provenance"], *steps, item["source_image"])
+        record = {**rec, editor.provenance.field: provenance, "step_edited": store_image(step_images[0])}
+        for step in range(2, args.edit_steps + 1):
+            if step <= len(step_images):
+                record[f"step_edited_{step}"] = store_image(step_images[step - 1])
+            elif args.output_format == "parquet":
+                record[f"step_edited_{step}"] = None
+        return record
+
+    async def analysis(item: Dict[str, Any]) -> Dict[str, Any]:
+        rec = item["record"]
+        edit_text = (
+            rec["edit"]
+            if isinstance(rec["edit"], str)
+            else json.dumps(rec["edit"], ensure_ascii=False)
+        )
+        generator = generators["analysis"]
+        step_image = item.pop("step_image")
+        cot_reediting_str = await generator.agenerate(step_image, item["source_image"], edit_text)
+        provenance = generator.provenance.of(rec["step_image_provenance"], edit_text, step_image, item["source_image"])
+        return {**rec, generator.provenance.field: provenance, "CoT_Reedit": parse_json_answer(cot_reediting_str)}
+
+    tasks = [
+        asyncio.ensure_future(produce()),
+        asyncio.ensure_future(run_stage(difference, queues[0], queues[1], sinks[0], concurrency[0], concurrency[1], stopped)),
+        asyncio.ensure_future(run_stage(instruction, queues[1], queues[2], sinks[1], concurrency[1], concurrency[2], stopped)),
+        asyncio.ensure_future(run_stage(step_image, queues[2], queues[3], sinks[2], concurrency[2], concurrency[3], stopped)),
+        asyncio.ensure_future(run_stage(analysis, queues[3], None, sinks[3], concurrency[3], 0, stopped)),
+    ]
+    try:
+        await asyncio.gather(*tasks)
+        failures = {stage: generators[stage].structured.stats.failed - failed_before[stage] for stage in chat_stages}
+        print(f"Unparseable answers in shard {parquet_path_number_str}: {failures}\n")
+        saved = {stage: generators[stage].dedup.saved - saved_before[stage] for stage in stages}
+        print(f"Deduplicated calls in shard {parquet_path_number_str}: {saved}\n")
+        print(f"Spent on shard {parquet_path_number_str}: ${budget.spent_cost - cost_before:.4f}\n")
+        # Per-stage JSON summaries next to each stage's output; the textfile holds the run totals so far
+        for stage_metrics, output_dir in zip(metrics, output_dirs):
+            stage_metrics.finish_shard(Path(f"{output_dir}/{parquet_path_number_str}.metrics.json"), parquet_path_number_str)
+        if args.metrics_textfile:
+            write_prometheus(args.metrics_textfile, metrics)
+        if stopped:
+            raise stopped[0]
+    finally:
+        # If one stage fails, stop the others instead of leaving them blocked on their queues
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for writer in writers:
+            writer.close()
+        if blob_writer is not None:
+            blob_writer.close()
+
+
+async def run_pipeline(args: argparse.Namespace) -> None:
+    # Optional on-disk response cache, so reruns do not pay for the same request twice
+    cache = (
+        ResponseCache(args.cache_dir, max_bytes=int(args.cache_max_gb * 1024 ** 3))
+        if args.cache_dir else None
+    )
+    # Separate rate budgets for the chat model and the image model (per key), shared by all stages
+    budgets = {
+        args.model: (args.rpm, args.tpm),
+        "gpt-image-1": (args.image_rpm, args.image_tpm),
+    }
+    # One key, or a pool of keys / endpoints from --api-keys-file; each key has its own
+    # pooled keep-alive connections and rate limiters
+    keys = KeyPool.from_specs(
+        load_key_specs(args.api_keys_file, args.api_key, args.base_url),
+        budgets,
+        client_options={
+            "max_connections": args.max_connections,
+            "max_keepalive_connections": args.max_keepalive_connections,
+            "keepalive_expiry": args.keepalive_expiry,
+            "connect_timeout": args.connect_timeout,
+            "read_timeout": args.read_timeout,
+            "image_max_connections": args.image_max_connections,
+            "image_read_timeout": args.image_read_timeout,
+            "http2": args.http2,
+        },
+        auth_cooldown=args.key_auth_cooldown,
+        error_cooldown=args.key_error_cooldown,
+    )
+    # Pre-flight cost / token estimate of every request of all stages, kept within --max-cost / --max-tokens
+    budget = Budget(max_cost=args.max_cost, max_tokens=args.max_tokens)
+    # Optional duplicates of the slowest requests, one policy (and extra-request cap) for all stages
+    hedge = HedgePolicy(args.hedge_percentile / 100, max_rate=args.hedge_max_rate, min_delay=args.hedge_min_delay) if args.hedge_percentile else None
+    caller = ApiCaller(keys, cache=cache, max_retries=args.max_retries, metrics=Metrics("difference"), budget=budget, hedge=hedge)
+    # One caller per stage, so that requests, tokens and phases are counted per stage;
+    # they share the keys (connection pools and rate budgets), the cache and the budget
+    callers = {"difference": caller}
+    for stage in ["instruction", "step_image", "analysis"]:
+        callers[stage] = ApiCaller(keys, cache=cache, max_retries=args.max_retries, metrics=Metrics(stage), budget=budget, hedge=hedge)
+    # One preprocessor for the chat stages, so a source image resized for stage 1 is reused by stages 2 and 4
+    images = ImagePreprocessor(
+        max_side=args.image_max_side,
+        detail=args.image_detail,
+        image_format=args.image_format,
+        quality=args.image_quality,
+        cache_dir=args.image_cache_dir,
+    )
+    # The image edits have no detail level and are uploaded as PNG unless asked otherwise.
+    # Their uploads are prepared in worker processes, started as soon as stage 2 is done with a row
+    image_pool = ProcessPoolExecutor(max_workers=args.image_workers) if args.image_workers > 0 else None
+    edit_images = ImagePreprocessor(
+        max_side=args.image_max_side,
+        image_format=args.image_format if args.image_format != "original" else "png",
+        quality=args.image_quality,
+        cache_dir=args.image_cache_dir,
+        executor=image_pool,
+    )
+    # Each stage sends identical work (same images and texts) to the API once per run
+    dedups = {stage: Deduplicator(enabled=not args.no_dedup) for stage in callers}
+    generators = {
+        "difference": DifferenceDescriptionGenerator(args.api_key, model=args.model, caller=callers["difference"], images=images, response_format=args.response_format, dedup=dedups["difference"]),
+        "instruction": EditInstructionGenerator(args.api_key, model=args.model, caller=callers["instruction"], images=images, response_format=args.response_format, dedup=dedups["instruction"]),
+        "step_image": StepImageEditor(api_key=args.api_key, n=args.n, caller=callers["step_image"], images=edit_images, dedup=dedups["step_image"]),
+        "analysis": MultiModalAnalysisGenerator(api_key=args.api_key, model=args.model, caller=callers["analysis"], images=images, response_format=args.response_format, dedup=dedups["analysis"]),
+    }
+
+    # The parquet files of this partition, in train-XXXXX order
+    valid_paths = list_shards(args.input_parquet_dir, args.num_shards, args.shard_index)
+    print(f"The number of parquet is {len(valid_paths)} \n")
+
+    def fits_budget(parquet_path: str) -> bool:
+        # Every row costs three chat requests and up to --edit-steps image edits
+        number = extract_index_number_str(parquet_path)
+        output_path = output_path_for(args.analysis_output_dir, number, args.output_format)
+        return budget.shard_fits(number, pending_rows(parquet_path, output_path, resume=args.resume), {args.model: 3, "gpt-image-1": args.edit_steps})
+
+    try:
+        # With --workers, each parquet file is claimed through a lock file so that
+        # concurrent processes (local or on other machines) never take the same one
+        for parquet_path in claim_shards(
+            valid_paths,
+            args.analysis_output_dir,
+            extract_index_number_str,
+            enabled=args.workers is not None,
+            stale_after=args.stale_lock_seconds,
+            admit=fits_budget if budget.limited else None,
+            run_id=args.run_id,
+            recheck_done=args.resume,
+        ):
+            try:
+                await run_shard(args, generators, parquet_path, extract_index_number_str(parquet_path))
+            except BudgetExceeded as exc:
+                # The stage outputs keep the rows finished so far, for a later --resume run
+                print(f"Stopping: {exc}. Run again with --resume to continue\n")
+                break
+    finally:
+        if image_pool is not None:
+            image_pool.shutdown()
+        await keys.aclose()
+
+    if cache is not None:
+        print(f"Response cache: {cache.stats()}\n")
+    print(f"API keys: {keys.stats()}\n")
+    print(f"Budget: {budget.stats()}\n")
+    if hedge is not None:
+        print(f"Hedging: {hedge.stats()}\n")
+    for stage in ["difference", "instruction", "analysis"]:
+        print(f"Structured answers ({stage}): {generators[stage].structured.stats.as_dict()}\n")
+    print(f"Image preprocessing: {images.stats()}\n")
+    print(f"Image preprocessing (edits): {edit_images.stats()}\n")
+    for stage, dedup in dedups.items():
+        print(f"Deduplication ({stage}): {dedup.stats()}\n")
+    print(f"Edit chains: {generators['step_image'].chain_stats()}\n")
+    for stage, stage_caller in callers.items():
+        print(f"Request metrics ({stage}): {stage_caller.metrics.summary()['requests']}\n")
+
+def run(args: argparse.Namespace) -> None:
+    asyncio.run(run_pipeline(args))
+
+def main() -> None:
+    args = parse_stage_args("pipeline")
+    # One process, or --workers processes sharing the parquet files through lock files
+    run_workers(run, args, args.workers or 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+import glob
+import json
+import multiprocessing
+import os
+import re
+import socket
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Callable, Iterator, List, Optional
+
+
+def extract_index_number_int(path):
+    # train-00012-xxx.parquet，extract int(12)
+    m = re.search(r'train-(\d+)-', os.path.basename(path))
+    return int(m.group(1)) if m else -1
+
+def extract_index_number_str(path):
+    # train-00012-xxx.parquet，extract str(00012)
+    m = re.search(r'train-(\d+)-', os.path.basename(path))
+    return m.group(1) if m else -1
+
+
+def list_shards(parquet_dir: str, num_shards: int = 1, shard_index: int = 0) -> List[str]:
+    """The parquet files of a run: sorted by train-XXXXX number, macOS ._ files skipped, this partition only."""
+    all_paths = glob.glob(os.path.join(parquet_dir, "*.parquet"))
+    valid_paths = [
+        p for p in all_paths
+        if not os.path.basename(p).startswith('._')
+    ]
+    # Sequence the path list with order of number: train-00000-xxx, train-00001-xxx, ...
+    valid_paths.sort(key=extract_index_number_int)
+    # Only the partition of this node, when the dataset is split across several
+    return select_shards(valid_paths, num_shards, shard_index, extract_index_number_int)
+
+
+def select_shards(
+    paths: List[str],
+    num_shards: int,
+    shard_index: int,
+    shard_number: Callable[[str], int],
+) -> List[str]:
+    """Keep the parquet files of partition `shard_index` out of `num_shards`.
+
+    Files are assigned by their train-XXXXX number (`shard_number`, i.e.
+    extract_index_number_int), so every node computes the same partition
+    even if it sees a different subset of the files. Files without a number
+    fall back to their position in the sorted list.
+    """
+    if not 0 <= shard_index < num_shards:
+        raise ValueError(f"--shard-index must be in [0, {num_shards}), got {shard_index}")
+    selected = []
+    for position, path in enumerate(paths):
+        number = shard_number(path)
+        if (number if number >= 0 else position) % num_shards == shard_index:
+            selected.append(path)
+    return selected
+
+
+class ShardLock:
+    """Exclusive claim of one parquet file, held as a lock file in the output directory.
+
+    `<number>.lock` is created with O_EXCL while the file is processed and
+    refreshed by a heartbeat; it is renamed to `<number>.done` once the
+    output is complete. A lock is stale, and may be taken over, when its
+    process is gone (same host) or its heartbeat is older than
+    `stale_after` seconds (any host on a shared filesystem).
+
+    The marker records the `run_id` of the run that finished the file. With
+    `recheck_done` (--resume / --incremental) only markers of the same run
+    count, so a later run checks every file again.
+    """
+
+    def __init__(self, lock_dir: Path, name: str, stale_after: float = 600.0, run_id: Optional[str] = None, recheck_done: bool = False) -> None:
+        self.lock_path = lock_dir / f"{name}.lock"
+        self.done_path = lock_dir / f"{name}.done"
+        self.stale_after = stale_after
+        self.run_id = run_id
+        self.recheck_done = recheck_done
+        self._stop = threading.Event()
+        self._heartbeat: Optional[threading.Thread] = None
+
+    def _is_stale(self) -> bool:
+        try:
+            stat = self.lock_path.stat()
+            owner = json.loads(self.lock_path.read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            return False
+        except ValueError:
+            # Half-written by an owner that died right after creating it
+            owner = {}
+        if time.time() - stat.st_mtime > self.stale_after:
+            return True
+        if owner.get("host") == socket.gethostname():
+            try:
+                os.kill(owner["pid"], 0)
+            except ProcessLookupError:
+                return True
+            except (KeyError, PermissionError):
+                pass
+        return False
+
+    def is_done(self) -> bool:
+        try:
+            marker = json.loads(self.done_path.read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            return False
+        except ValueError:
+            marker = {}
+        return not self.recheck_done or marker.get("run") == self.run_id
+
+    def acquire(self) -> bool:
+        """Try to claim the file; False if it is done or held by a live worker."""
+        if self.is_done():
+            return False
+        if self.lock_path.exists() and self._is_stale():
+            # Move the stale lock aside first: only one of several workers wins the rename
+            stale_path = self.lock_path.with_name(f"{self.lock_path.name}.stale.{os.getpid()}")
+            try:
+                os.rename(self.lock_path, stale_path)
+            except FileNotFoundError:
+                return False
+            stale_path.unlink(missing_ok=True)
+            print(f"Taking over the stale lock {self.lock_path}\n")
+        try:
+            fd = os.open(self.lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({"host": socket.gethostname(), "pid": os.getpid(), "started": time.time(), "run": self.run_id}, f)
+        # The lock may have been finished by another worker between the check and the claim
+        if self.is_done():
+            self.lock_path.unlink(missing_ok=True)
+            return False
+        self._heartbeat = threading.Thread(target=self._beat, daemon=True)
+        self._heartbeat.start()
+        return True
+
+    def _beat(self) -> None:
+        while not self._stop.wait(self.stale_after / 4):
+            try:
+                os.utime(self.lock_path)
+            except FileNotFoundError:
+                return
+
+    def _stop_heartbeat(self) -> None:
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+
+    def mark_done(self) -> None:
+        self._stop_heartbeat()
+        os.replace(self.lock_path, self.done_path)
+
+    def release(self) -> None:
+        """Give the file back unfinished, so another worker can pick it up."""
+        self._stop_heartbeat()
+        self.lock_path.unlink(missing_ok=True)
+
+
+def claim_shards(
+    paths: List[str],
+    lock_dir: str,
+    shard_number_str: Callable[[str], Any],
+    enabled: bool = True,
+    stale_after: float = 600.0,
+    admit: Optional[Callable[[str], bool]] = None,
+    run_id: Optional[str] = None,
+    recheck_done: bool = False,
+) -> Iterator[str]:
+    """Yield the parquet files this process gets to work on.
+
+    Without locking every path is yielded. With it, a path is only yielded
+    once its lock is acquired, and it is marked done when the loop asks for
+    the next one. If the loop body raises or breaks, the claim is released.
+    A path for which `admit` returns False is skipped and left unclaimed
+    (e.g. a shard that no longer fits in the budget). With `recheck_done`
+    the files finished by earlier runs are claimed again, see ShardLock.
+    """
+    if not enabled:
+        for path in paths:
+            if admit is None or admit(path):
+                yield path
+        return
+    Path(lock_dir).mkdir(parents=True, exist_ok=True)
+    for path in paths:
+        lock = ShardLock(Path(lock_dir), str(shard_number_str(path)), stale_after=stale_after, run_id=run_id, recheck_done=recheck_done)
+        if not lock.acquire():
+            continue
+        if admit is not None and not admit(path):
+            lock.release()
+            continue
+        try:
+            yield path
+        except BaseException:
+            lock.release()
+            raise
+        lock.mark_done()
+
+
+def run_workers(target: Callable[[Any], None], args: Any, workers: int) -> None:
+    """Run `target(args)` in `workers` processes that share the parquet files through lock files."""
+    # Written into the .done markers, so the workers of this run tell its finished files from older ones
+    args.run_id = uuid.uuid4().hex
+    if workers <= 1:
+        target(args)
+        return
+    processes = [multiprocessing.Process(target=target, args=(args,), name=f"worker-{k}") for k in range(workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    failed = [process.name for process in processes if process.exitcode != 0]
+    if failed:
+        raise SystemExit(f"Workers failed: {', '.join(failed)}")
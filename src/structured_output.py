@@ -0,0 +1,224 @@
+import json
+import re
+from typing import Any, Callable, Dict, List, Optional
+
+from .budget import BudgetExceeded
+
+
+def clean_json_block(s: str) -> str:
+    s = s.strip()
+    if s.startswith("```"):
+        s = s.strip("`")
+        s = s.replace("json\n", "", 1).replace("\n", "", 1) if s.startswith("json") else s
+    return s
+
+
+def repair_json(text: str) -> Optional[Any]:
+    """Parse a model answer as JSON, fixing the usual local damage; None if it cannot be saved.
+
+    Handles Markdown code fences, text around the outermost {...} and
+    trailing commas before a closing bracket.
+    """
+    cleaned = clean_json_block(text)
+    candidates = [cleaned]
+    start, end = cleaned.find("{"), cleaned.rfind("}")
+    if start != -1 and end > start:
+        candidates.append(cleaned[start:end + 1])
+    for candidate in list(candidates):
+        candidates.append(re.sub(r",\s*([}\]])", r"\1", candidate))
+    for candidate in candidates:
+        try:
+            return json.loads(candidate)
+        except json.JSONDecodeError:
+            continue
+    return None
+
+
+def _string_array(description: str) -> Dict[str, Any]:
+    return {"type": "array", "description": description, "items": {"type": "string"}}
+
+
+def _json_schema_format(name: str, properties: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": name,
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": properties,
+                "required": list(properties),
+                "additionalProperties": False,
+            },
+        },
+    }
+
+
+def _numbered(items: List[str], prefix: str = "") -> Dict[str, str]:
+    return {f"{prefix}{k}": item for k, item in enumerate(items, 1)}
+
+
+def _is_numbered(value: Any, prefixes: List[str]) -> bool:
+    pattern = re.compile(r"^(%s)\d+$" % "|".join(re.escape(p) for p in prefixes))
+    return (
+        isinstance(value, dict)
+        and bool(value)
+        and all(pattern.match(key) and isinstance(item, str) for key, item in value.items())
+    )
+
+
+class AnswerFormat:
+    """Structured-output contract of one chat stage.
+
+    Strict JSON schemas cannot describe dicts with free keys such as
+    {"1": ..., "2": ...}, so the model is asked for lists and `normalize`
+    turns them back into the numbered dicts the .jsonal records have always
+    used. Answers already in the numbered form (json_object mode, older
+    cache entries) are accepted as they are.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        properties: Dict[str, Any],
+        to_numbered: Callable[[Dict[str, Any]], Dict[str, str]],
+        numbered_prefixes: List[str],
+    ) -> None:
+        self.name = name
+        self.properties = properties
+        self.to_numbered = to_numbered
+        self.numbered_prefixes = numbered_prefixes
+
+    def response_format(self, mode: str) -> Optional[Dict[str, Any]]:
+        """The response_format request parameter for --response-format `mode`."""
+        if mode == "json_schema":
+            return _json_schema_format(self.name, self.properties)
+        if mode == "json_object":
+            return {"type": "json_object"}
+        return None
+
+    def normalize(self, value: Any) -> Optional[Dict[str, str]]:
+        if _is_numbered(value, self.numbered_prefixes):
+            return value
+        if (
+            isinstance(value, dict)
+            and set(value) == set(self.properties)
+            and all(isinstance(v, list) and all(isinstance(i, str) for i in v) for v in value.values())
+        ):
+            return self.to_numbered(value)
+        return None
+
+    def parse(self, answer: str) -> Optional[Dict[str, str]]:
+        """The numbered dict of an answer, after local repair; None if it is unusable."""
+        return self.normalize(repair_json(answer))
+
+
+DIFFERENCE_FORMAT = AnswerFormat(
+    "difference_description",
+    {"differences": _string_array("One sentence per difference category, in order")},
+    lambda value: _numbered(value["differences"]),
+    [""],
+)
+
+EDIT_FORMAT = AnswerFormat(
+    "editing_instructions",
+    {"edits": _string_array("One concise editing action per item, in order")},
+    lambda value: _numbered(value["edits"]),
+    [""],
+)
+
+COT_REEDIT_FORMAT = AnswerFormat(
+    "cot_reediting",
+    {
+        "CoT": _string_array("Chain-of-thought assessment steps, in order"),
+        "Re_Edit": _string_array("Re-editing instructions refining the first-step result, in order"),
+    },
+    lambda value: {**_numbered(value["CoT"], "CoT_"), **_numbered(value["Re_Edit"], "Re_Edit_")},
+    ["CoT_", "Re_Edit_"],
+)
+
+
+class ParseStats:
+    """Counters of the structured-answer handling of one generator."""
+
+    def __init__(self) -> None:
+        self.repaired = 0
+        self.retried = 0
+        self.failed = 0
+
+    def as_dict(self) -> Dict[str, int]:
+        return {"repaired": self.repaired, "retried": self.retried, "failed": self.failed}
+
+
+class StructuredChat:
+    """Ask a chat model for a structured answer: repair it locally, otherwise retry once.
+
+    Returns the answer as a JSON string of the numbered dict, or the raw
+    answer if it is still unusable after the retry. The retry bypasses the
+    response cache and the batch results, and replaces the cached answer.
+    """
+
+    def __init__(self, caller: Any, answer_format: AnswerFormat, mode: str = "json_schema") -> None:
+        self.caller = caller
+        self.answer_format = answer_format
+        self.mode = mode
+        self.stats = ParseStats()
+
+    def request_format(self) -> Optional[Dict[str, Any]]:
+        """The response_format sent with every request, None in prompt-only mode."""
+        return self.answer_format.response_format(self.mode)
+
+    def _params(self) -> Dict[str, Any]:
+        response_format = self.request_format()
+        return {"response_format": response_format} if response_format is not None else {}
+
+    def _check(self, answer: Optional[str]) -> Optional[str]:
+        # A refusal comes back without content
+        if not answer:
+            return None
+        parsed = self.answer_format.parse(answer)
+        if parsed is None:
+            return None
+        try:
+            json.loads(answer)
+        except (json.JSONDecodeError, TypeError):
+            # Only usable thanks to the local repair
+            self.stats.repaired += 1
+        return json.dumps(parsed, ensure_ascii=False)
+
+    def _give_up(self, answer: Optional[str]) -> str:
+        self.stats.failed += 1
+        return answer or ""
+
+    def chat(self, model: str, messages: List[dict]) -> str:
+        answer = self.caller.chat(model, messages, **self._params())
+        # The collection pass of batch mode has no answers yet
+        if self.caller.batch_collector is not None:
+            return answer
+        checked = self._check(answer)
+        if checked is not None:
+            return checked
+        self.stats.retried += 1
+        try:
+            answer = self.caller.chat(model, messages, refresh=True, **self._params())
+        except BudgetExceeded:
+            # Keep the answer already paid for rather than losing the row
+            return self._give_up(answer)
+        checked = self._check(answer)
+        return checked if checked is not None else self._give_up(answer)
+
+    async def achat(self, model: str, messages: List[dict]) -> str:
+        """Async version of chat."""
+        answer = await self.caller.achat(model, messages, **self._params())
+        if self.caller.batch_collector is not None:
+            return answer
+        checked = self._check(answer)
+        if checked is not None:
+            return checked
+        self.stats.retried += 1
+        try:
+            answer = await self.caller.achat(model, messages, refresh=True, **self._params())
+        except BudgetExceeded:
+            return self._give_up(answer)
+        checked = self._check(answer)
+        return checked if checked is not None else self._give_up(answer)
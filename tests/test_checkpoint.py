@@ -0,0 +1,98 @@
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from src.checkpoint import CheckpointWriter, RowCounter
+from src.parquet_output import iter_stage_records, open_stage_writer
+from src.row_index import select_records
+
+FIELD = "difference_provenance"
+
+
+def record(source, target, value, provenance="p"):
+    return {"source": source, "target": target, "difference": value, FIELD: provenance}
+
+
+def write_output(path, records):
+    with open_stage_writer(path) as writer:
+        for rec in records:
+            writer.write(rec)
+
+
+def read_values(path):
+    return [(rec["source"], rec["target"], rec["difference"]) for rec in iter_stage_records(path)]
+
+
+def rerun(path, records, provenance):
+    """An --incremental run over `records`: rows whose provenance changed are recomputed as value + "'"."""
+    rows = RowCounter()
+    with open_stage_writer(path, resume=True, provenance_field=FIELD) as writer:
+        for row, rec in [(rows.number(rec["source"], rec["target"]), rec) for rec in records]:
+            if not writer.keep(row, provenance[row]):
+                writer.write(record(rec["source"], rec["target"], rec["difference"] + "'", provenance[row]), row)
+
+
+def test_resume_after_a_crash_mid_line(tmp_path):
+    path = tmp_path / "00000.jsonal"
+    write_output(path, [record("a", "b", "x"), record("c", "d", "y")])
+    with path.open("a", encoding="utf-8") as f:
+        f.write('{"source": "e", "target": "f", "differ')
+
+    with CheckpointWriter(path, resume=True) as writer:
+        assert writer.done == {("a", "b", 0), ("c", "d", 0)}
+        assert not writer.is_done(("e", "f", 0))
+        writer.write(record("e", "f", "z"))
+
+    assert read_values(path) == [("a", "b", "x"), ("c", "d", "y"), ("e", "f", "z")]
+
+
+@pytest.mark.parametrize("suffix", ["jsonal", "parquet"])
+def test_incremental_keeps_the_nth_row_of_a_repeated_key(tmp_path, suffix):
+    path = tmp_path / f"00000.{suffix}"
+    records = [record("a", "b", "x0"), record("a", "b", "x1"), record(None, None, "n0"), record(None, None, "n1"), record("c", "d", "y")]
+    write_output(path, records)
+
+    # Only the second a/b row and the second unnamed row have new inputs
+    provenance = {("a", "b", 0): "p", ("a", "b", 1): "q", (None, None, 0): "p", (None, None, 1): "q", ("c", "d", 0): "p"}
+    rerun(path, records, provenance)
+
+    assert read_values(path) == [("a", "b", "x0"), ("a", "b", "x1'"), (None, None, "n0"), (None, None, "n1'"), ("c", "d", "y")]
+    # A plain resume afterwards sees every row, the repeated ones included
+    with open_stage_writer(path, resume=True) as writer:
+        assert select_records(records, writer, None, RowCounter()) == []
+
+
+@pytest.mark.parametrize("suffix", ["jsonal", "parquet"])
+def test_recomputed_rows_are_merged_in_shard_order(tmp_path, suffix):
+    path = tmp_path / f"00000.{suffix}"
+    records = [record(f"s{i}", "t", f"v{i}") for i in range(4)]
+    write_output(path, records)
+
+    # Rows 0 and 2 changed; row 4 is new to the output
+    provenance = {(f"s{i}", "t", 0): "q" if i in (0, 2) else "p" for i in range(5)}
+    rerun(path, records + [record("s4", "t", "v4")], provenance)
+
+    assert [value for _, _, value in read_values(path)] == ["v0'", "v1", "v2'", "v3", "v4'"]
+
+
+def test_changes_of_an_interrupted_incremental_run_are_merged_on_resume(tmp_path):
+    path = tmp_path / "00000.jsonal"
+    write_output(path, [record(f"s{i}", "t", f"v{i}") for i in range(3)])
+
+    writer = CheckpointWriter(path, resume=True, provenance_field=FIELD)
+    assert not writer.keep(("s1", "t", 0), "q")
+    writer.write(record("s1", "t", "v1'", "q"), ("s1", "t", 0))
+    # Killed before close(): the recomputed row only exists in the .changes file
+    writer.file.close()
+    assert writer.changes_path.exists()
+
+    with CheckpointWriter(path, resume=True) as resumed:
+        assert resumed.done == {("s0", "t", 0), ("s1", "t", 0), ("s2", "t", 0)}
+    assert not writer.changes_path.exists()
+    assert [value for _, _, value in read_values(path)] == ["v0", "v1'", "v2"]
+    with path.open(encoding="utf-8") as f:
+        assert json.loads(f.readlines()[1])[FIELD] == "q"
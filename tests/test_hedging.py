@@ -0,0 +1,61 @@
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from benchmarks.mock_openai import Latency, MockState, start_mock_server
+from src.api_call import ApiCaller
+from src.hedging import HedgePolicy
+from src.http_client import OpenAIClients
+
+
+def test_slow_call_is_hedged_and_the_hedge_wins():
+    policy = HedgePolicy(percentile=0.9, max_rate=1.0, min_samples=5)
+    key = ("chat.completions", "gpt-4o")
+    for _ in range(5):
+        policy.observe(key, 0.01)
+    copies = []
+
+    async def send():
+        # The original stalls, the duplicate answers at the usual speed
+        copies.append(None)
+        await asyncio.sleep(5.0 if len(copies) == 1 else 0.01)
+        return len(copies)
+
+    assert asyncio.run(policy.run(key, send)) == 2
+    assert policy.hedges == 1
+    assert policy.wins == 1
+
+
+def test_default_delay_follows_the_percentile_of_fast_requests():
+    policy = HedgePolicy(percentile=0.95, min_samples=5)
+    key = ("chat.completions", "gpt-4o")
+    for seconds in [0.2, 0.25, 0.3, 0.35, 0.4]:
+        policy.observe(key, seconds)
+    assert policy.delay(key) == 0.4
+
+
+def test_requests_to_a_server_with_a_latency_tail_get_hedged():
+    state = MockState(Latency("lognormal:0.02:1.0"), Latency("fixed:0.01"), seed=1)
+    server = start_mock_server(state)
+    clients = OpenAIClients("test", base_url=f"http://127.0.0.1:{server.server_address[1]}/v1")
+    hedge = HedgePolicy(percentile=0.8, max_rate=0.5, min_samples=10)
+    caller = ApiCaller.from_api_key("test", clients=clients, hedge=hedge)
+
+    async def ask(i):
+        return await caller.achat("gpt-4o", [{"role": "user", "content": f"question {i}"}])
+
+    async def main():
+        try:
+            for i in range(60):
+                await ask(i)
+        finally:
+            await clients.aclose()
+
+    try:
+        asyncio.run(main())
+    finally:
+        server.shutdown()
+    assert hedge.hedges > 0
+    assert hedge.wins > 0